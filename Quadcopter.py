@@ -13,43 +13,131 @@
 ####################################################################################################
 
 from __future__ import division
+from __future__ import print_function
 import signal
-import socket
 import time
-import string
 import sys
 import getopt
 import math
-import thread
 from array import *
-import smbus
 import select
 import os
+import errno
+import fcntl
 import struct
+import gc
 import logging
+import atexit
+
+#---------------------------------------------------------------------------------------------------
+# Python 2 / 3 (and PyPy) module names
+#---------------------------------------------------------------------------------------------------
+try:
+    import thread
+except ImportError:
+    import _thread as thread
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+#---------------------------------------------------------------------------------------------------
+# Importing this module only makes definitions, so it's quick and can be done anywhere.  Everything
+# heavy or with side effects is imported where it's first used:
+#
+# - the hardware drivers, C extensions only present on the Pi, by ImportDrivers() when a driver is
+#   constructed or go() checks for them via RequireHardware(); without them the flight code still
+#   runs off the hardware (qcbench, replays, interpreters they don't build for)
+# - NumPy, for the batch analysis functions only, by RequireNumpy()
+# - numba, to JIT compile the math kernels, by EnableKernels() at startup; without it they run as
+#   plain Python
+# - multiprocessing, ctypes, subprocess etc by the functions using them
+#
+# Each is None until imported (or if it's not installed).
+#---------------------------------------------------------------------------------------------------
+smbus = None
+RPIO = None
+PWM = None
+numpy = None
+numba = None
+
+def ImportDrivers():
+    global smbus
+    global RPIO
+    global PWM
+
+    if smbus is None:
+        try:
+            import smbus
+        except ImportError:
+            pass
 
-import RPi.GPIO as RPIO
-from RPIO import PWM
-
-import subprocess
-from datetime import datetime
-import shutil
-import ctypes
-from ctypes.util import find_library
-import random
+    if RPIO is None or PWM is None:
+        try:
+            import RPi.GPIO as RPIO
+            from RPIO import PWM
+        except ImportError:
+            RPIO = None
+            PWM = None
 
 ####################################################################################################
 #
 #  Adafruit i2c interface enhanced with performance / error handling enhancements
 #
+#  Each transfer is retried a bounded number of times within a deadline, backing off between
+#  attempts (exponentially, or fixed with a backoff factor of 1).  Misses are counted per register
+#  and logged at most once per log interval.  Too many consecutive failed transfers open a circuit
+#  breaker; while it's open transfers fail straight away, and after a cooldown a single trial
+#  transfer decides whether it closes again.  The flight loop queries the breaker to trigger a
+#  failsafe.
+#
 ####################################################################################################
+class I2CError(IOError):
+    pass
+
+
 class I2C:
 
-    def __init__(self, address, bus=smbus.SMBus(1)):
+    BREAKER_CLOSED = 0
+    BREAKER_OPEN = 1
+    BREAKER_HALF_OPEN = 2
+
+    _LOG_INTERVAL = 1.0
+    _BREAKER_THRESHOLD = 10
+    _BREAKER_COOLDOWN = 0.5
+
+    def __init__(self, address, bus=None, attempts=5, deadline=0.005, backoff=0.0001, backoff_factor=2.0):
         self.address = address
+        if bus is None:
+            ImportDrivers()
+            if smbus is None:
+                raise ImportError("smbus is needed for the i2c bus")
+            bus = smbus.SMBus(1)
         self.bus = bus
         self.misses = 0
 
+        #-------------------------------------------------------------------------------------------
+        # Retry policy
+        #-------------------------------------------------------------------------------------------
+        self.attempts = attempts
+        self.deadline = deadline
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+
+        #-------------------------------------------------------------------------------------------
+        # Bus health: failed transfers, per-register miss histogram, rate-limited miss logging and
+        # the circuit breaker
+        #-------------------------------------------------------------------------------------------
+        self.failures = 0
+        self.register_misses = {}
+        self.unlogged_misses = 0
+        self.next_log_time = 0.0
+        self.consecutive_failures = 0
+        self.breaker = self.BREAKER_CLOSED
+        self.breaker_time = 0.0
+        self.breaker_trips = 0
+
     def reverseByteOrder(self, data):
         "Reverses the byte order of an int (16-bit) or long (32-bit) value"
         # Courtesy Vishal Sapre
@@ -62,81 +150,326 @@ class I2C:
             data >>= 8
         return val
 
-    def write8(self, reg, value):
-        "Writes an 8-bit value to the specified register/address"
+    def transfer(self, function, reg, arg = None):
+        "Runs function(address, reg[, arg]) with bounded retries, raising I2CError if they all fail"
+        if self.breaker == self.BREAKER_OPEN:
+            if time.time() - self.breaker_time < self._BREAKER_COOLDOWN:
+                raise I2CError("i2c breaker open")
+            self.breaker = self.BREAKER_HALF_OPEN
+
+        attempt = 0
+        backoff = self.backoff
         while True:
             try:
-                self.bus.write_byte_data(self.address, reg, value)
-                break
-            except IOError, err:
-                logger.critical("i2c miss")
-                self.misses += 1
+                if arg is None:
+                    result = function(self.address, reg)
+                else:
+                    result = function(self.address, reg, arg)
+
+                self.consecutive_failures = 0
+                if self.breaker != self.BREAKER_CLOSED:
+                    self.breaker = self.BREAKER_CLOSED
+                    logger.critical("i2c breaker closed")
+                return result
+
+            except IOError as err:
+                self.missed(reg)
+
+                #-----------------------------------------------------------------------------------
+                # The deadline is only worked out once something's gone wrong to keep the normal
+                # path free of time lookups.
+                #-----------------------------------------------------------------------------------
+                time_now = time.time()
+                attempt += 1
+                if attempt == 1:
+                    deadline = time_now + self.deadline
+
+                if attempt >= self.attempts or time_now + backoff > deadline:
+                    break
+
+                time.sleep(backoff)
+                backoff *= self.backoff_factor
+
+        #-------------------------------------------------------------------------------------------
+        # Out of retries: count the failure, and open the breaker if the bus looks dead.
+        #-------------------------------------------------------------------------------------------
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.breaker == self.BREAKER_HALF_OPEN or self.consecutive_failures >= self._BREAKER_THRESHOLD:
+            if self.breaker != self.BREAKER_OPEN:
+                self.breaker_trips += 1
+                logger.critical("i2c breaker open after %d failed transfers", self.consecutive_failures)
+            self.breaker = self.BREAKER_OPEN
+            self.breaker_time = time.time()
+
+        raise I2CError("i2c transfer failed: address 0x%02x, register 0x%02x" % (self.address, reg))
+
+    def missed(self, reg):
+        self.misses += 1
+        self.register_misses[reg] = self.register_misses.get(reg, 0) + 1
+
+        #-------------------------------------------------------------------------------------------
+        # Aggregate the logging rather than logging each miss.
+        #-------------------------------------------------------------------------------------------
+        self.unlogged_misses += 1
+        time_now = time.time()
+        if time_now >= self.next_log_time:
+            logger.critical("i2c miss x %d", self.unlogged_misses)
+            self.unlogged_misses = 0
+            self.next_log_time = time_now + self._LOG_INTERVAL
+
+    def breakerOpen(self):
+        return self.breaker != self.BREAKER_CLOSED
+
+    def write8(self, reg, value):
+        "Writes an 8-bit value to the specified register/address"
+        self.transfer(self.bus.write_byte_data, reg, value)
 
     def writeList(self, reg, list):
         "Writes an array of bytes using I2C format"
-        while True:
-            try:
-                self.bus.write_i2c_block_data(self.address, reg, list)
-                break
-            except IOError, err:
-                logger.critical("i2c miss")
-                self.misses += 1
+        self.transfer(self.bus.write_i2c_block_data, reg, list)
 
     def readU8(self, reg):
         "Read an unsigned byte from the I2C device"
-        while True:
-            try:
-                result = self.bus.read_byte_data(self.address, reg)
-                return result
-            except IOError, err:
-                logger.critical("i2c miss")
-                self.misses += 1
+        result = self.transfer(self.bus.read_byte_data, reg)
+        return result
 
     def readS8(self, reg):
         "Reads a signed byte from the I2C device"
-        while True:
-            try:
-                result = self.bus.read_byte_data(self.address, reg)
-                if (result > 127):
-                    return result - 256
-                else:
-                    return result
-            except IOError, err:
-                logger.critical("i2c miss")
-                self.misses += 1
+        result = self.transfer(self.bus.read_byte_data, reg)
+        if (result > 127):
+            return result - 256
+        else:
+            return result
 
     def readU16(self, reg):
         "Reads an unsigned 16-bit value from the I2C device"
-        while True:
-            try:
-                hibyte = self.bus.read_byte_data(self.address, reg)
-                result = (hibyte << 8) + self.bus.read_byte_data(self.address, reg+1)
-                return result
-            except IOError, err:
-                logger.critical("i2c miss")
-                self.misses += 1
+        hibyte = self.transfer(self.bus.read_byte_data, reg)
+        result = (hibyte << 8) + self.transfer(self.bus.read_byte_data, reg+1)
+        return result
 
     def readS16(self, reg):
         "Reads a signed 16-bit value from the I2C device"
-        while True:
-            try:
-                hibyte = self.bus.read_byte_data(self.address, reg)
-                if (hibyte > 127):
-                    hibyte -= 256
-                result = (hibyte << 8) + self.bus.read_byte_data(self.address, reg+1)
-                return result
-            except IOError, err:
-                logger.critical("i2c miss")
-                self.misses += 1
+        hibyte = self.transfer(self.bus.read_byte_data, reg)
+        if (hibyte > 127):
+            hibyte -= 256
+        result = (hibyte << 8) + self.transfer(self.bus.read_byte_data, reg+1)
+        return result
 
     def readList(self, reg, length):
         "Reads a a byte array value from the I2C device"
-        result = self.bus.read_i2c_block_data(self.address, reg, length)
+        result = self.transfer(self.bus.read_i2c_block_data, reg, length)
         return result
 
     def getMisses(self):
         return self.misses
 
+    def report(self):
+        if self.unlogged_misses:
+            logger.critical("i2c miss x %d", self.unlogged_misses)
+            self.unlogged_misses = 0
+        logger.critical("i2c %d failed transfers, breaker tripped %d times", self.failures, self.breaker_trips)
+        for reg in sorted(self.register_misses):
+            logger.critical("i2c register 0x%02x: %d misses", reg, self.register_misses[reg])
+
+
+####################################################################################################
+#
+# MPU6050 data ready interrupt waiter.  The edges are waited for with epoll on a file descriptor
+# so each wait has a timeout: if the interrupt line stops toggling, the wait returns rather than
+# hanging with the motors left running at their last pulse widths, and enough consecutive timeouts
+# mark the line as stuck for the flight loop's failsafe.
+#
+# Edges pending when a wait starts are all consumed by it, returning their count, so more than one
+# means samples were missed.  The fd can be:
+#
+# - the GPIO character device (line event via GPIO_GET_LINEEVENT_IOCTL): edges are queued by the
+#   kernel with timestamps, so the count and time of each is exact
+# - the sysfs GPIO value file, the fallback for kernels without the character device: a wakeup is
+#   one edge, time stamped at wakeup
+# - a pipe or eventfd stand-in, one byte / the counter per edge, for driving it off the hardware
+#
+####################################################################################################
+class DataReadyTimeout(IOError):
+    pass
+
+
+class DataReadyWaiter:
+
+    SOURCE_CHARDEV = "chardev"
+    SOURCE_SYSFS = "sysfs"
+    SOURCE_PIPE = "pipe"
+    SOURCE_EVENTFD = "eventfd"
+
+    #-----------------------------------------------------------------------------------------------
+    # linux/gpio.h: struct gpioevent_request and struct gpioevent_data
+    #-----------------------------------------------------------------------------------------------
+    _GPIO_GET_LINEEVENT_IOCTL = 0xC030B404
+    _GPIOHANDLE_REQUEST_INPUT = 0x01
+    _GPIOEVENT_REQUEST_RISING_EDGE = 0x01
+    _GPIOEVENT_REQUEST = struct.Struct("=III32si")
+    _GPIOEVENT_DATA = struct.Struct("=QI4x")
+    _MAX_EVENTS = 64
+
+    _EVENTFD = struct.Struct("=Q")
+    _EFD_NONBLOCK = 0o4000
+
+    def __init__(self, fd, source, timeout = 0.02, stuck_timeouts = 5, pin = None):
+        self.fd = fd
+        self.source = source
+        self.timeout = timeout
+        self.stuck_timeouts = stuck_timeouts
+        self.pin = pin
+
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.epoll = select.epoll()
+        if source == self.SOURCE_SYSFS:
+            self.epoll.register(fd, select.EPOLLPRI | select.EPOLLERR)
+        else:
+            self.epoll.register(fd, select.EPOLLIN)
+
+        #-------------------------------------------------------------------------------------------
+        # Statistics, and the time of the latest edge in seconds: from the kernel's event for the
+        # character device (CLOCK_MONOTONIC / CLOCK_REALTIME depending on kernel version), else
+        # time.time() at wakeup.
+        #-------------------------------------------------------------------------------------------
+        self.timestamp = 0.0
+        self.edges = 0
+        self.wakeups = 0
+        self.coalesced = 0
+        self.max_count = 0
+        self.timeouts = 0
+        self.consecutive_timeouts = 0
+
+    @classmethod
+    def fromGPIO(cls, pin, chip = "/dev/gpiochip0", **kwargs):
+        #-------------------------------------------------------------------------------------------
+        # Rising edges on a BCM GPIO pin, by the character device if possible, else via sysfs
+        #-------------------------------------------------------------------------------------------
+        try:
+            chip_fd = os.open(chip, os.O_RDONLY)
+            try:
+                request = bytearray(cls._GPIOEVENT_REQUEST.pack(pin,
+                                                                cls._GPIOHANDLE_REQUEST_INPUT,
+                                                                cls._GPIOEVENT_REQUEST_RISING_EDGE,
+                                                                b"qc data ready",
+                                                                -1))
+                fcntl.ioctl(chip_fd, cls._GPIO_GET_LINEEVENT_IOCTL, request, True)
+            finally:
+                os.close(chip_fd)
+            fd = cls._GPIOEVENT_REQUEST.unpack(bytes(request))[4]
+            return cls(fd, cls.SOURCE_CHARDEV, pin = pin, **kwargs)
+
+        except (IOError, OSError) as err:
+            logger.warning("GPIO character device unavailable (%s), using sysfs", err)
+
+        gpio_path = "/sys/class/gpio/gpio%d" % pin
+        if not os.path.exists(gpio_path):
+            with open("/sys/class/gpio/export", "w") as export:
+                export.write("%d" % pin)
+        with open(gpio_path + "/direction", "w") as direction:
+            direction.write("in")
+        with open(gpio_path + "/edge", "w") as edge:
+            edge.write("rising")
+
+        fd = os.open(gpio_path + "/value", os.O_RDONLY)
+        os.read(fd, 8)
+        return cls(fd, cls.SOURCE_SYSFS, pin = pin, **kwargs)
+
+    @classmethod
+    def fromPipe(cls, **kwargs):
+        #-------------------------------------------------------------------------------------------
+        # Stand-in returning the waiter and the pipe's write fd: each byte written is an edge
+        #-------------------------------------------------------------------------------------------
+        read_fd, write_fd = os.pipe()
+        return cls(read_fd, cls.SOURCE_PIPE, **kwargs), write_fd
+
+    @classmethod
+    def fromEventfd(cls, **kwargs):
+        #-------------------------------------------------------------------------------------------
+        # Stand-in on an eventfd: each write of n as an 8 byte counter is n edges
+        #-------------------------------------------------------------------------------------------
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        fd = libc.eventfd(0, cls._EFD_NONBLOCK)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "eventfd failed")
+        return cls(fd, cls.SOURCE_EVENTFD, **kwargs)
+
+    def read(self):
+        #-------------------------------------------------------------------------------------------
+        # Consume the pending edges, returning how many there were
+        #-------------------------------------------------------------------------------------------
+        try:
+            if self.source == self.SOURCE_CHARDEV:
+                data = os.read(self.fd, self._GPIOEVENT_DATA.size * self._MAX_EVENTS)
+                count = len(data) // self._GPIOEVENT_DATA.size
+                if count:
+                    timestamp, event_id = self._GPIOEVENT_DATA.unpack_from(data, (count - 1) * self._GPIOEVENT_DATA.size)
+                    self.timestamp = timestamp / 1000000000
+                return count
+
+            if self.source == self.SOURCE_SYSFS:
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.read(self.fd, 8)
+                count = 1
+            elif self.source == self.SOURCE_EVENTFD:
+                count = self._EVENTFD.unpack(os.read(self.fd, self._EVENTFD.size))[0]
+            else:
+                count = len(os.read(self.fd, 4096))
+
+        except (IOError, OSError) as err:
+            if err.errno != errno.EAGAIN:
+                raise
+            count = 0
+
+        if count:
+            self.timestamp = time.time()
+        return count
+
+    def wait(self, timeout = None):
+        #-------------------------------------------------------------------------------------------
+        # Wait for the next edge(s), returning how many or 0 on timeout.  Signals (e.g. the
+        # sensor thread waking the main one) just restart the wait.
+        #-------------------------------------------------------------------------------------------
+        if timeout is None:
+            timeout = self.timeout
+
+        while True:
+            try:
+                events = self.epoll.poll(timeout)
+                break
+            except (IOError, OSError) as err:
+                if err.errno != errno.EINTR:
+                    raise
+
+        count = self.read() if events else 0
+        if not count:
+            self.timeouts += 1
+            self.consecutive_timeouts += 1
+            return 0
+
+        self.consecutive_timeouts = 0
+        self.wakeups += 1
+        self.edges += count
+        if count > 1:
+            self.coalesced += 1
+        if count > self.max_count:
+            self.max_count = count
+        return count
+
+    def stuck(self):
+        return self.consecutive_timeouts >= self.stuck_timeouts
+
+    def report(self):
+        logger.critical("data ready (%s): %d edges in %d wakeups, %d coalesced (max %d edges), %d timeouts",
+                        self.source, self.edges, self.wakeups, self.coalesced, self.max_count, self.timeouts)
+
+    def close(self):
+        self.epoll.close()
+        os.close(self.fd)
+
 
 ####################################################################################################
 #
@@ -261,20 +594,92 @@ class MPU6050 :
 
     __CALIBRATION_ITERATIONS = 50
 
+    #-----------------------------------------------------------------------------------------------
+    # HMC5883L magnetometer on the auxiliary i2c bus
+    #-----------------------------------------------------------------------------------------------
+    __HMC5883L_RA_CONFIG_A = 0x00
+    __HMC5883L_RA_CONFIG_B = 0x01
+    __HMC5883L_RA_MODE = 0x02
+    __HMC5883L_RA_DATA_X_H = 0x03
+    __HMC5883L_RA_ID_A = 0x0A
+    __HMC5883L_ID = [0x48, 0x34, 0x33]
+    __HMC5883L_OVERFLOW = -4096
+
+    #-----------------------------------------------------------------------------------------------
+    # The auxiliary i2c master reads the magnetometer every 1 + MAG_DELAY samples
+    #-----------------------------------------------------------------------------------------------
+    __MAG_DELAY = 9
+
+    #-----------------------------------------------------------------------------------------------
+    # The scales are for the +/- 250 degrees/s and +/- 2g ranges; raw data from the wider ranges
+    # is normalized to these by readSensors() so the offsets and scales never change.
+    #-----------------------------------------------------------------------------------------------
     __SCALE_GYRO = 500.0 * math.pi / (65536 * 180)
     __SCALE_ACCEL = 4.0 / 65536
 
-    def __init__(self, address=0x68, alpf=1, glpf=1):
-        self.i2c = I2C(address)
+    GYRO_RANGES = (250, 500, 1000, 2000)
+    ACCEL_RANGES = (2, 4, 8, 16)
+
+    def __init__(self, address=0x68, alpf=1, glpf=1, bus=None, data_ready=None):
+        if bus is None:
+            self.i2c = I2C(address)
+        else:
+            self.i2c = I2C(address, bus)
         self.address = address
+
+        #-------------------------------------------------------------------------------------------
+        # The data ready interrupt waiter; without one, readSensors() reads straight away.
+        #-------------------------------------------------------------------------------------------
+        self.data_ready = data_ready
         self.sensor_data = array('B', [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
-        self.result_array = array('h', [0, 0, 0, 0, 0, 0, 0])
+
+        #-------------------------------------------------------------------------------------------
+        # The ImuCapture each raw sample is written to as read, if any
+        #-------------------------------------------------------------------------------------------
+        self.capture = None
+        self.result_array = array('i', [0, 0, 0, 0, 0, 0, 0])
         self.misses = 0
 
+        #-------------------------------------------------------------------------------------------
+        # The burst read length: the accelerometer, temperature and gyro, plus the magnetometer's
+        # x, z, y from EXT_SENS_DATA_00-05 once enableMagnetometer() has slaved it.  The latest
+        # magnetometer data is kept in mag_array as x, y, z in raw units for a Compass to read.
+        #-------------------------------------------------------------------------------------------
+        self.burst_length = 14
+        self.mag_array = array('i', [0, 0, 0])
+        self.mag_overflows = 0
+
+        #-------------------------------------------------------------------------------------------
+        # Register shadow: the last value written to each configuration register, those written
+        # but not yet read back, and the count of writes skipped because the value was unchanged.
+        #-------------------------------------------------------------------------------------------
+        self.registers = {}
+        self.unverified = set()
+        self.skipped_writes = 0
+
+        #-------------------------------------------------------------------------------------------
+        # Configuration changes made at runtime are queued here and applied by readSensors()
+        # between samples.  The per-sensor factors normalizing the raw data to the +/- 2g and
+        # +/- 250 degrees/s ranges change with them as a single tuple so they always match the data.
+        #-------------------------------------------------------------------------------------------
+        self.pending_lock = thread.allocate_lock()
+        self.pending_writes = {}
+        self.range_factors = (1, 1, 1, 1, 1, 1, 1)
+        self.discard_sample = False
+
         self.gx_offset = 0.0
         self.gy_offset = 0.0
         self.gz_offset = 0.0
 
+        #-------------------------------------------------------------------------------------------
+        # The gyro offsets' drift per unit of temperature from the temperature model, if loaded,
+        # applied relative to the temperature calibrateGyros() measured them at.
+        #-------------------------------------------------------------------------------------------
+        self.gbx = 0.0
+        self.gby = 0.0
+        self.gbz = 0.0
+        self.gyro_temp = 0.0
+
         #-------------------------------------------------------------------------------------------
         # 0g offsets equation values measured with qc.py -g at low and high ambient temperatures
         # _Assuming_ the 0g offsets drift linearly, then measuring the offsets at 2 widely separated
@@ -318,6 +723,7 @@ class MPU6050 :
         #-------------------------------------------------------------------------------------------
         logger.debug('Reset all registers')
         self.i2c.write8(self.__MPU6050_RA_PWR_MGMT_1, 0x80)
+        self.registers = {}
         time.sleep(5.0)
 
         #-------------------------------------------------------------------------------------------
@@ -326,14 +732,14 @@ class MPU6050 :
         # to be changed to 7 to obtain the same 1kHz sample rate.
         #-------------------------------------------------------------------------------------------
         logger.debug('Sample rate 1kHz')
-        self.i2c.write8(self.__MPU6050_RA_SMPLRT_DIV, 1)
+        self.writeRegister(self.__MPU6050_RA_SMPLRT_DIV, 1)
         time.sleep(0.1)
 
         #-------------------------------------------------------------------------------------------
         # Sets clock source to gyro reference w/ PLL
         #-------------------------------------------------------------------------------------------
         logger.debug('Clock gyro PLL')
-        self.i2c.write8(self.__MPU6050_RA_PWR_MGMT_1, 0x01)
+        self.writeRegister(self.__MPU6050_RA_PWR_MGMT_1, 0x01)
         time.sleep(0.1)
 
         #-------------------------------------------------------------------------------------------
@@ -349,7 +755,7 @@ class MPU6050 :
         # 0x07 = 3600Hz @ 8kHz
         #-------------------------------------------------------------------------------------------
         logger.debug('configurable DLPF to filter out non-gravitational acceleration for Euler')
-        self.i2c.write8(self.__MPU6050_RA_CONFIG, glpf)
+        self.writeRegister(self.__MPU6050_RA_CONFIG, glpf)
         time.sleep(0.1)
 
         #-------------------------------------------------------------------------------------------
@@ -363,7 +769,7 @@ class MPU6050 :
         #-------------------------------------------------------------------------------------------
         # int(math.log(degrees / 250, 2)) << 3
         logger.debug('Gyro +/-250 degrees/s')
-        self.i2c.write8(self.__MPU6050_RA_GYRO_CONFIG, 0x00)
+        self.writeRegister(self.__MPU6050_RA_GYRO_CONFIG, 0x00)
         time.sleep(0.1)
 
         #-------------------------------------------------------------------------------------------
@@ -379,7 +785,7 @@ class MPU6050 :
         # 0x07 = 460Hz
         #-------------------------------------------------------------------------------------------
         logger.debug('configurable DLPF to filter out non-gravitational acceleration for Euler')
-        self.i2c.write8(self.__MPU9250_RA_ACCEL_CFG_2, alpf)
+        self.writeRegister(self.__MPU9250_RA_ACCEL_CFG_2, alpf)
         time.sleep(0.1)
 
         #-------------------------------------------------------------------------------------------
@@ -393,56 +799,234 @@ class MPU6050 :
         #-------------------------------------------------------------------------------------------
         # int(math.log(g / 2, 2)) << 3
         logger.debug('Accel +/- 2g')
-        self.i2c.write8(self.__MPU6050_RA_ACCEL_CONFIG, 0x00)
+        self.writeRegister(self.__MPU6050_RA_ACCEL_CONFIG, 0x00)
         time.sleep(0.1)
 
         #-------------------------------------------------------------------------------------------
         # Setup INT pin to push / pull,  pulse.
         #-------------------------------------------------------------------------------------------
         logger.debug('Enable interrupt')
-        self.i2c.write8(self.__MPU6050_RA_INT_PIN_CFG, 0x10)
+        self.writeRegister(self.__MPU6050_RA_INT_PIN_CFG, 0x10)
         time.sleep(0.1)
 
         #-------------------------------------------------------------------------------------------
         # Enable data ready interrupt
         #-------------------------------------------------------------------------------------------
         logger.debug('Interrupt data ready')
-        self.i2c.write8(self.__MPU6050_RA_INT_ENABLE, 0x01)
+        self.writeRegister(self.__MPU6050_RA_INT_ENABLE, 0x01)
         time.sleep(0.1)
 
+        #-------------------------------------------------------------------------------------------
+        # Read back the configuration in one go.
+        #-------------------------------------------------------------------------------------------
+        self.verifyRegisters()
+
+    #-----------------------------------------------------------------------------------------------
+    # Write a configuration register unless the shadow says it already holds the value.  The write
+    # is checked later by verifyRegisters().
+    #-----------------------------------------------------------------------------------------------
+    def writeRegister(self, reg, value):
+        if self.registers.get(reg) == value:
+            self.skipped_writes += 1
+            return
+
+        self.i2c.write8(reg, value)
+        self.registers[reg] = value
+        self.unverified.add(reg)
+
+    #-----------------------------------------------------------------------------------------------
+    # Read back the registers written since the last check, one block read per contiguous run of
+    # registers.  Any mismatch is logged and the shadow corrected so a rewrite isn't skipped.
+    # Returns the number of mismatches.
+    #-----------------------------------------------------------------------------------------------
+    def verifyRegisters(self):
+        mismatches = 0
+        regs = sorted(self.unverified)
+        self.unverified = set()
+
+        while regs:
+            start = regs[0]
+            length = 1
+            while length < len(regs) and regs[length] == start + length:
+                length += 1
+
+            values = self.i2c.readList(start, length)
+            for index in range(0, length):
+                reg = start + index
+                if values[index] != self.registers[reg]:
+                    logger.critical("mpu6050 register 0x%02x wrote 0x%02x read 0x%02x", reg, self.registers[reg], values[index])
+                    self.registers[reg] = values[index]
+                    mismatches += 1
+
+            regs = regs[length:]
+
+        return mismatches
+
+    #-----------------------------------------------------------------------------------------------
+    # Runtime configuration API.  These only queue the register writes; readSensors() applies them
+    # between samples.
+    #-----------------------------------------------------------------------------------------------
+    def setDLPF(self, glpf = None, alpf = None):
+        for lpf in (glpf, alpf):
+            if lpf is not None and not 0 <= lpf <= 7:
+                raise ValueError("DLPF setting %d not in 0 - 7" % lpf)
+
+        if glpf is not None:
+            self.queueWrite(self.__MPU6050_RA_CONFIG, glpf)
+        if alpf is not None:
+            self.queueWrite(self.__MPU9250_RA_ACCEL_CFG_2, alpf)
+
+    def setSampleRateDivider(self, divider):
+        if not 0 <= divider <= 255:
+            raise ValueError("sample rate divider %d not in 0 - 255" % divider)
+        self.queueWrite(self.__MPU6050_RA_SMPLRT_DIV, divider)
+
+    def setGyroRange(self, degrees):
+        if degrees not in self.GYRO_RANGES:
+            raise ValueError("gyro range %s not one of %s" % (degrees, self.GYRO_RANGES))
+        self.queueWrite(self.__MPU6050_RA_GYRO_CONFIG, self.GYRO_RANGES.index(degrees) << 3)
+
+    def setAccelRange(self, g):
+        if g not in self.ACCEL_RANGES:
+            raise ValueError("accel range %s not one of %s" % (g, self.ACCEL_RANGES))
+        self.queueWrite(self.__MPU6050_RA_ACCEL_CONFIG, self.ACCEL_RANGES.index(g) << 3)
+
+    def queueWrite(self, reg, value):
+        with self.pending_lock:
+            self.pending_writes[reg] = value
+
+    #-----------------------------------------------------------------------------------------------
+    # Apply the queued configuration changes, called from readSensors() between samples.  The
+    # next sample may have been taken with the old configuration so it's discarded; the range
+    # factors change in the same step so data and scale always match.
+    #-----------------------------------------------------------------------------------------------
+    def applyConfig(self):
+        with self.pending_lock:
+            pending_writes = self.pending_writes
+            self.pending_writes = {}
+
+        for reg in sorted(pending_writes):
+            self.writeRegister(reg, pending_writes[reg])
+
+        if self.verifyRegisters():
+            logger.critical("mpu6050 runtime configuration not as requested")
+
+        gyro_factor = 1 << ((self.registers.get(self.__MPU6050_RA_GYRO_CONFIG, 0) >> 3) & 0x03)
+        accel_factor = 1 << ((self.registers.get(self.__MPU6050_RA_ACCEL_CONFIG, 0) >> 3) & 0x03)
+        self.range_factors = (accel_factor, accel_factor, accel_factor, 1, gyro_factor, gyro_factor, gyro_factor)
+        self.discard_sample = True
+
+    #-----------------------------------------------------------------------------------------------
+    # Slave an HMC5883L magnetometer to the MPU6050's auxiliary i2c master so its data arrives in
+    # EXT_SENS_DATA_00-05, straight after the gyro registers, and so in the same burst read with
+    # no extra bus transaction per sample.  The HMC5883L is set up through the i2c bypass first:
+    # 75Hz continuous measurement at +/- 1.3 gauss.  The master then reads it every 1 + MAG_DELAY
+    # samples, and holds off the data ready interrupt until it has.  Returns whether it's there.
+    #-----------------------------------------------------------------------------------------------
+    def enableMagnetometer(self, address = 0x1E):
+        logger.debug('Magnetometer bypass')
+        self.writeRegister(self.__MPU6050_RA_USER_CTRL, 0x00)
+        self.writeRegister(self.__MPU6050_RA_INT_PIN_CFG, 0x12)
+        time.sleep(0.01)
+
+        hmc5883l = I2C(address, self.i2c.bus)
+        try:
+            if hmc5883l.readList(self.__HMC5883L_RA_ID_A, 3) != self.__HMC5883L_ID:
+                raise I2CError("not an HMC5883L")
+
+            hmc5883l.write8(self.__HMC5883L_RA_CONFIG_A, 0x18)
+            hmc5883l.write8(self.__HMC5883L_RA_CONFIG_B, 0x20)
+            hmc5883l.write8(self.__HMC5883L_RA_MODE, 0x00)
+
+        except IOError as err:
+            logger.critical("No magnetometer at 0x%02x: %s", address, err)
+            self.writeRegister(self.__MPU6050_RA_INT_PIN_CFG, 0x10)
+            self.verifyRegisters()
+            return False
+
+        logger.debug('Magnetometer via i2c master')
+        self.writeRegister(self.__MPU6050_RA_INT_PIN_CFG, 0x10)
+        self.writeRegister(self.__MPU6050_RA_I2C_MST_CTRL, 0x4D)
+        self.writeRegister(self.__MPU6050_RA_I2C_SLV0_ADDR, 0x80 | address)
+        self.writeRegister(self.__MPU6050_RA_I2C_SLV0_REG, self.__HMC5883L_RA_DATA_X_H)
+        self.writeRegister(self.__MPU6050_RA_I2C_SLV0_CTRL, 0x86)
+        self.writeRegister(self.__MPU6050_RA_I2C_SLV4_CTRL, self.__MAG_DELAY)
+        self.writeRegister(self.__MPU6050_RA_I2C_MST_DELAY_CTRL, 0x01)
+        self.writeRegister(self.__MPU6050_RA_USER_CTRL, 0x20)
+        time.sleep(0.01)
+
+        if self.verifyRegisters():
+            logger.critical("mpu6050 i2c master configuration not as requested")
+            return False
+
+        self.burst_length = 20
+        return True
+
+    def waitDataReady(self):
+        if self.data_ready is not None and not self.data_ready.wait():
+            raise DataReadyTimeout("mpu6050 data ready timeout")
+
     def readSensors(self):
         global temp_now
 
         #-------------------------------------------------------------------------------------------
-        # For the sake of always getting good date wrap the interrupt and the register read in a try
-        # except loop.
+        # The i2c read retries are bounded, so if they're exhausted, count the miss and hold the last
+        # good data; the flight loop watches the i2c breaker for a bus that's failed completely.
         #-------------------------------------------------------------------------------------------
-        while True:
-            try:
-                #-------------------------------------------------------------------------------------------
-                # Wait for the data ready interrupt
-                #-------------------------------------------------------------------------------------------
-                RPIO.edge_detect_wait(RPIO_DATA_READY_INTERRUPT)
-
-                #-------------------------------------------------------------------------------------------
-                # For speed of reading, read all the sensors and parse to SHORTs after.  This also
-                # ensures a self consistent set of sensor data compared to reading each individually
-                # where the sensor data registers could be updated between reads.
-                #-------------------------------------------------------------------------------------------
-                sensor_data = self.i2c.readList(self.__MPU6050_RA_ACCEL_XOUT_H, 14)
-                break
-            except IOError, err:
-                self.misses += 1
-                pass
+        if self.pending_writes:
+            self.applyConfig()
+
+        try:
+            #---------------------------------------------------------------------------------------
+            # Wait for the data ready interrupt; a timeout is a miss like an i2c failure.
+            #---------------------------------------------------------------------------------------
+            self.waitDataReady()
+
+            #---------------------------------------------------------------------------------------
+            # For speed of reading, read all the sensors and parse to SHORTs after.  This also
+            # ensures a self consistent set of sensor data compared to reading each individually
+            # where the sensor data registers could be updated between reads.
+            #---------------------------------------------------------------------------------------
+            sensor_data = self.i2c.readList(self.__MPU6050_RA_ACCEL_XOUT_H, self.burst_length)
+            if self.capture is not None:
+                self.capture.record(sensor_data)
+
+            if self.discard_sample:
+                self.discard_sample = False
+            else:
+                range_factors = self.range_factors
+                for index in range(0, 14, 2):
+                    if (sensor_data[index] > 127):
+                        sensor_data[index] -= 256
+                    self.result_array[int(index / 2)] = ((sensor_data[index] << 8) + sensor_data[index + 1]) * range_factors[int(index / 2)]
 
-        for index in range(0, 14, 2):
-            if (sensor_data[index] > 127):
-                sensor_data[index] -= 256
-            self.result_array[int(index / 2)] = (sensor_data[index] << 8) + sensor_data[index + 1]
+                #-----------------------------------------------------------------------------------
+                # The magnetometer's x, z, y, unless it's overflowed, in which case the last good
+                # data stands.
+                #-----------------------------------------------------------------------------------
+                if self.burst_length > 14:
+                    for index in range(14, 20, 2):
+                        if (sensor_data[index] > 127):
+                            sensor_data[index] -= 256
+                    mx = (sensor_data[14] << 8) + sensor_data[15]
+                    mz = (sensor_data[16] << 8) + sensor_data[17]
+                    my = (sensor_data[18] << 8) + sensor_data[19]
+                    overflow = self.__HMC5883L_OVERFLOW
+                    if mx == overflow or my == overflow or mz == overflow:
+                        self.mag_overflows += 1
+                    else:
+                        mag_array = self.mag_array
+                        mag_array[0] = mx
+                        mag_array[1] = my
+                        mag_array[2] = mz
+
+        except IOError as err:
+            self.misses += 1
 
         #-------------------------------------------------------------------------------------------
         # +/- 2g * 16 bit range for the accelerometer
         # +/- 250 degrees per second * 16 bit range for the gyroscope
+        # whatever the configured ranges, as per range_factors.
         #-------------------------------------------------------------------------------------------
         [ax, ay, az, temp_now, gx, gy, gz] = self.result_array
 
@@ -458,9 +1042,10 @@ class MPU6050 :
         qay = (ay - ay_offset) * self.__SCALE_ACCEL
         qaz = (az - az_offset) * self.__SCALE_ACCEL
 
-        qrx = (gx - self.gx_offset) * self.__SCALE_GYRO
-        qry = (gy - self.gy_offset) * self.__SCALE_GYRO
-        qrz = (gz - self.gz_offset) * self.__SCALE_GYRO
+        gyro_drift = temp_now - self.gyro_temp
+        qrx = (gx - self.gx_offset - self.gbx * gyro_drift) * self.__SCALE_GYRO
+        qry = (gy - self.gy_offset - self.gby * gyro_drift) * self.__SCALE_GYRO
+        qrz = (gz - self.gz_offset - self.gbz * gyro_drift) * self.__SCALE_GYRO
 
         return qax, qay, qaz, qrx, qry, qrz
 
@@ -469,6 +1054,7 @@ class MPU6050 :
         gx_offset = 0.0
         gy_offset = 0.0
         gz_offset = 0.0
+        gyro_temp = 0.0
 
         for iteration in range(0, self.__CALIBRATION_ITERATIONS):
             [ax, ay, az, gx, gy, gz] = self.readSensors()
@@ -476,10 +1062,12 @@ class MPU6050 :
             gx_offset += gx
             gy_offset += gy
             gz_offset += gz
+            gyro_temp += temp_now
 
         self.gx_offset = gx_offset / self.__CALIBRATION_ITERATIONS
         self.gy_offset = gy_offset / self.__CALIBRATION_ITERATIONS
         self.gz_offset = gz_offset / self.__CALIBRATION_ITERATIONS
+        self.gyro_temp = gyro_temp / self.__CALIBRATION_ITERATIONS
 
     def calibrateGravity(self, file_name):
         gravity_x = 0.0
@@ -509,12 +1097,71 @@ class MPU6050 :
                 cfg_file.write('%f\n' % gravity_z)
                 cfg_file.flush()
 
-        except IOError, err:
+        except IOError as err:
             logger.critical('Could not open offset config file: %s for writing', file_name)
             cfg_rc = False
 
         return cfg_rc
 
+    def setTemperatureModel(self, model):
+        #-------------------------------------------------------------------------------------------
+        # Use a temperature model's 0g offsets in place of the two-point ones above, and its gyro
+        # drift; the gyro offsets themselves are still measured afresh by calibrateGyros().
+        #-------------------------------------------------------------------------------------------
+        self.ax, self.ay, self.az = model.intercepts()[0:3]
+        self.bx, self.by, self.bz, self.gbx, self.gby, self.gbz = model.slopes
+
+    def getTemperatureModel(self):
+        #-------------------------------------------------------------------------------------------
+        # The temperature model currently in use, as the starting point for calibrateTemperature()
+        #-------------------------------------------------------------------------------------------
+        return TemperatureModel((self.ax, self.ay, self.az,
+                                 self.gx_offset - self.gbx * self.gyro_temp,
+                                 self.gy_offset - self.gby * self.gyro_temp,
+                                 self.gz_offset - self.gbz * self.gyro_temp),
+                                (self.bx, self.by, self.bz, self.gbx, self.gby, self.gbz))
+
+    def calibrateTemperature(self, model, ax, ay, az, gx, gy, gz):
+        #-------------------------------------------------------------------------------------------
+        # Update the temperature model from (averaged) raw readings taken sitting level and still:
+        # the 0g offsets are the accelerometer readings less 1g on the Z axis, and the gyro offsets
+        # are the gyro readings.
+        #-------------------------------------------------------------------------------------------
+        model.update(temp_now, (ax, ay, az - 1.0 / self.__SCALE_ACCEL, gx, gy, gz))
+
+    def adjustGyroOffsets(self, bias):
+        #-------------------------------------------------------------------------------------------
+        # Fold a gyro bias in radians per second, as tracked by GyroBiasTracker, into the offsets
+        #-------------------------------------------------------------------------------------------
+        self.gx_offset += bias[0] / self.__SCALE_GYRO
+        self.gy_offset += bias[1] / self.__SCALE_GYRO
+        self.gz_offset += bias[2] / self.__SCALE_GYRO
+
+    def saveGyroOffsets(self, file_name):
+        try:
+            with open(file_name, 'w') as offsets_file:
+                offsets_file.write('%f, %f, %f, %f\n' % (self.gx_offset, self.gy_offset, self.gz_offset, self.gyro_temp))
+
+        except IOError as err:
+            logger.critical('Could not open gyro offsets file: %s for writing', file_name)
+            return False
+
+        return True
+
+    def loadGyroOffsets(self, file_name):
+        #-------------------------------------------------------------------------------------------
+        # The gyro offsets and their temperature saved by the last flight in place of
+        # calibrateGyros(), returning whether there were any.
+        #-------------------------------------------------------------------------------------------
+        try:
+            with open(file_name, 'r') as offsets_file:
+                self.gx_offset, self.gy_offset, self.gz_offset, self.gyro_temp = [float(field) for field in offsets_file.readline().split(',')]
+
+        except (IOError, ValueError) as err:
+            return False
+
+        return True
+
     def getMisses(self):
         i2c_misses = self.i2c.getMisses()
         return self.misses, i2c_misses
@@ -523,219 +1170,1127 @@ class MPU6050 :
 
 ####################################################################################################
 #
-# PID algorithm to take input sensor readings, and target requirements, and output an arbirtrary
-# corrective value.
+# Per-axis temperature model of the MPU6050 offsets, offset = intercept + slope * temperature for
+# the 3 accelerometer 0g offsets and the 3 gyro offsets, with the temperature in the raw units of
+# the temperature register.  It's fitted by recursive least squares, one update per (decimated)
+# sample at a fixed cost of a few multiplies per axis, so it can run inside the warm-up loop as the
+# IMU warms up, and saved to / loaded from a CSV file with one line per axis.
+#
+# Each axis keeps its estimate as the offset at a reference temperature (the first sample's) and
+# the slope, with the 2x2 covariance of the estimate, which keeps the sums well conditioned with
+# temperatures in the thousands.  The estimate starts from the model in use and the covariance
+# from the variances given, so with little temperature change the slope stays near what it was.
+# A forgetting factor under 1 weights recent samples more.
 #
 ####################################################################################################
-class PID:
-
-    def __init__(self, p_gain, i_gain, d_gain):
-        self.last_error = 0.0
-        self.p_gain = p_gain
-        self.i_gain = i_gain
-        self.d_gain = d_gain
-        self.i_error = 0.0
+TEMPERATURE_MODEL_FILE = "qctempmodel.csv"
+
+class TemperatureModel(object):
+
+    AXES = ("ax", "ay", "az", "gx", "gy", "gz")
+
+    def __init__(self, intercepts, slopes, intercept_variance = 1.0e6, slope_variance = 1.0, forgetting = 1.0):
+        self.slopes = list(slopes)
+        self.levels = list(intercepts)
+        self.reference = 0.0
+        self.p00 = [intercept_variance] * 6
+        self.p01 = [0.0] * 6
+        self.p11 = [slope_variance] * 6
+        self.forgetting = forgetting
+        self.samples = 0
+        self.min_temp = 0
+        self.max_temp = 0
+
+    def intercepts(self):
+        return [level - slope * self.reference for level, slope in zip(self.levels, self.slopes)]
+
+    def update(self, temperature, offsets):
+        #-------------------------------------------------------------------------------------------
+        # The first sample sets the reference temperature, moving each estimate's offset to it.
+        #-------------------------------------------------------------------------------------------
+        if self.samples == 0:
+            for axis in range(0, 6):
+                self.levels[axis] += self.slopes[axis] * temperature
+            self.reference = temperature
+            self.min_temp = temperature
+            self.max_temp = temperature
+
+        self.samples += 1
+        self.min_temp = min(self.min_temp, temperature)
+        self.max_temp = max(self.max_temp, temperature)
+
+        #-------------------------------------------------------------------------------------------
+        # With regressor [1, t] for t the temperature less the reference:
+        # gain k = P [1, t] / (forgetting + [1, t] P [1, t])
+        # estimate += k * (offset - [1, t] . estimate)
+        # P = (P - k [1, t] P) / forgetting
+        #-------------------------------------------------------------------------------------------
+        t = temperature - self.reference
+        forgetting = self.forgetting
+        levels = self.levels
+        slopes = self.slopes
+        p00 = self.p00
+        p01 = self.p01
+        p11 = self.p11
+        for axis in range(0, 6):
+            pt0 = p00[axis] + p01[axis] * t
+            pt1 = p01[axis] + p11[axis] * t
+            denominator = forgetting + pt0 + pt1 * t
+            k0 = pt0 / denominator
+            k1 = pt1 / denominator
+
+            error = offsets[axis] - levels[axis] - slopes[axis] * t
+            levels[axis] += k0 * error
+            slopes[axis] += k1 * error
+
+            p00[axis] = (p00[axis] - k0 * pt0) / forgetting
+            p01[axis] = (p01[axis] - k0 * pt1) / forgetting
+            p11[axis] = (p11[axis] - k1 * pt1) / forgetting
+
+    def save(self, file_name):
+        try:
+            with open(file_name, 'w') as model_file:
+                for name, intercept, slope in zip(self.AXES, self.intercepts(), self.slopes):
+                    model_file.write('%s, %f, %f, %d, %d, %d\n' % (name, intercept, slope, self.samples, self.min_temp, self.max_temp))
 
+        except IOError as err:
+            logger.critical('Could not open temperature model file: %s for writing', file_name)
+            return False
 
-    def Compute(self, input, target, dt):
-        #-------------------------------------------------------------------------------------------
-        # Error is what the PID alogithm acts upon to derive the output
-        #-------------------------------------------------------------------------------------------
-        error = target - input
+        return True
 
+    @classmethod
+    def load(cls, file_name):
         #-------------------------------------------------------------------------------------------
-        # The proportional term takes the distance between current input and target
-        # and uses this proportially (based on Kp) to control the ESC pulse width
+        # The model saved in the file, or None if there isn't one
         #-------------------------------------------------------------------------------------------
-        p_error = error
+        try:
+            with open(file_name, 'r') as model_file:
+                fields = dict((line.split(',')[0].strip(), line.split(',')[1:3]) for line in model_file if line.strip())
 
-        #-------------------------------------------------------------------------------------------
-        # The integral term sums the errors across many compute calls to allow for
-        # external factors like wind speed and friction
-        #-------------------------------------------------------------------------------------------
-        self.i_error += (error + self.last_error) * dt
-        i_error = self.i_error
+        except IOError as err:
+            return None
 
-        #-------------------------------------------------------------------------------------------
-        # The differential term accounts for the fact that as error approaches 0,
-        # the output needs to be reduced proportionally to ensure factors such as
-        # momentum do not cause overshoot.
-        #-------------------------------------------------------------------------------------------
-        d_error = (error - self.last_error) / dt
+        try:
+            return cls([float(fields[name][0]) for name in cls.AXES], [float(fields[name][1]) for name in cls.AXES])
 
-        #-------------------------------------------------------------------------------------------
-        # The overall output is the sum of the (P)roportional, (I)ntegral and (D)iffertial terms
-        #-------------------------------------------------------------------------------------------
-        p_output = self.p_gain * p_error
-        i_output = self.i_gain * i_error
-        d_output = self.d_gain * d_error
+        except (KeyError, IndexError, ValueError) as err:
+            logger.critical('Ignoring temperature model file: %s, it is corrupt', file_name)
+            return None
 
-        #-------------------------------------------------------------------------------------------
-        # Store off last error for integral and differential processing next time.
-        #-------------------------------------------------------------------------------------------
-        self.last_error = error
+    def report(self):
+        for name, intercept, slope in zip(self.AXES, self.intercepts(), self.slopes):
+            logger.critical("%s offset = %f + %f * temperature", name, intercept, slope)
+        logger.critical("temperature model: %d samples, %f to %foC",
+                        self.samples, self.min_temp / 333.87 + 21.0, self.max_temp / 333.87 + 21.0)
 
-        #-------------------------------------------------------------------------------------------
-        # Return the output, which has been tuned to be the increment / decrement in ESC PWM
-        #-------------------------------------------------------------------------------------------
-        return p_output, i_output, d_output
 
 ####################################################################################################
 #
-#  Class for managing each blade + motor configuration via its ESC
+# Gyro bias tracking: the gyro offsets measured before flight drift with temperature during it,
+# and any residual bias integrates straight into the yaw angle and the rate PIDs.  The tracker
+# holds the residual bias in radians per second, subtracted from the scaled gyro readings, and
+# refines it whenever the quad is still or nearly so: the accelerometer reads 1g to within
+# accel_threshold and the corrected rates are all within rate_threshold, continuously for
+# still_time.  Those checks are on the readings low pass filtered with time constant 'smoothing'
+# so sensor noise doesn't break up the still periods.  The bias then moves towards the rates with
+# time_constant, so noise and any slow rotation it can't tell from bias are smoothed out.  Still
+# periods are sitting on the ground before take-off, and steady hover in flight.  The bias is
+# logged every log_period.
 #
 ####################################################################################################
-class ESC:
+GYRO_OFFSETS_FILE = "qcgyrooffsets.csv"
+
+class GyroBiasTracker(object):
+
+    def __init__(self, accel_threshold = 0.02, rate_threshold = 0.01, still_time = 1.0, smoothing = 0.2, time_constant = 5.0, log_period = 10.0):
+        self.accel_threshold = accel_threshold
+        self.rate_threshold = rate_threshold
+        self.still_time = still_time
+        self.smoothing = smoothing
+        self.time_constant = time_constant
+        self.log_period = log_period
+
+        self.bias = [0.0, 0.0, 0.0]
+        self.accel_error = 0.0
+        self.rates = [0.0, 0.0, 0.0]
+        self.still_for = 0.0
+        self.elapsed_time = 0.0
+        self.tracking_time = 0.0
+        self.next_log_time = 0.0
+        self.max_bias = 0.0
 
-    def __init__(self, pin, location, rotation, name):
+    def update(self, qax, qay, qaz, qrx, qry, qrz, dt):
         #-------------------------------------------------------------------------------------------
-        # The GPIO BCM numbered pin providing PWM signal for this ESC
+        # Called with averaged accelerometer readings in g's and bias corrected gyro rates, e.g. at
+        # the attitude task rate.  Returns whether the quad is still enough to track the bias.
         #-------------------------------------------------------------------------------------------
-        self.bcm_pin = pin
+        self.elapsed_time += dt
+        rate_threshold = self.rate_threshold
+        rates = self.rates
 
-        #-------------------------------------------------------------------------------------------
-        # Physical parameters of the ESC / motors / propellers
-        #-------------------------------------------------------------------------------------------
-        self.motor_location = location
-        self.motor_rotation = rotation
+        smoothing = dt / (self.smoothing + dt)
+        self.accel_error += smoothing * (math.sqrt(qax * qax + qay * qay + qaz * qaz) - 1.0 - self.accel_error)
+        rates[0] += smoothing * (qrx - rates[0])
+        rates[1] += smoothing * (qry - rates[1])
+        rates[2] += smoothing * (qrz - rates[2])
 
-        #-------------------------------------------------------------------------------------------
-        # Initialize the RPIO DMa PWM for this ESC in microseconds - 1ms - 2ms of
-        # pulse widths with 3ms carrier.
-        #-------------------------------------------------------------------------------------------
-        self.min_pulse_width = 1000
-        self.max_pulse_width = 2000
+        if (abs(self.accel_error) < self.accel_threshold and
+            abs(rates[0]) < rate_threshold and abs(rates[1]) < rate_threshold and abs(rates[2]) < rate_threshold):
+            self.still_for += dt
+        else:
+            self.still_for = 0.0
+
+        tracking = self.still_for >= self.still_time
+        if tracking:
+            gain = dt / (self.time_constant + dt)
+            bias = self.bias
+            bias[0] += gain * qrx
+            bias[1] += gain * qry
+            bias[2] += gain * qrz
+            self.tracking_time += dt
+            self.max_bias = max(self.max_bias, abs(bias[0]), abs(bias[1]), abs(bias[2]))
+
+        if self.elapsed_time >= self.next_log_time:
+            self.next_log_time += self.log_period
+            logger.warning("gyro bias at %fs: %f, %f, %f degrees/s, %s", self.elapsed_time,
+                           math.degrees(self.bias[0]), math.degrees(self.bias[1]), math.degrees(self.bias[2]), "tracking" if tracking else "not still")
+
+        return tracking
+
+    def report(self):
+        logger.critical("gyro bias %f, %f, %f degrees/s (largest %f), tracked for %fs of %fs",
+                        math.degrees(self.bias[0]), math.degrees(self.bias[1]), math.degrees(self.bias[2]),
+                        math.degrees(self.max_bias), self.tracking_time, self.elapsed_time)
+
+
+####################################################################################################
+#
+# Magnetometer heading correction for the yaw angle, which otherwise is only ever the integrated
+# gyro rate and so drifts without bound.  The magnetometer data is whatever the MPU6050's burst
+# read last picked up (MPU6050.enableMagnetometer()), less the hard iron 'offsets' in raw units.
+# The field is levelled with the pitch and roll angles (tilt compensation) to get the heading, and
+# the yaw angle is pulled towards it with time constant 'tau'.  Yaw stays relative to the heading at
+# the first reading after reset(), whose field strength is kept as the reference; a reading more
+# than 'tolerance' from that, e.g. distorted by the motor currents, is rejected.
+#
+####################################################################################################
+COMPASS_TAU = 2.0
+COMPASS_TOLERANCE = 0.25
+
+class Compass(object):
 
+    def __init__(self, mpu6050, tau = COMPASS_TAU, tolerance = COMPASS_TOLERANCE, offsets = (0.0, 0.0, 0.0)):
+        self.mpu6050 = mpu6050
+        self.mag_array = mpu6050.mag_array
+        self.tau = tau
+        self.tolerance = tolerance
+        self.offsets = offsets
+
+        self.reference = None
+        self.field = 0.0
+        self.corrections = 0
+        self.rejections = 0
+        self.max_error = 0.0
+
+    def reset(self):
+        self.reference = None
+
+    def correct(self, pa, ra, ya, dt):
         #-------------------------------------------------------------------------------------------
-        # The PWM pulse range required by this ESC
+        # Called with the latest angles e.g. at the attitude task rate, returning the corrected yaw.
         #-------------------------------------------------------------------------------------------
-        self.pulse_width = self.min_pulse_width
+        mag_array = self.mag_array
+        offsets = self.offsets
+        mx = mag_array[0] - offsets[0]
+        my = mag_array[1] - offsets[1]
+        mz = mag_array[2] - offsets[2]
+        field = math.sqrt(mx * mx + my * my + mz * mz)
 
         #-------------------------------------------------------------------------------------------
-        # Name - for logging purposes only
+        # Level the field into the earth frame bar yaw; what yaw there is then turns it about the
+        # z axis, as per RotateE2Q().
         #-------------------------------------------------------------------------------------------
-        self.name = name
+        emx, emy, emz = RotateQ2E(mx, my, mz, pa, ra, 0.0)
+        heading = -math.atan2(emy, emx)
+
+        if self.reference is None:
+            if field > 0.0:
+                self.reference = heading - ya
+                self.field = field
+            return ya
+
+        if abs(field - self.field) > self.tolerance * self.field:
+            self.rejections += 1
+            return ya
 
         #-------------------------------------------------------------------------------------------
-        # Initialize the RPIO DMA PWM for this ESC.
+        # The error is wrapped into +/- pi so the gyro yaw can carry on unwrapped.
         #-------------------------------------------------------------------------------------------
-        PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.pulse_width)
+        error = (heading - self.reference - ya + math.pi) % (2 * math.pi) - math.pi
+        self.corrections += 1
+        self.max_error = max(self.max_error, abs(error))
+        return ya + error * dt / (self.tau + dt)
 
+    def report(self):
+        logger.critical("compass: %d corrections (largest error %f degrees), %d readings rejected, %d overflowed",
+                        self.corrections, math.degrees(self.max_error), self.rejections, self.mpu6050.mag_overflows)
 
-    def update(self, spin_rate):
-        self.pulse_width = int(self.min_pulse_width + spin_rate)
 
-        if self.pulse_width < self.min_pulse_width:
-            self.pulse_width = self.min_pulse_width
-        if self.pulse_width > self.max_pulse_width:
-            self.pulse_width = self.max_pulse_width
+####################################################################################################
+#
+# Raw IMU capture: every sample as read from the MPU6050, before the averaging loses it, written to
+# a memory mapped file in /dev/shm and moved to disk at shutdown.  The file's preallocated (and
+# prefaulted, so the flight takes no page faults for it) for 'capacity' samples and used as a ring,
+# so it holds the whole flight if it's big enough or else the latest part of it.  Each sample is
+# packed straight into the map, so no memory is allocated per sample beyond the time stamp.  The
+# flight loop sets 'throttle' to the mean motor spin each motion loop, so the samples can be
+# matched to it for vibration analysis (qcspectrum.py).
+#
+# The file is a header then 'capacity' records, all little endian bar the sensor data:
+#
+# header: 8s magic "QCIMU001", I version, I record size, Q capacity, Q samples written,
+#         d start time, I accelerometer range factor, I gyro range factor
+# record: d time stamp, 7 x big endian int16 raw accel x, y, z, temperature, gyro x, y, z
+#         (as per the MPU6050 registers, at the configured range), H throttle
+#
+# The record for sample n is at header size + (n % capacity) * record size; the samples written
+# count is updated after each record, so it's always consistent with the records.
+#
+####################################################################################################
+IMU_CAPTURE_FILE = "/dev/shm/qcimu"
 
-        PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.pulse_width)
+class ImuCapture(object):
+
+    MAGIC = b"QCIMU001"
+    VERSION = 2
+    HEADER = struct.Struct("<8sIIQQdII")
+    COUNT = struct.Struct("<Q")
+    COUNT_OFFSET = 24
+    RECORD = struct.Struct("<d14BH")
+
+    def __init__(self, file_name, capacity, accel_factor = 1, gyro_factor = 1):
+        import mmap
+
+        self.file_name = file_name
+        self.capacity = capacity
+        self.count = 0
+        self.throttle = 0
+
+        size = self.HEADER.size + capacity * self.RECORD.size
+        fd = os.open(file_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        #-------------------------------------------------------------------------------------------
+        # Touch every page now rather than in flight
+        #-------------------------------------------------------------------------------------------
+        page = b"\0" * mmap.PAGESIZE
+        for offset in range(0, size, mmap.PAGESIZE):
+            self.map[offset:min(offset + mmap.PAGESIZE, size)] = page[0:min(mmap.PAGESIZE, size - offset)]
+
+        self.HEADER.pack_into(self.map, 0, self.MAGIC, self.VERSION, self.RECORD.size, capacity, 0, time.time(), accel_factor, gyro_factor)
+        self.start_offset = self.HEADER.size
+        self.end_offset = size
+        self.offset = self.start_offset
+
+    def record(self, data):
+        self.RECORD.pack_into(self.map, self.offset, time.time(),
+                              data[0], data[1], data[2], data[3], data[4], data[5], data[6],
+                              data[7], data[8], data[9], data[10], data[11], data[12], data[13], self.throttle)
+        self.count += 1
+        self.COUNT.pack_into(self.map, self.COUNT_OFFSET, self.count)
+
+        self.offset += self.RECORD.size
+        if self.offset == self.end_offset:
+            self.offset = self.start_offset
 
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+
+    def report(self):
+        logger.critical("imu capture: %d samples, %d kept in %s", self.count, min(self.count, self.capacity), self.file_name)
 
 
 ####################################################################################################
 #
-# Angles required to convert between Earth (interal reference frame) and Quadcopter (body # reference
-# frame).
+# PID algorithm to take input sensor readings, and target requirements, and output an arbirtrary
+# corrective value.
 #
-# This is used for reorientating gravity into the quad frame to calculated quad frame velocities
+####################################################################################################
+class PID(object):
+
+    #-----------------------------------------------------------------------------------------------
+    # Slots keep the per-loop attribute lookups cheap, and hold the last P, I and D terms so they
+    # can be read when (and only when) they're needed.
+    #-----------------------------------------------------------------------------------------------
+    __slots__ = ('last_error', 'p_gain', 'i_gain', 'd_gain', 'i_error', 'p_out', 'i_out', 'd_out')
+
+    def __init__(self, p_gain, i_gain, d_gain):
+        self.last_error = 0.0
+        self.p_gain = p_gain
+        self.i_gain = i_gain
+        self.d_gain = d_gain
+        self.i_error = 0.0
+
+        self.p_out = 0.0
+        self.i_out = 0.0
+        self.d_out = 0.0
+
+
+    def reset(self):
+        #-------------------------------------------------------------------------------------------
+        # Start afresh, keeping the gains
+        #-------------------------------------------------------------------------------------------
+        self.last_error = 0.0
+        self.i_error = 0.0
+        self.p_out = 0.0
+        self.i_out = 0.0
+        self.d_out = 0.0
+
+
+    def Compute(self, input, target, dt):
+        #-------------------------------------------------------------------------------------------
+        # Error is what the PID alogithm acts upon to derive the output
+        #-------------------------------------------------------------------------------------------
+        error = target - input
+
+        #-------------------------------------------------------------------------------------------
+        # The proportional term takes the distance between current input and target
+        # and uses this proportially (based on Kp) to control the ESC pulse width
+        #-------------------------------------------------------------------------------------------
+        p_error = error
+
+        #-------------------------------------------------------------------------------------------
+        # The integral term sums the errors across many compute calls to allow for
+        # external factors like wind speed and friction
+        #-------------------------------------------------------------------------------------------
+        self.i_error += (error + self.last_error) * dt
+        i_error = self.i_error
+
+        #-------------------------------------------------------------------------------------------
+        # The differential term accounts for the fact that as error approaches 0,
+        # the output needs to be reduced proportionally to ensure factors such as
+        # momentum do not cause overshoot.
+        #-------------------------------------------------------------------------------------------
+        d_error = (error - self.last_error) / dt
+
+        #-------------------------------------------------------------------------------------------
+        # The overall output is the sum of the (P)roportional, (I)ntegral and (D)iffertial terms
+        #-------------------------------------------------------------------------------------------
+        p_output = self.p_gain * p_error
+        i_output = self.i_gain * i_error
+        d_output = self.d_gain * d_error
+
+        #-------------------------------------------------------------------------------------------
+        # Store off last error for integral and differential processing next time, and the terms
+        # for diagnostics.
+        #-------------------------------------------------------------------------------------------
+        self.last_error = error
+        self.p_out = p_output
+        self.i_out = i_output
+        self.d_out = d_output
+
+        #-------------------------------------------------------------------------------------------
+        # Return the output, which has been tuned to be the increment / decrement in ESC PWM; the
+        # terms are read from the slots above when they're wanted.
+        #-------------------------------------------------------------------------------------------
+        return p_output + i_output + d_output
+
+####################################################################################################
+#
+# A bank of PIDs whose gains and state are held in lists indexed by PID, any subset of which can be
+# updated in one call.  With the options off, each gives exactly the same results as a PID above,
+# but slower: BenchPIDBank times it against the PIDs, which the flight loop runs for that reason.
+# The bank is only for the PIDs that want its options, which ControlLoop.configurePID() moves onto
+# it behind a BankedPID.  Its state is in lists as arrays box and unbox a float on every access.
+# The options per PID are:
+# - i_limit: anti-windup clamping the integral term to +/- i_limit
+# - d_on_measurement: the differential term uses the change in input rather than error, so a
+#   target change doesn't kick the output
+# - d_tau: first order low pass filter time constant for the differential term
+# - output_limit: clamping the output to +/- output_limit
 #
 ####################################################################################################
-def GetRotationAngles(ax, ay, az):
+PID_QVX, PID_QVY, PID_QVZ, PID_YA, PID_PR, PID_RR, PID_YR, PID_PA, PID_RA = range(9)
+
+class PIDBank:
+
+    def __init__(self, gains):
+        size = len(gains)
+        self.p_gains = [p_gain for p_gain, i_gain, d_gain in gains]
+        self.i_gains = [i_gain for p_gain, i_gain, d_gain in gains]
+        self.d_gains = [d_gain for p_gain, i_gain, d_gain in gains]
+
+        #-------------------------------------------------------------------------------------------
+        # State
+        #-------------------------------------------------------------------------------------------
+        self.last_errors = [0.0] * size
+        self.i_errors = [0.0] * size
+        self.last_inputs = [0.0] * size
+        self.d_filtered = [0.0] * size
+        self.primed = [False] * size
+
+        #-------------------------------------------------------------------------------------------
+        # Options; 'options' flags the PIDs using any of them so the others take the fast path.
+        #-------------------------------------------------------------------------------------------
+        self.options = [False] * size
+        self.i_limits = [0.0] * size
+        self.d_on_measurement = [False] * size
+        self.d_taus = [0.0] * size
+        self.output_limits = [0.0] * size
+
+        #-------------------------------------------------------------------------------------------
+        # Outputs, and the P, I and D terms for diagnostics
+        #-------------------------------------------------------------------------------------------
+        self.outputs = [0.0] * size
+        self.p_out = [0.0] * size
+        self.i_out = [0.0] * size
+        self.d_out = [0.0] * size
+
+    def configure(self, index, i_limit = 0.0, d_on_measurement = False, d_tau = 0.0, output_limit = 0.0):
+        self.i_limits[index] = i_limit
+        self.d_on_measurement[index] = d_on_measurement
+        self.d_taus[index] = d_tau
+        self.output_limits[index] = output_limit
+        self.options[index] = bool(i_limit or d_on_measurement or d_tau or output_limit)
+
+    def reset(self, indices):
+        #-------------------------------------------------------------------------------------------
+        # Start the PIDs listed in indices afresh
+        #-------------------------------------------------------------------------------------------
+        for index in indices:
+            self.last_errors[index] = 0.0
+            self.i_errors[index] = 0.0
+            self.last_inputs[index] = 0.0
+            self.d_filtered[index] = 0.0
+            self.primed[index] = False
+            self.outputs[index] = 0.0
+            self.p_out[index] = 0.0
+            self.i_out[index] = 0.0
+            self.d_out[index] = 0.0
+
+    def compute(self, indices, inputs, targets, dt):
+        #-------------------------------------------------------------------------------------------
+        # Run the PIDs listed in indices against the matching inputs and targets, returning the
+        # outputs array indexed as per the PIDs.
+        #-------------------------------------------------------------------------------------------
+        p_gains = self.p_gains
+        i_gains = self.i_gains
+        d_gains = self.d_gains
+        last_errors = self.last_errors
+        i_errors = self.i_errors
+        options = self.options
+        outputs = self.outputs
+        p_outs = self.p_out
+        i_outs = self.i_out
+        d_outs = self.d_out
+
+        for index, input, target in zip(indices, inputs, targets):
+            error = target - input
+            last_error = last_errors[index]
+            i_error = i_errors[index] + (error + last_error) * dt
+
+            if not options[index]:
+                d_error = (error - last_error) / dt
+                p_output = p_gains[index] * error
+                i_output = i_gains[index] * i_error
+                d_output = d_gains[index] * d_error
+                output = p_output + i_output + d_output
+
+            else:
+                #-----------------------------------------------------------------------------------
+                # Differential term from the change in error or measurement, optionally filtered.
+                # The first measurement has no predecessor so its differential is zero.
+                #-----------------------------------------------------------------------------------
+                if self.d_on_measurement[index]:
+                    if self.primed[index]:
+                        d_error = (self.last_inputs[index] - input) / dt
+                    else:
+                        d_error = 0.0
+                        self.primed[index] = True
+                else:
+                    d_error = (error - last_error) / dt
+
+                d_tau = self.d_taus[index]
+                if d_tau:
+                    d_error = self.d_filtered[index] + (d_error - self.d_filtered[index]) * dt / (d_tau + dt)
+                    self.d_filtered[index] = d_error
+
+                #-----------------------------------------------------------------------------------
+                # Anti-windup: stop the integral growing beyond what's needed to produce i_limit.
+                #-----------------------------------------------------------------------------------
+                i_gain = i_gains[index]
+                i_output = i_gain * i_error
+                i_limit = self.i_limits[index]
+                if i_limit and i_gain:
+                    if i_output > i_limit:
+                        i_output = i_limit
+                        i_error = i_limit / i_gain
+                    elif i_output < -i_limit:
+                        i_output = -i_limit
+                        i_error = -i_limit / i_gain
+
+                p_output = p_gains[index] * error
+                d_output = d_gains[index] * d_error
+                output = p_output + i_output + d_output
+
+                output_limit = self.output_limits[index]
+                if output_limit:
+                    if output > output_limit:
+                        output = output_limit
+                    elif output < -output_limit:
+                        output = -output_limit
+
+                self.last_inputs[index] = input
+
+            last_errors[index] = error
+            i_errors[index] = i_error
+            outputs[index] = output
+            p_outs[index] = p_output
+            i_outs[index] = i_output
+            d_outs[index] = d_output
+
+        return outputs
+
+
+class BankedPID(object):
+
     #-----------------------------------------------------------------------------------------------
-    # What's the angle in the x and y plane from horizontal in radians?
+    # One of a PIDBank's PIDs standing in for a PID, with the same Compute(), reset() and terms.
     #-----------------------------------------------------------------------------------------------
-    pitch = math.atan2(-ax, math.pow(math.pow(ay, 2) + math.pow(az, 2), 0.5))
-    roll = math.atan2(ay, az)
+    __slots__ = ('bank', 'index', 'indices', 'inputs', 'targets')
 
-    return pitch, roll
+    def __init__(self, bank, index):
+        self.bank = bank
+        self.index = index
+        self.indices = (index,)
+        self.inputs = [0.0]
+        self.targets = [0.0]
+
+    def reset(self):
+        self.bank.reset(self.indices)
+
+    def Compute(self, input, target, dt):
+        self.inputs[0] = input
+        self.targets[0] = target
+        return self.bank.compute(self.indices, self.inputs, self.targets, dt)[self.index]
+
+    @property
+    def p_out(self):
+        return self.bank.p_out[self.index]
+
+    @property
+    def i_out(self):
+        return self.bank.i_out[self.index]
+
+    @property
+    def d_out(self):
+        return self.bank.d_out[self.index]
 
 ####################################################################################################
 #
-# Absolute angles of tilt compared to the earth reference frame.
+# Flight state shared by the sensor thread, the motion loop, diagnostics and shutdown reporting.
+# The field layout is fixed: each field has a struct format code, and snapshot() packs the lot into
+# a preallocated buffer so readers get a consistent copy.  Each field's packed on its own at its
+# offset in the layout, as packing them in one go would build a tuple of them every snapshot.
 #
 ####################################################################################################
-def GetAbsoluteAngles(ax, ay, az):
+FLIGHT_STATE_LAYOUT = (
+    #-----------------------------------------------------------------------------------------------
+    # Motion loop timing, and the sensor batch averages in raw units, written by SENSORDATA
+    #-----------------------------------------------------------------------------------------------
+    ('elapsed_time', 'd'), ('loop_count', 'i'),
+    ('i_qax', 'd'), ('i_qay', 'd'), ('i_qaz', 'd'), ('i_qrx', 'd'), ('i_qry', 'd'), ('i_qrz', 'd'), ('i_time', 'd'),
 
-    pitch = math.atan2(-ax, az)
-    roll = math.atan2(ay, az)
+    #-----------------------------------------------------------------------------------------------
+    # Scaled sensor data and the estimators' outputs
+    #-----------------------------------------------------------------------------------------------
+    ('qrx', 'd'), ('qry', 'd'), ('qrz', 'd'), ('qax', 'd'), ('qay', 'd'), ('qaz', 'd'),
+    ('egx', 'd'), ('egy', 'd'), ('egz', 'd'), ('qgx', 'd'), ('qgy', 'd'), ('qgz', 'd'),
+    ('qvx_input', 'd'), ('qvy_input', 'd'), ('qvz_input', 'd'), ('pa', 'd'), ('ra', 'd'), ('ya', 'd'),
 
-    return pitch, roll
+    #-----------------------------------------------------------------------------------------------
+    # Targets and PID outputs
+    #-----------------------------------------------------------------------------------------------
+    ('evx_target', 'd'), ('evy_target', 'd'), ('evz_target', 'd'),
+    ('qvx_target', 'd'), ('qvy_target', 'd'), ('qvz_target', 'd'),
+    ('pr_target', 'd'), ('rr_target', 'd'), ('yr_target', 'd'),
+    ('qvz_out', 'd'), ('pr_out', 'i'), ('rr_out', 'i'), ('yr_out', 'i'), ('vert_out', 'i'), ('hover_speed', 'i'),
+
+    #-----------------------------------------------------------------------------------------------
+    # Loop control, set by the signal handlers and flight plan
+    #-----------------------------------------------------------------------------------------------
+    ('keep_looping', '?'), ('woken_by', 'i'))
+
+
+class FlightState(object):
+
+    __slots__ = tuple([name for name, code in FLIGHT_STATE_LAYOUT]) + ('buffer', 'view')
+
+    FIELDS = tuple([name for name, code in FLIGHT_STATE_LAYOUT])
+    _STRUCT = struct.Struct('=' + ''.join([code for name, code in FLIGHT_STATE_LAYOUT]))
+    _PACKERS = tuple([(name, struct.Struct('=' + code).pack_into, struct.calcsize('=' + ''.join([code for name, code in FLIGHT_STATE_LAYOUT[0:index]])))
+                      for index, (name, code) in enumerate(FLIGHT_STATE_LAYOUT)])
+
+    def __init__(self):
+        for name, code in FLIGHT_STATE_LAYOUT:
+            if code == 'd':
+                setattr(self, name, 0.0)
+            elif code == '?':
+                setattr(self, name, False)
+            else:
+                setattr(self, name, 0)
+
+        self.buffer = bytearray(self._STRUCT.size)
+        self.view = memoryview(self.buffer)
+
+    def size(self):
+        return self._STRUCT.size
+
+    def snapshot(self, buffer = None, offset = 0):
+        #-------------------------------------------------------------------------------------------
+        # Pack the fields into buffer at offset, or into the state's own buffer, returning a
+        # memoryview of the state's buffer or the buffer passed in.
+        #-------------------------------------------------------------------------------------------
+        if buffer is None:
+            buffer = self.buffer
+            for name, pack_into, field_offset in self._PACKERS:
+                pack_into(buffer, field_offset, getattr(self, name))
+            return self.view
+
+        for name, pack_into, field_offset in self._PACKERS:
+            pack_into(buffer, offset + field_offset, getattr(self, name))
+        return buffer
 
+    @classmethod
+    def unpack(cls, buffer, offset = 0):
+        return cls._STRUCT.unpack_from(buffer, offset)
+
+    def report(self):
+        fields = self.unpack(self.snapshot())
+        logger.critical("flight state: %s", ", ".join(["%s = %s" % (name, value) for name, value in zip(self.FIELDS, fields)]))
 
 ####################################################################################################
 #
-# Convert a body frame rotation rate to the rotation frames
+# Diagnostics logging.  Nothing is formatted in the motion loop unless a sample is due: the flight
+# state and PID terms are read from the FlightState and PIDs at that point, and logging
+# formats the record lazily.  Decimation allows sampling 1 in every N motion loops.
 #
 ####################################################################################################
-def Body2EulerRates(qry, qrx, qrz, pa, ra):
-    #===============================================================================================
-    # Axes: Convert a set of gyro body frame rotation rates into Euler frames
-    #
-    # Matrix
-    # ---------
-    # |err|   | 1 ,  sin(ra) * tan(pa) , cos(ra) * tan(pa) | |qrx|
-    # |epr| = | 0 ,  cos(ra)           ,     -sin(ra)      | |qry|
-    # |eyr|   | 0 ,  sin(ra) / cos(pa) , cos(ra) / cos(pa) | |qrz|
-    #
-    #===============================================================================================
-    c_pa = math.cos(pa)
-    t_pa = math.tan(pa)
-    c_ra = math.cos(ra)
-    s_ra = math.sin(ra)
+class Diagnostics:
 
-    err = qrx + qry * s_ra * t_pa + qrz * c_ra * t_pa
-    epr =       qry * c_ra        - qrz * s_ra
-    eyr =       qry * s_ra / c_pa + qrz * c_ra / c_pa
+    _HEADER = 'time, dt, loop, qrx, qry, qrz, qax, qay, qaz, efrgv_x, efrgv_y, efrgv_z, qfrgv_x, qfrgv_y, qfrgv_z, qvx_input, qvy_input, qvz_input, pitch, roll, yaw, evx_target, qvx_target, qxp, qxi, qxd, pr_target, prp, pri, prd, pr_out, evy_yarget, qvy_target, qyp, qyi, qyd, rr_target, rrp, rri, rrd, rr_out, evz_target, qvz_target, qzp, qzi, qzd, qvz_out, yr_target, yrp, yri, yrd, yr_out, FL spin, FR spin, BL spin, BR spin'
+    _FORMAT = '%f, %f, %d, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %d, %f, %f, %f, %f, %f, %f, %f, %f, %f, %d, %f, %f, %f, %f, %f, %d, %f, %f, %f, %f, %d, %d, %d, %d, %d'
 
-    return epr, err, eyr
+    def __init__(self, decimation):
+        self.decimation = decimation
+        self.countdown = 1
+        self.samples = 0
+
+    def header(self):
+        logger.warning(self._HEADER)
+
+    def due(self):
+        #-------------------------------------------------------------------------------------------
+        # Count down to the next sample; the first loop is always sampled.
+        #-------------------------------------------------------------------------------------------
+        self.countdown -= 1
+        if self.countdown > 0:
+            return False
 
+        self.countdown = self.decimation
+        self.samples += 1
+        return True
 
+    def emit(self, fs, pids, esc_list):
+        logger.warning(self._FORMAT,
+                       fs.elapsed_time, fs.i_time, fs.loop_count, fs.qrx, fs.qry, fs.qrz, fs.qax, fs.qay, fs.qaz, fs.egx, fs.egy, fs.egz, fs.qgx, fs.qgy, fs.qgz, fs.qvx_input, fs.qvy_input, fs.qvz_input, math.degrees(fs.pa), math.degrees(fs.ra), math.degrees(fs.ya),
+                       fs.evx_target, fs.qvx_target, pids[PID_QVX].p_out, pids[PID_QVX].i_out, pids[PID_QVX].d_out, math.degrees(fs.pr_target), pids[PID_PR].p_out, pids[PID_PR].i_out, pids[PID_PR].d_out, fs.pr_out,
+                       fs.evy_target, fs.qvy_target, pids[PID_QVY].p_out, pids[PID_QVY].i_out, pids[PID_QVY].d_out, math.degrees(fs.rr_target), pids[PID_RR].p_out, pids[PID_RR].i_out, pids[PID_RR].d_out, fs.rr_out,
+                       fs.evz_target, fs.qvz_target, pids[PID_QVZ].p_out, pids[PID_QVZ].i_out, pids[PID_QVZ].d_out, fs.qvz_out, math.degrees(fs.yr_target), pids[PID_YR].p_out, pids[PID_YR].i_out, pids[PID_YR].d_out, fs.yr_out,
+                       esc_list[0].pulse_width, esc_list[1].pulse_width, esc_list[2].pulse_width, esc_list[3].pulse_width)
 
 ####################################################################################################
 #
-# Convert a vector to quadcopter-frame coordinates from earth-frame coordinates
+# Multi-rate scheduling driven by the IMU sample count.  Each task runs every 'period' IMU samples;
+# the rate task's period sets how many samples are read per motion loop, and the other tasks' periods
+# must be integer multiples of it.  Each task keeps track of how long it takes against the time its
+# period allows, so it's clear whether each rate fits the CPU budget.
 #
 ####################################################################################################
-def RotateE2Q(evx, evy, evz, pa, ra, ya):
+class SchedulerTask:
 
-    #===============================================================================================
-    # Axes: Convert a vector from earth- to quadcopter frame
-    #
-    # Matrix
-    # ---------
-    # |qvx|   | cos(pa) * cos(ya),                                 cos(pa) * sin(ya),                               -sin(pa)          | |evx|
-    # |qvy| = | sin(ra) * sin(pa) * cos(ya) - cos(ra) * sin(ya),   sin(ra) * sin(pa) * sin(ya) + cos(ra) * cos(ya),  sin(ra) * cos(pa)| |evy|
-    # |qvz|   | cos(ra) * sin(pa) * cos(ya) + sin(ra) * sin(ya),   cos(ra) * sin(pa) * sin(ya) - sin(ra) * cos(ya),  cos(pa) * cos(ra)| |evz|
-    #
-    #===============================================================================================
-    c_pa = math.cos(pa)
-    s_pa = math.sin(pa)
-    c_ra = math.cos(ra)
-    s_ra = math.sin(ra)
-    c_ya = math.cos(ya)
-    s_ya = math.sin(ya)
+    def __init__(self, name, period, sample_time):
+        self.name = name
+        self.period = period
+        self.budget = period * sample_time
 
-    qvx = evx * c_pa * c_ya                        + evy * c_pa * s_ya                        - evz * s_pa
-    qvy = evx * (s_ra * s_pa * c_ya - c_ra * s_ya) + evy * (s_ra * s_pa * s_ya + c_ra * c_ya) + evz * s_ra * c_pa
-    qvz = evx * (c_ra * s_pa * c_ya + s_ra * s_ya) + evy * (c_ra * s_pa * s_ya - s_ra * c_ya) + evz * c_pa * c_ra
+        #-------------------------------------------------------------------------------------------
+        # Sensor time since the task last ran, set by the scheduler when the task is due.
+        #-------------------------------------------------------------------------------------------
+        self.dt = 0.0
+        self.last_elapsed = 0.0
 
-    return qvx, qvy, qvz
+        #-------------------------------------------------------------------------------------------
+        # Overrun accounting
+        #-------------------------------------------------------------------------------------------
+        self.runs = 0
+        self.overruns = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.start_time = 0.0
+
+    def begin(self):
+        self.start_time = time.time()
+
+    def end(self):
+        run_time = time.time() - self.start_time
+        self.runs += 1
+        self.total_time += run_time
+        if run_time > self.max_time:
+            self.max_time = run_time
+        if run_time > self.budget:
+            self.overruns += 1
+
+
+class Scheduler:
 
+    def __init__(self, sample_time):
+        self.sample_time = sample_time
+        self.tasks = []
+        self.sample_count = 0
+        self.due_count = 0
+        self.elapsed_time = 0.0
+
+    def addTask(self, name, period):
+        task = SchedulerTask(name, period, self.sample_time)
+        self.tasks.append(task)
+        return task
+
+    def tick(self, samples, dt):
+        #-------------------------------------------------------------------------------------------
+        # Account for the latest batch of samples; tasks are due if their period divides the sample
+        # count at the start of the batch, so all tasks run on the first tick.
+        #-------------------------------------------------------------------------------------------
+        self.due_count = self.sample_count
+        self.sample_count += samples
+        self.elapsed_time += dt
+
+    def due(self, task):
+        if self.due_count % task.period:
+            return False
+
+        task.dt = self.elapsed_time - task.last_elapsed
+        task.last_elapsed = self.elapsed_time
+        return True
+
+    def report(self):
+        logger.critical("scheduler: %d samples in %fs", self.sample_count, self.elapsed_time)
+
+        utilization = 0.0
+        for task in self.tasks:
+            if task.runs == 0:
+                continue
+            mean_time = task.total_time / task.runs
+            utilization += mean_time / task.budget
+            logger.critical("%s task: every %d samples, %d runs, mean %.0fus, max %.0fus, budget %.0fus, %d overruns",
+                            task.name, task.period, task.runs, mean_time * 1000000, task.max_time * 1000000, task.budget * 1000000, task.overruns)
+        logger.critical("scheduler CPU utilization %.1f%%", utilization * 100)
 
 ####################################################################################################
 #
-# Convert a vector to earth-frame coordingates from quadcopter-frame coordinates.
+# Startup phase timing from launch to take-off.  go() calls lap() at the end of each phase of
+# startup, which records the time since the previous lap on the monotonic clock (wall clock time on
+# Python 2, which has none) and, where the resource module's available, the CPU time used and the
+# minor / major page faults taken.  report() logs them all at take-off so they're kept in the
+# flight log alongside everything else.
 #
 ####################################################################################################
-def RotateQ2E(qvx, qvy, qvz, pa, ra, ya):
+class PhaseTimer(object):
 
-    #===============================================================================================
-    # We need an inverse of the Earth- to quadcopter-frame matrix above.  It is only
-    # needed for accurate gravity calculation at take-off.  For that reason, yaw can be
-    # omitted making it simpler. However the method used could equally well be used in
-    # a context requiring yaw to be included.
+    def __init__(self):
+        self.clock = getattr(time, "monotonic", time.time)
+        try:
+            import resource
+            self.resource = resource
+        except ImportError:
+            self.resource = None
+
+        self.phases = []
+        self.start_time = self.clock()
+        self.last_time = self.start_time
+        self.start_usage = self.usage()
+        self.last_usage = self.start_usage
+
+    def usage(self):
+        if self.resource is None:
+            return None
+
+        usage = self.resource.getrusage(self.resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime, usage.ru_minflt, usage.ru_majflt
+
+    def lap(self, name):
+        time_now = self.clock()
+        usage = self.usage()
+        self.phases.append((name, time_now - self.last_time, self.last_usage, usage))
+        self.last_time = time_now
+        self.last_usage = usage
+
+    def report(self):
+        phases = self.phases + [("total", self.last_time - self.start_time, self.start_usage, self.last_usage)]
+        for name, phase_time, start_usage, end_usage in phases:
+            if start_usage is None:
+                logger.critical("startup %s: %fs", name, phase_time)
+            else:
+                logger.critical("startup %s: %fs, CPU %fs, %d minor / %d major page faults", name, phase_time,
+                                end_usage[0] - start_usage[0], end_usage[1] - start_usage[1], end_usage[2] - start_usage[2])
+
+####################################################################################################
+#
+# Motor locations on the frame and propeller rotation directions
+#
+####################################################################################################
+MOTOR_LOCATION_FRONT = 0b00000001
+MOTOR_LOCATION_BACK =  0b00000010
+MOTOR_LOCATION_LEFT =  0b00000100
+MOTOR_LOCATION_RIGHT = 0b00001000
+
+MOTOR_ROTATION_CW = 1
+MOTOR_ROTATION_ACW = 2
+
+####################################################################################################
+#
+#  Class for managing each blade + motor configuration via its ESC
+#
+####################################################################################################
+class ESC:
+
+    def __init__(self, pin, location, rotation, name):
+        #-------------------------------------------------------------------------------------------
+        # The GPIO BCM numbered pin providing PWM signal for this ESC
+        #-------------------------------------------------------------------------------------------
+        self.bcm_pin = pin
+
+        #-------------------------------------------------------------------------------------------
+        # Physical parameters of the ESC / motors / propellers
+        #-------------------------------------------------------------------------------------------
+        self.motor_location = location
+        self.motor_rotation = rotation
+
+        #-------------------------------------------------------------------------------------------
+        # Initialize the RPIO DMa PWM for this ESC in microseconds - 1ms - 2ms of
+        # pulse widths with 3ms carrier.
+        #-------------------------------------------------------------------------------------------
+        self.min_pulse_width = 1000
+        self.max_pulse_width = 2000
+
+        #-------------------------------------------------------------------------------------------
+        # The PWM pulse range required by this ESC
+        #-------------------------------------------------------------------------------------------
+        self.pulse_width = self.min_pulse_width
+
+        #-------------------------------------------------------------------------------------------
+        # Name - for logging purposes only
+        #-------------------------------------------------------------------------------------------
+        self.name = name
+
+        #-------------------------------------------------------------------------------------------
+        # Initialize the RPIO DMA PWM for this ESC.
+        #-------------------------------------------------------------------------------------------
+        PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.pulse_width)
+
+
+    def update(self, spin_rate):
+        self.pulse_width = int(self.min_pulse_width + spin_rate)
+
+        if self.pulse_width < self.min_pulse_width:
+            self.pulse_width = self.min_pulse_width
+        if self.pulse_width > self.max_pulse_width:
+            self.pulse_width = self.max_pulse_width
+
+        PWM.add_channel_pulse(RPIO_DMA_CHANNEL, self.bcm_pin, 0, self.pulse_width)
+
+
+
+####################################################################################################
+#
+# Math kernels: the per-sample arithmetic on the flight path.  If numba is installed,
+# EnableKernels() at startup swaps in versions JIT compiled on first use with the compiled code
+# cached on disk beside this file, so only the very first flight pays for compilation and later
+# ones just load the cache.  WarmKernels() calls each once at startup so neither happens inside
+# the flight loop.  Without numba they're the plain Python functions.  Either way, a kernel's
+# 'py_func' (or the kernel itself) is the Python version.
+#
+####################################################################################################
+KERNELS = []
+
+def Kernel(function):
+    KERNELS.append(function.__name__)
+    return function
+
+
+def EnableKernels():
+    #-----------------------------------------------------------------------------------------------
+    # Swap the JIT compiled kernels in for the Python ones if numba's installed, returning whether
+    # they're in use.  Callers look kernels up by name, so they pick up whichever is current;
+    # BUTTERWORTHs and NotchFilterBanks made before this keep using the Python filters.
+    #-----------------------------------------------------------------------------------------------
+    global numba
+    global numpy
+
+    if numba is None:
+        try:
+            import numba
+            import numpy
+        except ImportError:
+            numba = None
+            return False
+
+        module_globals = globals()
+        for name in KERNELS:
+            module_globals[name] = numba.njit(cache = True)(module_globals[name])
+
+    return True
+
+
+def WarmKernels():
+    #-----------------------------------------------------------------------------------------------
+    # Run each kernel once with representative arguments, returning how long it took
+    #-----------------------------------------------------------------------------------------------
+    start_time = time.time()
+    GetRotationAngles(0.0, 0.0, 1.0)
+    GetAbsoluteAngles(0.0, 0.0, 1.0)
+    Body2EulerRates(0.0, 0.0, 0.0, 0.0, 0.0)
+    RotateE2Q(0.0, 0.0, 1.0, 0.0, 0.0, 0.0)
+    RotateQ2E(0.0, 0.0, 1.0, 0.0, 0.0, 0.0)
+    BUTTERWORTH(100, 0.2, 4, 0.0).filter(0.0)
+    notch_bank = NotchFilterBank(1000, 5, 60.0, 300.0)
+    notch_bank.filter(5)
+    notch_bank.track()
+    return time.time() - start_time
+
+
+def KernelReport():
+    if not EnableKernels():
+        logger.critical("Math kernels: Python (numba not installed)")
+    else:
+        logger.critical("Math kernels: numba %s JIT, ready in %fs", numba.__version__, WarmKernels())
+
+
+####################################################################################################
+#
+# Angles required to convert between Earth (interal reference frame) and Quadcopter (body # reference
+# frame).
+#
+# This is used for reorientating gravity into the quad frame to calculated quad frame velocities
+#
+####################################################################################################
+@Kernel
+def GetRotationAngles(ax, ay, az):
+    #-----------------------------------------------------------------------------------------------
+    # What's the angle in the x and y plane from horizontal in radians?
+    #-----------------------------------------------------------------------------------------------
+    pitch = math.atan2(-ax, math.pow(math.pow(ay, 2) + math.pow(az, 2), 0.5))
+    roll = math.atan2(ay, az)
+
+    return pitch, roll
+
+####################################################################################################
+#
+# Absolute angles of tilt compared to the earth reference frame.
+#
+####################################################################################################
+@Kernel
+def GetAbsoluteAngles(ax, ay, az):
+
+    pitch = math.atan2(-ax, az)
+    roll = math.atan2(ay, az)
+
+    return pitch, roll
+
+
+####################################################################################################
+#
+# Convert a body frame rotation rate to the rotation frames
+#
+####################################################################################################
+@Kernel
+def Body2EulerRates(qry, qrx, qrz, pa, ra):
+    #===============================================================================================
+    # Axes: Convert a set of gyro body frame rotation rates into Euler frames
+    #
+    # Matrix
+    # ---------
+    # |err|   | 1 ,  sin(ra) * tan(pa) , cos(ra) * tan(pa) | |qrx|
+    # |epr| = | 0 ,  cos(ra)           ,     -sin(ra)      | |qry|
+    # |eyr|   | 0 ,  sin(ra) / cos(pa) , cos(ra) / cos(pa) | |qrz|
+    #
+    #===============================================================================================
+    c_pa = math.cos(pa)
+    t_pa = math.tan(pa)
+    c_ra = math.cos(ra)
+    s_ra = math.sin(ra)
+
+    err = qrx + qry * s_ra * t_pa + qrz * c_ra * t_pa
+    epr =       qry * c_ra        - qrz * s_ra
+    eyr =       qry * s_ra / c_pa + qrz * c_ra / c_pa
+
+    return epr, err, eyr
+
+
+
+####################################################################################################
+#
+# Convert a vector to quadcopter-frame coordinates from earth-frame coordinates
+#
+####################################################################################################
+@Kernel
+def RotateE2Q(evx, evy, evz, pa, ra, ya):
+
+    #===============================================================================================
+    # Axes: Convert a vector from earth- to quadcopter frame
+    #
+    # Matrix
+    # ---------
+    # |qvx|   | cos(pa) * cos(ya),                                 cos(pa) * sin(ya),                               -sin(pa)          | |evx|
+    # |qvy| = | sin(ra) * sin(pa) * cos(ya) - cos(ra) * sin(ya),   sin(ra) * sin(pa) * sin(ya) + cos(ra) * cos(ya),  sin(ra) * cos(pa)| |evy|
+    # |qvz|   | cos(ra) * sin(pa) * cos(ya) + sin(ra) * sin(ya),   cos(ra) * sin(pa) * sin(ya) - sin(ra) * cos(ya),  cos(pa) * cos(ra)| |evz|
+    #
+    #===============================================================================================
+    c_pa = math.cos(pa)
+    s_pa = math.sin(pa)
+    c_ra = math.cos(ra)
+    s_ra = math.sin(ra)
+    c_ya = math.cos(ya)
+    s_ya = math.sin(ya)
+
+    qvx = evx * c_pa * c_ya                        + evy * c_pa * s_ya                        - evz * s_pa
+    qvy = evx * (s_ra * s_pa * c_ya - c_ra * s_ya) + evy * (s_ra * s_pa * s_ya + c_ra * c_ya) + evz * s_ra * c_pa
+    qvz = evx * (c_ra * s_pa * c_ya + s_ra * s_ya) + evy * (c_ra * s_pa * s_ya - s_ra * c_ya) + evz * c_pa * c_ra
+
+    return qvx, qvy, qvz
+
+
+####################################################################################################
+#
+# Convert a vector to earth-frame coordingates from quadcopter-frame coordinates.
+#
+####################################################################################################
+@Kernel
+def RotateQ2E(qvx, qvy, qvz, pa, ra, ya):
+
+    #===============================================================================================
+    # We need an inverse of the Earth- to quadcopter-frame matrix above.  It is only
+    # needed for accurate gravity calculation at take-off.  For that reason, yaw can be
+    # omitted making it simpler. However the method used could equally well be used in
+    # a context requiring yaw to be included.
     #
     # Earth to quadcopter rotation matrix
     # -----------------------------------
@@ -819,6 +2374,85 @@ def RotateQ2E(qvx, qvy, qvz, pa, ra, ya):
     return evx, evy, evz
 
 
+####################################################################################################
+#
+# Batch versions of the angle and frame conversion functions above for offline analysis of flight
+# logs.  They take NumPy arrays (or scalars, which broadcast) in place of each scalar, and return
+# arrays.  NumPy is optional; it's only needed if these are used, and isn't needed for flight.
+#
+####################################################################################################
+def RequireNumpy():
+    global numpy
+
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("NumPy is needed for the batch angle and frame conversions")
+
+
+def GetRotationAnglesArray(ax, ay, az):
+    RequireNumpy()
+    pitch = numpy.arctan2(-ax, numpy.sqrt(ay * ay + az * az))
+    roll = numpy.arctan2(ay, az)
+
+    return pitch, roll
+
+
+def GetAbsoluteAnglesArray(ax, ay, az):
+    RequireNumpy()
+    pitch = numpy.arctan2(-ax, az)
+    roll = numpy.arctan2(ay, az)
+
+    return pitch, roll
+
+
+def Body2EulerRatesArray(qry, qrx, qrz, pa, ra):
+    RequireNumpy()
+    c_pa = numpy.cos(pa)
+    t_pa = numpy.tan(pa)
+    c_ra = numpy.cos(ra)
+    s_ra = numpy.sin(ra)
+
+    err = qrx + qry * s_ra * t_pa + qrz * c_ra * t_pa
+    epr =       qry * c_ra        - qrz * s_ra
+    eyr =       qry * s_ra / c_pa + qrz * c_ra / c_pa
+
+    return epr, err, eyr
+
+
+def RotateE2QArray(evx, evy, evz, pa, ra, ya):
+    RequireNumpy()
+    c_pa = numpy.cos(pa)
+    s_pa = numpy.sin(pa)
+    c_ra = numpy.cos(ra)
+    s_ra = numpy.sin(ra)
+    c_ya = numpy.cos(ya)
+    s_ya = numpy.sin(ya)
+
+    qvx = evx * c_pa * c_ya                        + evy * c_pa * s_ya                        - evz * s_pa
+    qvy = evx * (s_ra * s_pa * c_ya - c_ra * s_ya) + evy * (s_ra * s_pa * s_ya + c_ra * c_ya) + evz * s_ra * c_pa
+    qvz = evx * (c_ra * s_pa * c_ya + s_ra * s_ya) + evy * (c_ra * s_pa * s_ya - s_ra * c_ya) + evz * c_pa * c_ra
+
+    return qvx, qvy, qvz
+
+
+def RotateQ2EArray(qvx, qvy, qvz, pa, ra, ya):
+    RequireNumpy()
+    c_pa = numpy.cos(pa)
+    s_pa = numpy.sin(pa)
+    c_ra = numpy.cos(ra)
+    s_ra = numpy.sin(ra)
+    c_ya = numpy.cos(ya)
+    s_ya = numpy.sin(ya)
+
+    evx = qvx * c_pa * c_ya + qvy * (s_ra * s_pa * c_ya - c_ra * s_ya) + qvz * (c_ra * s_pa * c_ya + s_ra * s_ya)
+    evy = qvx * c_pa * s_ya + qvy * (s_ra * s_pa * s_ya + c_ra * c_ya) + qvz * (c_ra * s_pa * s_ya - s_ra * c_ya)
+    evz = -qvx * s_pa       + qvy *  s_ra * c_pa                       + qvz * c_pa * c_ra
+
+    return evx, evy, evz
+
+
 ####################################################################################################
 #
 # Butterwork IIR Filter calculator and actor - this is carried out in the earth frame as we are track
@@ -855,6 +2489,19 @@ class BUTTERWORTH:
             self.d1[ii] = 2.0 * (1 - a2) / s
             self.d2[ii] = -(a2 - 2.0 * a * r + 1.0) / s
 
+        #-------------------------------------------------------------------------------------------
+        # With numba, hand the state to the compiled kernel as NumPy arrays (numba can't use the
+        # array module's) in place of running the Python filter below.
+        #-------------------------------------------------------------------------------------------
+        if numba is not None:
+            self.A = numpy.array(self.A, numpy.float32)
+            self.d1 = numpy.array(self.d1, numpy.float32)
+            self.d2 = numpy.array(self.d2, numpy.float32)
+            self.w0 = numpy.array(self.w0, numpy.float32)
+            self.w1 = numpy.array(self.w1, numpy.float32)
+            self.w2 = numpy.array(self.w2, numpy.float32)
+            self.filter = self.filterKernel
+
     def filter(self, input):
         for ii in range(0, self.n):
             self.w0[ii] = self.d1[ii] * self.w1[ii] + self.d2[ii] * self.w2[ii] + input
@@ -864,48 +2511,675 @@ class BUTTERWORTH:
 
         return output
 
-####################################################################################################
-#
-# GPIO pins initialization for MPU6050 interrupt, sounder and hardware PWM
-#
-####################################################################################################
-def RpioSetup():
-    RPIO.setmode(RPIO.BCM)
+    def filterKernel(self, input):
+        return ButterworthFilter(input, self.n, self.A, self.d1, self.d2, self.w0, self.w1, self.w2)
 
-    #-----------------------------------------------------------------------------------------------
-    # Set the MPU6050 interrupt input - this is a floating input; the IMU interrupt drives this
-    # input up when data is ready, and reading the data drives it down.
-    #-----------------------------------------------------------------------------------------------
-    logger.info('Setup MPU6050 interrupt input %s', RPIO_DATA_READY_INTERRUPT)
-    RPIO.setup(RPIO_DATA_READY_INTERRUPT, RPIO.IN)
-    RPIO.edge_detect_init(RPIO_DATA_READY_INTERRUPT, RPIO.RISING)
 
+@Kernel
+def ButterworthFilter(input, n, A, d1, d2, w0, w1, w2):
     #-----------------------------------------------------------------------------------------------
-    # Set up the globally shared single PWM channel
+    # BUTTERWORTH.filter as a kernel on the filter's coefficient and state arrays
     #-----------------------------------------------------------------------------------------------
-    PWM.set_loglevel(PWM.LOG_LEVEL_ERRORS)
-    PWM.setup(1)                                    # 1us resolution pulses
-    PWM.init_channel(RPIO_DMA_CHANNEL, 3000)        # pulse every 3ms
+    output = 0.0
+    for ii in range(0, n):
+        w0[ii] = d1[ii] * w1[ii] + d2[ii] * w2[ii] + input
+        output = A[ii] * (w0[ii] + 2.0 * w1[ii] + w2[ii])
+        w2[ii] = w1[ii]
+        w1[ii] = w0[ii]
+
+    return output
 
 ####################################################################################################
 #
-# GPIO pins cleanup for MPU6050 interrupt, sounder and hardware PWM
+# Dynamic notch filters taking motor vibration out of the raw IMU samples before they're averaged
+# into the motion loop's batches, where it would otherwise alias down into the rate PIDs' inputs.
+# Each accelerometer and gyro axis has its own biquad notch, run on every 1kHz sample.
 #
-####################################################################################################
-def RpioCleanup():
-    PWM.cleanup()
-    RPIO.edge_detect_term(RPIO_DATA_READY_INTERRUPT)
-    RPIO.cleanup()
-
-
-####################################################################################################
+# Each axis' notch is either tracked, fixed or off.  A tracked notch's centre follows the vibration
+# as estimated from blocks of the raw samples: a bank of Goertzel filters spread across the
+# tracking range gives the power at each of their frequencies, and if the strongest stands out
+# enough from the median it's taken as the vibration peak, refined by fitting a parabola to the
+# log power around it.  Tracked axes are analysed in turn, one per block, to spread the cost out;
+# until an axis' first peak is found its notch is off.
 #
-# Check CLI validity, set calibrate_sensors / fly or sys.exit(1)
+# The filtering and tracking are tasks of the motion loop's scheduler, so their costs are reported
+# against their budgets alongside its own tasks'.
+#
+####################################################################################################
+NOTCH_AXES = ("ax", "ay", "az", "gx", "gy", "gz")
+NOTCH_BLOCK = 128
+NOTCH_BINS = 16
+NOTCH_Q = 3.0
+NOTCH_PEAK_RATIO = 8.0
+NOTCH_SMOOTHING = 0.5
+NOTCH_RETUNE = 1.0
+
+class NotchFilterBank(object):
+
+    def __init__(self, sample_rate, batch, min_hz, max_hz, q = NOTCH_Q, bins = NOTCH_BINS, block = NOTCH_BLOCK, scheduler = None):
+        self.sample_rate = sample_rate
+        self.q = q
+        self.channels = len(NOTCH_AXES)
+        self.min_hz = min_hz
+        self.bin_spacing = (max_hz - min_hz) / (bins - 1)
+
+        #-------------------------------------------------------------------------------------------
+        # With numba, the coefficients, state and buffers are NumPy arrays for the kernels; without,
+        # lists are quickest.  Either way the kernels are chosen now, as per BUTTERWORTH.
+        #-------------------------------------------------------------------------------------------
+        if numba is not None:
+            Buffer = lambda size: numpy.zeros(size, numpy.float64)
+        else:
+            Buffer = lambda size: [0.0] * size
+
+        self.notch_kernel = NotchFilter
+        self.goertzel_kernel = GoertzelPowers
+        self.copy_kernel = NotchCopy
+        self.median_kernel = NotchMedian
+
+        #-------------------------------------------------------------------------------------------
+        # Per axis biquad coefficients and state; every notch starts off, passing samples straight
+        # through.  centres[] is 0.0 for notches that are off.
+        #-------------------------------------------------------------------------------------------
+        self.b0 = Buffer(self.channels)
+        self.b1 = Buffer(self.channels)
+        self.b2 = Buffer(self.channels)
+        self.a1 = Buffer(self.channels)
+        self.a2 = Buffer(self.channels)
+        self.z1 = Buffer(self.channels)
+        self.z2 = Buffer(self.channels)
+        self.centres = [0.0] * self.channels
+        for channel in range(self.channels):
+            self.setCoefficients(channel, 0.0)
+
+        #-------------------------------------------------------------------------------------------
+        # The samples for each batch are stored in 'samples' interleaved by axis, and filtered in
+        # one go into their per axis sums.
+        #-------------------------------------------------------------------------------------------
+        self.batch = batch
+        self.samples = Buffer(batch * self.channels)
+        self.sums = Buffer(self.channels)
+
+        #-------------------------------------------------------------------------------------------
+        # The sums are handed back through a memoryview with numba, so the motion loop gets Python
+        # floats rather than NumPy scalars, which are slower and allocate as they go.
+        #-------------------------------------------------------------------------------------------
+        self.sums_view = self.sums if numba is None else memoryview(self.sums)
+
+        #-------------------------------------------------------------------------------------------
+        # Tracking: the Goertzel coefficients for each bin frequency, a Hann window, and the raw
+        # sample block, rounded up to a whole number of batches.
+        #-------------------------------------------------------------------------------------------
+        self.block_size = batch * int(math.ceil(block / batch))
+        self.block = Buffer(self.block_size * self.channels)
+        self.block_index = 0
+        self.window = Buffer(self.block_size)
+        for ii in range(self.block_size):
+            self.window[ii] = 0.5 - 0.5 * math.cos(2 * math.pi * ii / (self.block_size - 1))
+        self.bin_coefficients = Buffer(bins)
+        for ii in range(bins):
+            self.bin_coefficients[ii] = 2 * math.cos(2 * math.pi * (min_hz + ii * self.bin_spacing) / sample_rate)
+        self.powers = Buffer(bins)
+        self.ranked_powers = Buffer(bins)
+
+        self.tracked = list(range(self.channels))
+        self.track_index = 0
+        self.estimates = [0.0] * self.channels
+        self.peaks = [0] * self.channels
+        self.blocks = 0
+
+        #-------------------------------------------------------------------------------------------
+        # The filter runs every batch and the tracker every block, each budgeted the time its
+        # samples take to arrive.
+        #-------------------------------------------------------------------------------------------
+        if scheduler is not None:
+            self.filter_task = scheduler.addTask("notch", batch)
+            self.track_task = scheduler.addTask("notch tracker", self.block_size)
+        else:
+            self.filter_task = SchedulerTask("notch", batch, 1.0 / sample_rate)
+            self.track_task = SchedulerTask("notch tracker", self.block_size, 1.0 / sample_rate)
+
+    def setCoefficients(self, channel, centre):
+        #-------------------------------------------------------------------------------------------
+        # Audio EQ cookbook notch, normalized so a0 is 1; a centre of 0.0 turns the notch off.
+        #-------------------------------------------------------------------------------------------
+        if centre == 0.0:
+            b0, b1, b2, a1, a2 = 1.0, 0.0, 0.0, 0.0, 0.0
+        else:
+            w0 = 2 * math.pi * centre / self.sample_rate
+            alpha = math.sin(w0) / (2 * self.q)
+            a0 = 1 + alpha
+            b0 = 1 / a0
+            b1 = -2 * math.cos(w0) / a0
+            b2 = b0
+            a1 = b1
+            a2 = (1 - alpha) / a0
+
+        self.b0[channel] = b0
+        self.b1[channel] = b1
+        self.b2[channel] = b2
+        self.a1[channel] = a1
+        self.a2[channel] = a2
+        self.centres[channel] = centre
+
+    def setCentre(self, channel, centre):
+        #-------------------------------------------------------------------------------------------
+        # Fix an axis' notch at 'centre' Hz, or turn it off with 0.0; either way it's no longer
+        # tracked.
+        #-------------------------------------------------------------------------------------------
+        if channel in self.tracked:
+            self.tracked.remove(channel)
+            self.track_index = 0
+        self.setCoefficients(channel, centre)
+
+    def filter(self, count):
+        #-------------------------------------------------------------------------------------------
+        # Filter the first 'count' samples in 'samples', returning the sum of each axis' filtered
+        # samples; the raw samples are kept for tracking, analysed once there's a block of them.
+        #-------------------------------------------------------------------------------------------
+        self.filter_task.begin()
+        self.notch_kernel(self.samples, count, self.channels, self.b0, self.b1, self.b2, self.a1, self.a2, self.z1, self.z2, self.sums)
+        self.filter_task.end()
+
+        if self.tracked:
+            length = min(count * self.channels, len(self.block) - self.block_index)
+            self.copy_kernel(self.samples, length, self.block, self.block_index)
+            self.block_index += length
+            if self.block_index == len(self.block):
+                self.block_index = 0
+                self.track()
+
+        return self.sums_view
+
+    def track(self):
+        self.track_task.begin()
+        self.blocks += 1
+        channel = self.tracked[self.track_index]
+        self.track_index = (self.track_index + 1) % len(self.tracked)
+
+        powers = self.powers
+        self.goertzel_kernel(self.block, self.block_size, self.channels, channel, self.window, self.bin_coefficients, powers)
+        bins = len(powers)
+        peak = 0
+        for ii in range(1, bins):
+            if powers[ii] > powers[peak]:
+                peak = ii
+        median = self.median_kernel(powers, self.ranked_powers)
+
+        if powers[peak] > NOTCH_PEAK_RATIO * median:
+            #---------------------------------------------------------------------------------------
+            # Refine the peak between the bins either side of it
+            #---------------------------------------------------------------------------------------
+            offset = 0.0
+            if 0 < peak < bins - 1:
+                left = math.log(max(powers[peak - 1], 1e-30))
+                centre = math.log(powers[peak])
+                right = math.log(max(powers[peak + 1], 1e-30))
+                curvature = left - 2 * centre + right
+                if curvature < 0.0:
+                    offset = 0.5 * (left - right) / curvature
+            estimate = self.min_hz + (peak + offset) * self.bin_spacing
+
+            #---------------------------------------------------------------------------------------
+            # Smooth the estimates, only retuning the notch once it's moved far enough to matter
+            #---------------------------------------------------------------------------------------
+            if self.peaks[channel] == 0:
+                self.estimates[channel] = estimate
+            else:
+                self.estimates[channel] += NOTCH_SMOOTHING * (estimate - self.estimates[channel])
+            self.peaks[channel] += 1
+
+            if abs(self.estimates[channel] - self.centres[channel]) >= NOTCH_RETUNE:
+                self.setCoefficients(channel, self.estimates[channel])
+
+        self.track_task.end()
+
+    def report(self):
+        for channel in range(self.channels):
+            if channel in self.tracked:
+                logger.critical("notch %s: tracked, %.1fHz, peaks found in %d of %d blocks", NOTCH_AXES[channel], self.centres[channel],
+                                self.peaks[channel], self.blocks // len(self.tracked))
+            elif self.centres[channel] == 0.0:
+                logger.critical("notch %s: off", NOTCH_AXES[channel])
+            else:
+                logger.critical("notch %s: fixed, %.1fHz", NOTCH_AXES[channel], self.centres[channel])
+
+
+@Kernel
+def NotchFilter(samples, count, channels, b0, b1, b2, a1, a2, z1, z2, sums):
+    #-----------------------------------------------------------------------------------------------
+    # Each axis' biquad, transposed direct form II, over the axis-interleaved samples, summing the
+    # outputs per axis
+    #-----------------------------------------------------------------------------------------------
+    for channel in range(channels):
+        sums[channel] = 0.0
+
+    for ii in range(count):
+        for channel in range(channels):
+            input = samples[ii * channels + channel]
+            output = b0[channel] * input + z1[channel]
+            z1[channel] = b1[channel] * input - a1[channel] * output + z2[channel]
+            z2[channel] = b2[channel] * input - a2[channel] * output
+            sums[channel] += output
+
+
+@Kernel
+def NotchCopy(samples, length, block, offset):
+    #-----------------------------------------------------------------------------------------------
+    # Append the first 'length' samples to the tracking block at 'offset', without slicing
+    #-----------------------------------------------------------------------------------------------
+    for ii in range(length):
+        block[offset + ii] = samples[ii]
+
+
+@Kernel
+def NotchMedian(values, ranked):
+    #-----------------------------------------------------------------------------------------------
+    # The median of 'values', insertion sorted into the scratch buffer 'ranked' of the same size
+    #-----------------------------------------------------------------------------------------------
+    count = len(values)
+    for ii in range(count):
+        value = values[ii]
+        jj = ii
+        while jj > 0 and ranked[jj - 1] > value:
+            ranked[jj] = ranked[jj - 1]
+            jj -= 1
+        ranked[jj] = value
+    return ranked[count // 2]
+
+
+@Kernel
+def GoertzelPowers(block, count, channels, channel, window, coefficients, powers):
+    #-----------------------------------------------------------------------------------------------
+    # The power of one axis' windowed samples at each Goertzel bin's frequency
+    #-----------------------------------------------------------------------------------------------
+    for jj in range(len(coefficients)):
+        coefficient = coefficients[jj]
+        s1 = 0.0
+        s2 = 0.0
+        for ii in range(count):
+            s0 = block[ii * channels + channel] * window[ii] + coefficient * s1 - s2
+            s2 = s1
+            s1 = s0
+        powers[jj] = s1 * s1 + s2 * s2 - coefficient * s1 * s2
+
+####################################################################################################
+#
+# Extended Kalman filter estimating attitude, quad frame velocity and gyro / accelerometer bias.  An
+# alternative to the Butterworth gravity + complementary filter pipeline, selected with --ekf.
+#
+# State: pitch, roll, yaw (radians), quad frame velocity (meters per second), gyro bias (radians
+# per second) and accelerometer bias (g's).  The gyros drive the angles, and the accelerometer less
+# gravity drives the velocity.  The accelerometer is then used as a measurement of gravity in the
+# quad frame to correct the angles and both biases; readings well away from 1g are skipped as
+# they're dominated by the quad's own acceleration.  There's no velocity measurement, so velocity
+# drift is only reduced as far as the accelerometer bias can be estimated.
+#
+# All storage is fixed size and allocated up front: the covariance etc are flat row-major arrays,
+# and the sparse structure of the Jacobians is used to avoid full 12 x 12 matrix products.
+#
+####################################################################################################
+class EKF:
+
+    _STATES = 12
+
+    #-----------------------------------------------------------------------------------------------
+    # Noise: gyro and accel in rad/s and g's, bias random walk per root second, and the measurement
+    # noise on accelerometer gravity, which includes the quad's own motion and vibration.
+    #-----------------------------------------------------------------------------------------------
+    _GYRO_NOISE = 0.02
+    _ACCEL_NOISE = 0.05
+    _GYRO_BIAS_WALK = 0.0005
+    _ACCEL_BIAS_WALK = 0.0005
+    _GRAVITY_NOISE = 0.1
+    _GRAVITY_GATE = 0.2
+
+    #-----------------------------------------------------------------------------------------------
+    # Columns of the non-zero entries of the process Jacobian, per attitude / velocity row
+    #-----------------------------------------------------------------------------------------------
+    _ANGLE_COLUMNS = (0, 1, 6, 7, 8)
+    _VELOCITY_COLUMNS = (0, 1, 9, 10, 11)
+    _ROWS = tuple(range(0, 12))
+    _DYNAMIC_ROWS = tuple(range(0, 6))
+
+    def __init__(self, grav_accel):
+        self.grav_accel = grav_accel
+
+        n = self._STATES
+        self.x = array('d', [0.0] * n)
+        self.P = array('d', [0.0] * n * n)
+        self.M = array('d', [0.0] * n * n)
+
+        #-------------------------------------------------------------------------------------------
+        # dt * process Jacobian rows for the angles and velocities; the biases' rows are identity.
+        #-------------------------------------------------------------------------------------------
+        self.A = array('d', [0.0] * 6 * n)
+
+        #-------------------------------------------------------------------------------------------
+        # Measurement Jacobian, P * H transpose, innovation covariance and its inverse, and gain
+        #-------------------------------------------------------------------------------------------
+        self.H = array('d', [0.0] * 3 * n)
+        self.PHt = array('d', [0.0] * n * 3)
+        self.S = array('d', [0.0] * 9)
+        self.K = array('d', [0.0] * n * 3)
+
+        self.qgx = 0.0
+        self.qgy = 0.0
+        self.qgz = 1.0
+
+        self.updates = 0
+        self.skipped = 0
+
+        self.reset(0.0, 0.0, 0.0)
+
+    def reset(self, pa, ra, ya):
+        n = self._STATES
+        x = self.x
+        P = self.P
+
+        for ii in self._ROWS:
+            x[ii] = 0.0
+        for ii in range(0, n * n):
+            P[ii] = 0.0
+
+        x[0] = pa
+        x[1] = ra
+        x[2] = ya
+
+        initial_variance = (0.0025, 0.0025, 0.0001, 0.0001, 0.0001, 0.0001, 0.0001, 0.0001, 0.0001, 0.000025, 0.000025, 0.000025)
+        for ii in self._ROWS:
+            P[ii * n + ii] = initial_variance[ii]
+
+    def predict(self, qax, qay, qaz, qrx, qry, qrz, dt):
+        n = self._STATES
+        x = self.x
+        P = self.P
+        M = self.M
+        A = self.A
+        G = self.grav_accel
+
+        pa = x[0]
+        ra = x[1]
+        c_pa = math.cos(pa)
+        s_pa = math.sin(pa)
+        t_pa = s_pa / c_pa
+        c_ra = math.cos(ra)
+        s_ra = math.sin(ra)
+
+        #-------------------------------------------------------------------------------------------
+        # Bias corrected rotation rates, converted to Euler rates as per Body2EulerRates()
+        #-------------------------------------------------------------------------------------------
+        wx = qrx - x[6]
+        wy = qry - x[7]
+        wz = qrz - x[8]
+        q = wy * s_ra + wz * c_ra
+        r = wy * c_ra - wz * s_ra
+
+        #-------------------------------------------------------------------------------------------
+        # Bias corrected acceleration less gravity in the quad frame as per RotateE2Q(0, 0, 1, ...)
+        #-------------------------------------------------------------------------------------------
+        fx = qax - x[9] + s_pa
+        fy = qay - x[10] - s_ra * c_pa
+        fz = qaz - x[11] - c_pa * c_ra
+
+        #-------------------------------------------------------------------------------------------
+        # dt * process Jacobian, evaluated before the state moves on
+        #-------------------------------------------------------------------------------------------
+        A[0 * n + 1] = -q * dt
+        A[0 * n + 7] = -c_ra * dt
+        A[0 * n + 8] = s_ra * dt
+
+        A[1 * n + 0] = q / (c_pa * c_pa) * dt
+        A[1 * n + 1] = r * t_pa * dt
+        A[1 * n + 6] = -dt
+        A[1 * n + 7] = -s_ra * t_pa * dt
+        A[1 * n + 8] = -c_ra * t_pa * dt
+
+        A[2 * n + 0] = q * s_pa / (c_pa * c_pa) * dt
+        A[2 * n + 1] = r / c_pa * dt
+        A[2 * n + 7] = -s_ra / c_pa * dt
+        A[2 * n + 8] = -c_ra / c_pa * dt
+
+        A[3 * n + 0] = G * c_pa * dt
+        A[3 * n + 9] = -G * dt
+
+        A[4 * n + 0] = G * s_ra * s_pa * dt
+        A[4 * n + 1] = -G * c_ra * c_pa * dt
+        A[4 * n + 10] = -G * dt
+
+        A[5 * n + 0] = G * s_pa * c_ra * dt
+        A[5 * n + 1] = G * c_pa * s_ra * dt
+        A[5 * n + 11] = -G * dt
+
+        #-------------------------------------------------------------------------------------------
+        # Move the state on; the biases are constant bar the random walk
+        #-------------------------------------------------------------------------------------------
+        x[0] = pa + r * dt
+        x[1] = ra + (wx + q * t_pa) * dt
+        x[2] += q / c_pa * dt
+        x[3] += fx * G * dt
+        x[4] += fy * G * dt
+        x[5] += fz * G * dt
+
+        #-------------------------------------------------------------------------------------------
+        # M = F * P where F = I + dt * A
+        #-------------------------------------------------------------------------------------------
+        for ii in self._ROWS:
+            row = ii * n
+            if ii < 6:
+                columns = self._ANGLE_COLUMNS if ii < 3 else self._VELOCITY_COLUMNS
+                for jj in self._ROWS:
+                    total = P[row + jj]
+                    for kk in columns:
+                        total += A[row + kk] * P[kk * n + jj]
+                    M[row + jj] = total
+            else:
+                for jj in self._ROWS:
+                    M[row + jj] = P[row + jj]
+
+        #-------------------------------------------------------------------------------------------
+        # P = M * F transpose
+        #-------------------------------------------------------------------------------------------
+        for ii in self._ROWS:
+            row = ii * n
+            for jj in self._ROWS:
+                total = M[row + jj]
+                if jj < 6:
+                    columns = self._ANGLE_COLUMNS if jj < 3 else self._VELOCITY_COLUMNS
+                    for kk in columns:
+                        total += M[row + kk] * A[jj * n + kk]
+                P[row + jj] = total
+
+        #-------------------------------------------------------------------------------------------
+        # Add the process noise
+        #-------------------------------------------------------------------------------------------
+        angle_noise = self._GYRO_NOISE * self._GYRO_NOISE * dt
+        velocity_noise = G * G * self._ACCEL_NOISE * self._ACCEL_NOISE * dt
+        gyro_bias_noise = self._GYRO_BIAS_WALK * self._GYRO_BIAS_WALK * dt
+        accel_bias_noise = self._ACCEL_BIAS_WALK * self._ACCEL_BIAS_WALK * dt
+        for ii in self._DYNAMIC_ROWS:
+            P[ii * n + ii] += angle_noise if ii < 3 else velocity_noise
+        for ii in (6, 7, 8):
+            P[ii * n + ii] += gyro_bias_noise
+        for ii in (9, 10, 11):
+            P[ii * n + ii] += accel_bias_noise
+
+    def update(self, qax, qay, qaz):
+        n = self._STATES
+        x = self.x
+        P = self.P
+        H = self.H
+        PHt = self.PHt
+        S = self.S
+        K = self.K
+
+        pa = x[0]
+        ra = x[1]
+        c_pa = math.cos(pa)
+        s_pa = math.sin(pa)
+        c_ra = math.cos(ra)
+        s_ra = math.sin(ra)
+
+        #-------------------------------------------------------------------------------------------
+        # Predicted gravity in the quad frame
+        #-------------------------------------------------------------------------------------------
+        self.qgx = -s_pa
+        self.qgy = s_ra * c_pa
+        self.qgz = c_pa * c_ra
+
+        #-------------------------------------------------------------------------------------------
+        # Only use the accelerometer as a gravity reference when it's reading close to 1g
+        #-------------------------------------------------------------------------------------------
+        if math.fabs(math.sqrt(qax * qax + qay * qay + qaz * qaz) - 1.0) > self._GRAVITY_GATE:
+            self.skipped += 1
+            return
+
+        #-------------------------------------------------------------------------------------------
+        # Innovation
+        #-------------------------------------------------------------------------------------------
+        y0 = qax - (self.qgx + x[9])
+        y1 = qay - (self.qgy + x[10])
+        y2 = qaz - (self.qgz + x[11])
+
+        #-------------------------------------------------------------------------------------------
+        # Measurement Jacobian: gravity depends on pitch and roll, plus the accelerometer bias
+        #-------------------------------------------------------------------------------------------
+        H[0 * n + 0] = -c_pa
+        H[0 * n + 9] = 1.0
+        H[1 * n + 0] = -s_ra * s_pa
+        H[1 * n + 1] = c_ra * c_pa
+        H[1 * n + 10] = 1.0
+        H[2 * n + 0] = -s_pa * c_ra
+        H[2 * n + 1] = -c_pa * s_ra
+        H[2 * n + 11] = 1.0
+
+        #-------------------------------------------------------------------------------------------
+        # PHt = P * H transpose
+        #-------------------------------------------------------------------------------------------
+        for ii in self._ROWS:
+            row = ii * n
+            for mm in (0, 1, 2):
+                hrow = mm * n
+                PHt[ii * 3 + mm] = P[row + 0] * H[hrow + 0] + P[row + 1] * H[hrow + 1] + P[row + 9 + mm] * H[hrow + 9 + mm]
+
+        #-------------------------------------------------------------------------------------------
+        # S = H * P * H transpose + R
+        #-------------------------------------------------------------------------------------------
+        r = self._GRAVITY_NOISE * self._GRAVITY_NOISE
+        for mm in (0, 1, 2):
+            hrow = mm * n
+            for ll in (0, 1, 2):
+                S[mm * 3 + ll] = H[hrow + 0] * PHt[0 * 3 + ll] + H[hrow + 1] * PHt[1 * 3 + ll] + H[hrow + 9 + mm] * PHt[(9 + mm) * 3 + ll]
+            S[mm * 3 + mm] += r
+
+        #-------------------------------------------------------------------------------------------
+        # Invert S by cofactors
+        #-------------------------------------------------------------------------------------------
+        s00, s01, s02, s10, s11, s12, s20, s21, s22 = S
+        c00 = s11 * s22 - s12 * s21
+        c01 = s12 * s20 - s10 * s22
+        c02 = s10 * s21 - s11 * s20
+        det = s00 * c00 + s01 * c01 + s02 * c02
+        if det == 0.0:
+            self.skipped += 1
+            return
+        i00 = c00 / det
+        i01 = (s02 * s21 - s01 * s22) / det
+        i02 = (s01 * s12 - s02 * s11) / det
+        i10 = c01 / det
+        i11 = (s00 * s22 - s02 * s20) / det
+        i12 = (s02 * s10 - s00 * s12) / det
+        i20 = c02 / det
+        i21 = (s01 * s20 - s00 * s21) / det
+        i22 = (s00 * s11 - s01 * s10) / det
+
+        #-------------------------------------------------------------------------------------------
+        # K = PHt * S inverse, and correct the state
+        #-------------------------------------------------------------------------------------------
+        for ii in self._ROWS:
+            p0 = PHt[ii * 3 + 0]
+            p1 = PHt[ii * 3 + 1]
+            p2 = PHt[ii * 3 + 2]
+            k0 = p0 * i00 + p1 * i10 + p2 * i20
+            k1 = p0 * i01 + p1 * i11 + p2 * i21
+            k2 = p0 * i02 + p1 * i12 + p2 * i22
+            K[ii * 3 + 0] = k0
+            K[ii * 3 + 1] = k1
+            K[ii * 3 + 2] = k2
+            x[ii] += k0 * y0 + k1 * y1 + k2 * y2
+
+        #-------------------------------------------------------------------------------------------
+        # P = P - K * H * P, where H * P is the transpose of PHt as P is symmetric
+        #-------------------------------------------------------------------------------------------
+        for ii in self._ROWS:
+            k0 = K[ii * 3 + 0]
+            k1 = K[ii * 3 + 1]
+            k2 = K[ii * 3 + 2]
+            row = ii * n
+            for jj in self._ROWS:
+                P[row + jj] -= k0 * PHt[jj * 3 + 0] + k1 * PHt[jj * 3 + 1] + k2 * PHt[jj * 3 + 2]
+
+        self.updates += 1
+
+####################################################################################################
+#
+# Check the hardware drivers imported, before flight needs them
+#
+####################################################################################################
+def RequireHardware():
+    ImportDrivers()
+    missing = [name for name, module in (("smbus", smbus), ("RPi.GPIO", RPIO), ("RPIO.PWM", PWM)) if module is None]
+    if missing:
+        raise ImportError("Hardware drivers needed to fly not installed: %s" % ", ".join(missing))
+
+####################################################################################################
+#
+# GPIO pins initialization for MPU6050 interrupt, sounder and hardware PWM
+#
+####################################################################################################
+def RpioSetup():
+    global data_ready
+
+    RPIO.setmode(RPIO.BCM)
+
+    #-----------------------------------------------------------------------------------------------
+    # Set the MPU6050 interrupt input - this is a floating input; the IMU interrupt drives this
+    # input up when data is ready, and reading the data drives it down.  Its rising edges are
+    # waited for by the data ready waiter.
+    #-----------------------------------------------------------------------------------------------
+    logger.info('Setup MPU6050 interrupt input %s', RPIO_DATA_READY_INTERRUPT)
+    RPIO.setup(RPIO_DATA_READY_INTERRUPT, RPIO.IN)
+    data_ready = DataReadyWaiter.fromGPIO(RPIO_DATA_READY_INTERRUPT)
+    logger.warning("data ready interrupt via %s", data_ready.source)
+
+    #-----------------------------------------------------------------------------------------------
+    # Set up the globally shared single PWM channel
+    #-----------------------------------------------------------------------------------------------
+    PWM.set_loglevel(PWM.LOG_LEVEL_ERRORS)
+    PWM.setup(1)                                    # 1us resolution pulses
+    PWM.init_channel(RPIO_DMA_CHANNEL, 3000)        # pulse every 3ms
+
+####################################################################################################
+#
+# GPIO pins cleanup for MPU6050 interrupt, sounder and hardware PWM
+#
+####################################################################################################
+def RpioCleanup():
+    PWM.cleanup()
+    if data_ready is not None:
+        data_ready.close()
+    RPIO.cleanup()
+
+
+####################################################################################################
+#
+# Check CLI validity, set calibrate_sensors / fly or sys.exit(1)
 #
 ####################################################################################################
 def CheckCLI(argv):
     cli_fly = False
     cli_calibrate_gravity = False
+    cli_calibrate_temperature = False
     cli_video = False
 
     if i_am_phoebe:
@@ -978,429 +3252,1687 @@ def CheckCLI(argv):
         cli_rrd_gain = 0.0
 
         #-------------------------------------------------------------------------------------------
-        # Defaults for yaw angle PIDs
+        # Defaults for yaw angle PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_yrp_gain = 30.0
+        cli_yri_gain = 0.0
+        cli_yrd_gain = 0.0
+
+    elif i_am_zoe:
+        #-------------------------------------------------------------------------------------------
+        # Phoebe's PID configuration due to using her ESCs / motors / props
+        #-------------------------------------------------------------------------------------------
+        cli_hover_target = 600
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for vertical velocity PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_vvp_gain = 360.0
+        cli_vvi_gain = 180.0
+        cli_vvd_gain = 0.0
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for horizontal velocity PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_hvp_gain = 0.6
+        cli_hvi_gain = 0.4
+        cli_hvd_gain = 0.1
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for pitch angle PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_prp_gain = 120.0
+        cli_pri_gain = 60.0
+        cli_prd_gain = 0.0
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for roll angle PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_rrp_gain = 110.0
+        cli_rri_gain = 55.0
+        cli_rrd_gain = 0.0
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for yaw angle PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_yrp_gain = 60.0
+        cli_yri_gain = 30.0
+        cli_yrd_gain = 0.0
+
+    elif i_am_hog:
+        #-------------------------------------------------------------------------------------------
+        # Chloe's PID configuration due to using her frame / ESCs / motors / props
+        #-------------------------------------------------------------------------------------------
+        cli_hover_target = 500
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for vertical velocity PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_vvp_gain = 360.0      # 300 on GitHub
+        cli_vvi_gain = 180.0
+        cli_vvd_gain = 0.0
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for horizontal velocity PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_hvp_gain = 0.6
+        cli_hvi_gain = 0.3
+        cli_hvd_gain = 0.1
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for pitch angle PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_prp_gain = 100.0      # 80 on GitHub
+        cli_pri_gain = 50.0
+        cli_prd_gain = 0.0
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for roll angle PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_rrp_gain = 90.0       # 75 on GitHub
+        cli_rri_gain = 45.0
+        cli_rrd_gain = 0.0
+
+        #-------------------------------------------------------------------------------------------
+        # Defaults for yaw angle PIDs
+        #-------------------------------------------------------------------------------------------
+        cli_yrp_gain = 50.0       # 45 on GitHub
+        cli_yri_gain = 25.0
+        cli_yrd_gain = 0.0
+
+
+    #-----------------------------------------------------------------------------------------------
+    # Other configuration defaults
+    #-----------------------------------------------------------------------------------------------
+    cli_test_case = 0
+    cli_alpf = 3
+    cli_glpf = 1
+    cli_diagnostics = False
+    cli_diagnostics_rate = 1
+
+    #-----------------------------------------------------------------------------------------------
+    # Task periods in IMU samples (1ms) for the rate PIDs and ESCs, the attitude / velocity
+    # estimation, the velocity PIDs and the flight plan.  The rate task is limited to 200Hz as the
+    # ESC PWM carrier only updates every 3ms anyway.
+    #-----------------------------------------------------------------------------------------------
+    cli_rate_period = 5
+    cli_attitude_period = 20
+    cli_velocity_period = 20
+    cli_plan_period = 20
+    cli_ekf = False
+    cli_watchdog_deadline = 0.05
+    cli_profile_rate = 0
+    cli_gc_off = False
+    cli_gyro_tracking = False
+    cli_capture_time = 0.0
+    cli_notch = None
+    cli_compass_tau = 0.0
+    cli_rtf_period = 1.0
+    cli_tau = 0.5
+
+    hover_target_defaulted = True
+    prp_set = False
+    pri_set = False
+    prd_set = False
+    rrp_set = False
+    rri_set = False
+    rrd_set = False
+    yrp_set = False
+    yri_set = False
+    yrd_set = False
+
+    #-----------------------------------------------------------------------------------------------
+    # Right, let's get on with reading the command line and checking consistency
+    #-----------------------------------------------------------------------------------------------
+    try:
+        opts, args = getopt.getopt(argv,'dfgvh:r:', ['tc=', 'tau=', 'vvp=', 'vvi=', 'vvd=', 'hvp=', 'hvi=', 'hvd=', 'prp=', 'pri=', 'prd=', 'rrp=', 'rri=', 'rrd=', 'tau=', 'yrp=', 'yri=', 'yrd=', 'alpf=', 'glpf=', 'dd=', 'rtp=', 'atp=', 'vtp=', 'fpp=', 'ekf', 'wdt=', 'prof=', 'nogc', 'rls', 'gbt', 'cap=', 'notch=', 'mag='])
+    except getopt.GetoptError:
+        logger.critical('Must specify one of -f or -g or --tc')
+        logger.critical('  qcpi.py')
+        logger.critical('  -f set whether to fly')
+        logger.critical('  -h set the hover speed for manual testing')
+        logger.critical('  -g calibrate gravity against temperature, save and end')
+        logger.critical('  --rls calibrate the temperature model while warming up sitting level, save on Ctrl-C and end')
+        logger.critical('  -d enable diagnostics')
+        logger.critical('  --dd ?? log diagnostics every ?? motion loops')
+        logger.critical('  -v video the flight')
+        logger.critical('  -r ??  set the ready-to-fly period')
+        logger.critical('  --tc   select which testcase to run')
+        logger.critical('  --tau ??  set the angle CF -3dB point')
+        logger.critical('  --vvp  set vertical speed PID P gain')
+        logger.critical('  --vvi  set vertical speed PID P gain')
+        logger.critical('  --vvd  set vertical speed PID P gain')
+        logger.critical('  --hvp  set horizontal speed PID P gain')
+        logger.critical('  --hvi  set horizontal speed PID I gain')
+        logger.critical('  --hvd  set horizontal speed PID D gain')
+        logger.critical('  --prp  set pitch rotation rate PID P gain')
+        logger.critical('  --pri  set pitch rotation rate PID I gain')
+        logger.critical('  --prd  set pitch rotation rate PID D gain')
+        logger.critical('  --rrp  set roll rotation rate PID P gain')
+        logger.critical('  --rri  set roll rotation rate PID I gain')
+        logger.critical('  --rrd  set roll rotation rate PID D gain')
+        logger.critical('  --yrp  set yaw rotation rate PID P gain')
+        logger.critical('  --yri  set yaw rotation rate PID I gain')
+        logger.critical('  --yrd  set yaw rotation rate PID D gain')
+        logger.critical('  --alpf set the accelerometer low pass filter')
+        logger.critical('  --glpf set the gyroscope low pass filter')
+        logger.critical('  --rtp  set the rate PID / ESC task period in IMU samples')
+        logger.critical('  --atp  set the attitude / velocity estimation task period in IMU samples')
+        logger.critical('  --vtp  set the velocity PID task period in IMU samples')
+        logger.critical('  --fpp  set the flight plan task period in IMU samples')
+        logger.critical('  --ekf  use the extended Kalman filter for attitude and velocity')
+        logger.critical('  --wdt  set the motion loop watchdog deadline in ms')
+        logger.critical('  --prof ?? profile the flight sampling at ?? Hz (or toggle with SIGUSR2), ~300Hz at best on Python 3')
+        logger.critical('  --nogc disable the cyclic garbage collector for the flight')
+        logger.critical('  --gbt  track the gyro bias while still, starting from the last flight\'s')
+        logger.critical('  --cap ?? capture the raw IMU samples, the last ?? seconds of them')
+        logger.critical('  --notch ??:??[,axis=??...] notch motor vibration tracked between ?? and ??Hz; axis (ax - gz) =?? fixes that axis\' notch at ??Hz, or 0 for off')
+        logger.critical('  --mag ?? correct the yaw angle from the magnetometer with a ?? second time constant')
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-f':
+            cli_fly = True
+
+        elif opt in '-h':
+            cli_hover_target = int(arg)
+            hover_target_defaulted = False
+
+        elif opt in '-v':
+            cli_video = True
+
+        elif opt in '-g':
+            cli_calibrate_gravity = True
+
+        elif opt in '-d':
+            cli_diagnostics = True
+
+        elif opt in '-r':
+            cli_rtf_period = float(arg)
+
+        elif opt in '--tc':
+            cli_test_case = int(arg)
+
+        elif opt in '--tau':
+            cli_tau = float(arg)
+
+        elif opt in '--vvp':
+            cli_vvp_gain = float(arg)
+
+        elif opt in '--vvi':
+            cli_vvi_gain = float(arg)
+
+        elif opt in '--vvd':
+            cli_vvd_gain = float(arg)
+
+        elif opt in '--hvp':
+            cli_hvp_gain = float(arg)
+
+        elif opt in '--hvi':
+            cli_hvi_gain = float(arg)
+
+        elif opt in '--hvd':
+            cli_hvd_gain = float(arg)
+
+        elif opt in '--prp':
+            cli_prp_gain = float(arg)
+            prp_set = True
+
+        elif opt in '--pri':
+            cli_pri_gain = float(arg)
+            pri_set = True
+
+        elif opt in '--prd':
+            cli_prd_gain = float(arg)
+            prd_set = True
+
+        elif opt in '--rrp':
+            cli_rrp_gain = float(arg)
+            rrp_set = True
+
+        elif opt in '--rri':
+            cli_rri_gain = float(arg)
+            rri_set = True
+
+        elif opt in '--rrd':
+            cli_rrd_gain = float(arg)
+            rrd_set = True
+
+        elif opt in '--yrp':
+            cli_yrp_gain = float(arg)
+            yrp_set = True
+
+        elif opt in '--yri':
+            cli_yri_gain = float(arg)
+            yri_set = True
+
+        elif opt in '--yrd':
+            cli_yrd_gain = float(arg)
+            yrd_set = True
+
+        elif opt in '--alpf':
+            cli_alpf = int(arg)
+
+        elif opt in '--glpf':
+            cli_glpf = int(arg)
+
+        elif opt in '--dd':
+            cli_diagnostics_rate = int(arg)
+
+        elif opt in '--rtp':
+            cli_rate_period = int(arg)
+
+        elif opt in '--atp':
+            cli_attitude_period = int(arg)
+
+        elif opt in '--vtp':
+            cli_velocity_period = int(arg)
+
+        elif opt in '--fpp':
+            cli_plan_period = int(arg)
+
+        elif opt in '--ekf':
+            cli_ekf = True
+
+        elif opt in '--wdt':
+            cli_watchdog_deadline = float(arg) / 1000
+
+        elif opt in '--prof':
+            cli_profile_rate = int(arg)
+
+        elif opt in '--nogc':
+            cli_gc_off = True
+
+        elif opt in '--rls':
+            cli_calibrate_temperature = True
+
+        elif opt in '--gbt':
+            cli_gyro_tracking = True
+
+        elif opt in '--cap':
+            cli_capture_time = float(arg)
+
+        elif opt in '--notch':
+            fields = arg.split(',')
+            min_hz, max_hz = [float(hz) for hz in fields[0].split(':')]
+            fixed_axes = {}
+            for field in fields[1:]:
+                axis, hz = field.split('=')
+                fixed_axes[NOTCH_AXES.index(axis)] = float(hz)
+            cli_notch = (min_hz, max_hz, fixed_axes)
+
+        elif opt in '--mag':
+            cli_compass_tau = float(arg)
+
+    if not cli_fly and not cli_calibrate_gravity and not cli_calibrate_temperature and cli_test_case == 0:
+        logger.critical('Must specify one of -f or --tc')
+        sys.exit(2)
+
+    elif cli_diagnostics_rate < 1:
+        logger.critical('Diagnostics rate must be 1 or more motion loops')
+        sys.exit(2)
+
+    elif cli_rate_period < 1 or cli_attitude_period % cli_rate_period or cli_velocity_period % cli_rate_period or cli_plan_period % cli_rate_period:
+        logger.critical('Task periods must be multiples of the rate task period')
+        sys.exit(2)
+
+    elif cli_profile_rate < 0 or cli_profile_rate > 1000:
+        logger.critical('Profiler rate must lie in the range 0 (SIGUSR2 only) to 1000Hz')
+        sys.exit(2)
+
+    elif cli_watchdog_deadline <= 0.0:
+        logger.critical('Watchdog deadline must be more than 0ms')
+        sys.exit(2)
+
+    elif cli_capture_time < 0.0:
+        logger.critical('IMU capture time must be 0 (off) or more seconds')
+        sys.exit(2)
+
+    elif cli_notch is not None and not (0.0 < cli_notch[0] < cli_notch[1] < 500.0 and all(0.0 <= hz < 500.0 for hz in cli_notch[2].values())):
+        logger.critical('Notch frequencies must lie below the IMU\'s 500Hz Nyquist frequency, tracked from min to max')
+        sys.exit(2)
+
+    elif cli_compass_tau < 0.0:
+        logger.critical('Magnetometer time constant must be 0 (off) or more seconds')
+        sys.exit(2)
+
+    elif cli_fly and cli_calibrate_temperature:
+        logger.critical('Calibrating the temperature model (--rls) and flight (-f) are exclusive')
+        sys.exit(2)
+
+    elif cli_hover_target < 0 or cli_hover_target > 1000:
+        logger.critical('Hover speed must lie in the following range')
+        logger.critical('0 <= hover speed <= 1000')
+        sys.exit(2)
+
+    elif cli_test_case == 0 and cli_fly:
+        logger.critical('Pre-flight checks passed, enjoy your flight, sir!')
+
+    elif cli_test_case == 0 and cli_calibrate_gravity:
+        logger.critical('Calibrate gravity is it, sir!')
+        cli_alpf = 6
+
+    elif cli_test_case == 0 and cli_calibrate_temperature:
+        logger.critical('Calibrate the temperature model it is, sir!  Sit me level and Ctrl-C when done.')
+
+    elif cli_test_case == 0:
+        logger.critical('You must specify flight (-f) or gravity calibration (-g)')
+        sys.exit(2)
+
+    elif cli_fly or cli_calibrate_gravity or cli_calibrate_temperature:
+        logger.critical('Choose a specific test case (--tc) or fly (-f) or calibrate gravity (-g) or the temperature model (--rls)')
+        sys.exit(2)
+
+    elif cli_test_case < 1 or cli_test_case > 3:
+        logger.critical('Only 1, 2 or 3 are valid testcases')
+        sys.exit(2)
+
+    elif cli_test_case == 1 and hover_target_defaulted:
+        logger.critical('You must choose a specific hover speed (-h) for test case 1 - try 200')
+        sys.exit(2)
+
+
+    return cli_calibrate_gravity, cli_fly, cli_hover_target, cli_video, cli_vvp_gain, cli_vvi_gain, cli_vvd_gain, cli_hvp_gain, cli_hvi_gain, cli_hvd_gain, cli_prp_gain, cli_pri_gain, cli_prd_gain, cli_rrp_gain, cli_rri_gain, cli_rrd_gain, cli_yrp_gain, cli_yri_gain, cli_yrd_gain, cli_test_case, cli_alpf, cli_glpf, cli_rtf_period, cli_tau, cli_diagnostics, cli_diagnostics_rate, cli_rate_period, cli_attitude_period, cli_velocity_period, cli_plan_period, cli_ekf, cli_watchdog_deadline, cli_profile_rate, cli_gc_off, cli_calibrate_temperature, cli_gyro_tracking, cli_capture_time, cli_notch, cli_compass_tau
+
+####################################################################################################
+#
+# Shutdown triggered by early Ctrl-C or end of script
+#
+####################################################################################################
+def CleanShutdown():
+
+    #-----------------------------------------------------------------------------------------------
+    # Stop the signal handler
+    #-----------------------------------------------------------------------------------------------
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    #-----------------------------------------------------------------------------------------------
+    # Stop profiling the shutdown
+    #-----------------------------------------------------------------------------------------------
+    if profiler is not None:
+        profiler.shutdown()
+
+    #-----------------------------------------------------------------------------------------------
+    # Stop the watchdog, letting it finish any failsafe descent, then stop the blades spinning
+    #-----------------------------------------------------------------------------------------------
+    if watchdog is not None:
+        watchdog.stop()
+
+    for esc in esc_list:
+        esc.update(0)
+
+    #-----------------------------------------------------------------------------------------------
+    # Stop the video if it's running
+    #-----------------------------------------------------------------------------------------------
+    if shoot_video:
+        video.send_signal(signal.SIGINT)
+
+    #-----------------------------------------------------------------------------------------------
+    # If the sensor data acquisition is running, then stop it
+    #-----------------------------------------------------------------------------------------------
+    if sensordata is not None:
+        logger.critical("lps: %f", flight_state.loop_count / flight_state.elapsed_time)
+        sensordata.go = False;
+
+        #-------------------------------------------------------------------------------------------
+        # Record where the flight ended up
+        #-------------------------------------------------------------------------------------------
+        flight_state.report()
+
+    #-----------------------------------------------------------------------------------------------
+    # Report whether each task's rate fitted its CPU budget
+    #-----------------------------------------------------------------------------------------------
+    if scheduler is not None:
+        scheduler.report()
+
+    #-----------------------------------------------------------------------------------------------
+    # Report where the notch filters ended up
+    #-----------------------------------------------------------------------------------------------
+    if notch_bank is not None:
+        notch_bank.report()
+
+    #-----------------------------------------------------------------------------------------------
+    # Report how the magnetometer did correcting the yaw angle
+    #-----------------------------------------------------------------------------------------------
+    if compass is not None:
+        compass.report()
+
+    #-----------------------------------------------------------------------------------------------
+    # Record MPU6050 / i2c bus data misses.
+    #-----------------------------------------------------------------------------------------------
+    if mpu6050 is not None:
+        mpu6050_misses, i2c_misses = mpu6050.getMisses()
+        logger.critical("mpu6050 %d misses, i2c %d misses", mpu6050_misses, i2c_misses)
+        mpu6050.i2c.report()
+
+    if data_ready is not None:
+        data_ready.report()
+
+    if imu_capture is not None:
+        mpu6050.capture = None
+        imu_capture.close()
+        imu_capture.report()
+
+    #-----------------------------------------------------------------------------------------------
+    # Report the motion loop stalls the watchdog saw
+    #-----------------------------------------------------------------------------------------------
+    if watchdog is not None:
+        watchdog.report()
+
+    if profiler is not None and profiler.samples:
+        profiler.report()
+
+    if gc_frozen:
+        GCRelease()
+
+    #-----------------------------------------------------------------------------------------------
+    # Fold the tracked gyro bias into the gyro offsets and save them for the next flight to start
+    # from.
+    #-----------------------------------------------------------------------------------------------
+    if gyro_bias is not None:
+        gyro_bias.report()
+        mpu6050.adjustGyroOffsets(gyro_bias.bias)
+        mpu6050.saveGyroOffsets(GYRO_OFFSETS_FILE)
+
+    #-----------------------------------------------------------------------------------------------
+    # Save the temperature model if calibrating it
+    #-----------------------------------------------------------------------------------------------
+    if temperature_model is not None and temperature_model.samples:
+        temperature_model.report()
+        if temperature_model.save(TEMPERATURE_MODEL_FILE):
+            logger.critical("Temperature model saved to %s", TEMPERATURE_MODEL_FILE)
+
+    #-----------------------------------------------------------------------------------------------
+    # Let the logger process flush and exit, then copy logs from /dev/shm (shared / virtual memory)
+    # to the Logs directory.  Older rotated logs get a numeric suffix, oldest first.
+    #-----------------------------------------------------------------------------------------------
+    log_sink.stop()
+
+    from datetime import datetime
+    import shutil
+
+    now = datetime.now()
+    now_string = now.strftime("%y%m%d-%H:%M:%S")
+    shm_log_files = log_sink.files()
+    for shm_index, shm_log_file in enumerate(shm_log_files):
+        if shm_index == len(shm_log_files) - 1:
+            log_file_name = "qcstats" + now_string + ".csv"
+        else:
+            log_file_name = "qcstats" + now_string + "-" + str(shm_index) + ".csv"
+        shutil.move(shm_log_file, log_file_name)
+
+    #-----------------------------------------------------------------------------------------------
+    # Likewise the raw IMU capture
+    #-----------------------------------------------------------------------------------------------
+    if imu_capture is not None:
+        shutil.move(imu_capture.file_name, "qcimu" + now_string + ".bin")
+
+    #-----------------------------------------------------------------------------------------------
+    # Save the profile as collapsed stacks for flamegraph.pl
+    #-----------------------------------------------------------------------------------------------
+    if profiler is not None and profiler.samples:
+        profiler.write("qcprofile" + now_string + ".folded")
+
+    #-----------------------------------------------------------------------------------------------
+    # Unlock memory we've used from RAM
+    #-----------------------------------------------------------------------------------------------
+    munlockall()
+
+    #-----------------------------------------------------------------------------------------------
+    # Clean up PWM / GPIO, but pause beforehand to give the ESCs time to stop properly
+    #-----------------------------------------------------------------------------------------------
+    time.sleep(1.0)
+    RpioCleanup()
+
+    #-----------------------------------------------------------------------------------------------
+    # Reset the signal handler to default
+    #-----------------------------------------------------------------------------------------------
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    sys.exit(0)
+
+####################################################################################################
+#
+# Signal handler for Ctrl-C => abort cleanly
+#
+####################################################################################################
+def ShutdownSignalHandler(signal, frame):
+    global SIG_SHUTDOWN
+
+    if not flight_state.keep_looping:
+        CleanShutdown()
+    flight_state.keep_looping = False
+    flight_state.woken_by = SIG_SHUTDOWN
+
+####################################################################################################
+#
+# Signal handler to switch the profiler on / off
+#
+####################################################################################################
+def ProfilerSignalHandler(signal, frame):
+    profiler.toggle()
+
+####################################################################################################
+#
+# Signal handler for new data ready to process
+#
+####################################################################################################
+def DataReadySignalHandler(signal, frame):
+    global SIG_DATA_READY
+
+    #-----------------------------------------------------------------------------------------------
+    # This does nothing other than wake the main thread up
+    #-----------------------------------------------------------------------------------------------
+    flight_state.woken_by = SIG_DATA_READY
+
+####################################################################################################
+#
+# Flight plan management
+#
+####################################################################################################
+class FlightPlan:
+
+    #-----------------------------------------------------------------------------------------------
+    # The flight plan - move to file at some point to allow various FP's to be saved, and selected
+    # per flight.
+    #-----------------------------------------------------------------------------------------------
+    fp_evx_target  = [0.0,       0.0,       0.0,       0.0,       0.0]
+    fp_evy_target  = [0.0,       0.0,       0.0,       0.0,       0.0]
+    fp_evz_target  = [0.0,       0.75,       0.0,      -0.75,       0.0]
+    fp_time        = [0.0,       2.0,       5.0,       2.0,       0.0]
+    fp_name        = ["RTF",  "ASCENT",   "HOVER", "DESCENT",    "STOP"]
+    _FP_STEPS = 5
+
+    def __init__(self):
+
+        self.fp_index = 0
+        self.fp_prev_index = 0
+        self.elapsed_time = 0.0
+        self.finished = False
+
+
+    def getTargets(self, delta_time):
+        self.elapsed_time += delta_time
+
+        fp_total_time = 0.0
+        for fp_index in range(0, self._FP_STEPS):
+            fp_total_time += self.fp_time[fp_index]
+            if self.elapsed_time < fp_total_time:
+                break
+        else:
+            self.finished = True
+
+        if fp_index != self.fp_prev_index:
+            logger.critical("%s", self.fp_name[fp_index])
+            self.fp_prev_index = fp_index
+
+        return self.fp_evx_target[fp_index], self.fp_evy_target[fp_index], self.fp_evz_target[fp_index]
+
+####################################################################################################
+#
+# Control modes: strategies for what the flight plan and velocity tasks make of the estimated
+# motion, and optionally a replacement for the rate PIDs and mixer.  The mode's chosen at startup
+# by the test case, and the ControlLoop calls the active one's stages directly, so there's no mode
+# checking on the flight path.
+#
+# - VelocityHold: the velocity PIDs' outputs set the pitch and roll rate targets to fly the plan
+# - AttitudeLevel: the angle PIDs hold the quad level regardless of the take-off platform's angle
+# - RateTuning: the rate PIDs hold zero rotation rates, for tuning their gains (testcase 2)
+# - MotorSpin: each motor spins up in turn to check it turns the right way (testcase 1)
+#
+# Each mode lists the PIDs it uses in 'pids'; when it takes over, those the previous mode didn't
+# use start afresh rather than from whatever state they were left in.  Modes that fly can also
+# take over from each other in flight (see ControlLoop.setMode()), when a Handover blends the
+# previous mode's rate targets into the new one's.
+#
+####################################################################################################
+HANDOVER_TIME = 0.5
+
+class ControlMode(object):
+
+    name = "control"
+    in_flight = True
+    pids = ()
+    rate = None
+
+    def __init__(self):
+        self.control_loop = None
+        self.flight_state = None
+
+    def enter(self, control_loop, previous):
+        self.control_loop = control_loop
+        self.flight_state = control_loop.flight_state
+        for index in self.pids:
+            if previous is None or index not in previous.pids:
+                control_loop.pids[index].reset()
+
+    def plan(self, p_time):
+        #-------------------------------------------------------------------------------------------
+        # Get the curent flight plan targets, once the blades are up to hover speed.
+        #-------------------------------------------------------------------------------------------
+        control_loop = self.control_loop
+        fs = self.flight_state
+        if not control_loop.ready_to_fly:
+            if fs.hover_speed >= control_loop.hover_target:
+                fs.hover_speed = control_loop.hover_target
+                control_loop.ready_to_fly = True
+
+                #-----------------------------------------------------------------------------------
+                # Register the flight plan with the authorities
+                #-----------------------------------------------------------------------------------
+                control_loop.fp = FlightPlan()
+
+            else:
+                fs.hover_speed += int(control_loop.hover_target * p_time / control_loop.rtf_period)
+
+        else:
+            fs.evx_target, fs.evy_target, fs.evz_target = control_loop.fp.getTargets(p_time)
+            if control_loop.fp.finished:
+                fs.keep_looping = False
+
+    def velocity(self, v_time):
+        #-------------------------------------------------------------------------------------------
+        # Run the mode's PIDs and set the vertical PWM and rate targets through vertical() and
+        # rates().  By default nothing changes, so the rate PIDs hold the targets already set.
+        #-------------------------------------------------------------------------------------------
+        pass
+
+    def vertical(self, qvz_out):
+        #-------------------------------------------------------------------------------------------
+        # Convert the vertical velocity PID output direct to PWM pulse width.
+        #-------------------------------------------------------------------------------------------
+        fs = self.flight_state
+        fs.qvz_out = qvz_out
+        fs.vert_out = fs.hover_speed + int(round(qvz_out))
+
+    def rates(self, pr_target, rr_target, yr_target):
+        fs = self.flight_state
+        fs.pr_target = pr_target
+        fs.rr_target = rr_target
+        fs.yr_target = yr_target
+
+
+class VelocityHold(ControlMode):
+
+    name = "velocity hold"
+    pids = (PID_QVX, PID_QVY, PID_QVZ, PID_YA)
+
+    def velocity(self, v_time):
+        fs = self.flight_state
+        pa = fs.pa
+        ra = fs.ra
+        ya = fs.ya
+
+        #-------------------------------------------------------------------------------------------
+        # Convert earth-frame velocity targets to quadcopter frame.
+        #-------------------------------------------------------------------------------------------
+        qvx_target, qvy_target, qvz_target = RotateE2Q(fs.evx_target, fs.evy_target, fs.evz_target, pa, ra, ya)
+        fs.qvx_target = qvx_target
+        fs.qvy_target = qvy_target
+        fs.qvz_target = qvz_target
+
+        #===========================================================================================
+        # Motion PIDs: Run the horizontal speed PIDs each rotation axis to determine targets for
+        # absolute angle PIDs and the verical speed PID to control height.  For the moment, we just
+        # want yaw to not exist, so the yaw angle PID target is zero.  It's only required if we want
+        # the front of the quad to face the direction it's travelling.
+        #===========================================================================================
+        pids = self.control_loop.pids
+        qvx_out = pids[PID_QVX].Compute(fs.qvx_input, qvx_target, v_time)
+        qvy_out = pids[PID_QVY].Compute(fs.qvy_input, qvy_target, v_time)
+        qvz_out = pids[PID_QVZ].Compute(fs.qvz_input, qvz_target, v_time)
+        yr_target = pids[PID_YA].Compute(ya, 0.0, v_time)
+
+        #-------------------------------------------------------------------------------------------
+        # Convert the horizontal velocity PID output i.e. the horizontal acceleration target in q's
+        # into the pitch and roll angle PID targets in radians
+        # - A forward unintentional drift is a positive input and negative output from the velocity
+        #   PID.  This represents corrective acceleration.  To achieve corrective backward
+        #   acceleration, the negative velocity PID output needs to trigger a negative pitch
+        #   rotation rate
+        # - A left unintentional drift is a positive input and negative output from the velocity
+        #   PID.  To achieve corrective right acceleration, the negative velocity PID output needs
+        #   to trigger a positive roll rotation rate
+        #
+        # Use a bit of hokey trigonometry to convert desired quad frame acceleration (qv*_out) into
+        # the target quad frame angle that provides that acceleration (*a_target
+        #-------------------------------------------------------------------------------------------
+        self.vertical(qvz_out)
+        self.rates(math.atan(qvx_out), -math.atan(qvy_out), yr_target)
+
+
+class AttitudeLevel(ControlMode):
+
+    name = "attitude level"
+    pids = (PID_QVZ, PID_YA, PID_PA, PID_RA)
+
+    def velocity(self, v_time):
+        #-------------------------------------------------------------------------------------------
+        # Instead of the horizontal velocity PIDs, the angle PIDs hold the quad level regardless of
+        # the take-off platform's angle; the vertical speed and yaw angle PIDs work as usual.
         #-------------------------------------------------------------------------------------------
-        cli_yrp_gain = 30.0
-        cli_yri_gain = 0.0
-        cli_yrd_gain = 0.0
+        fs = self.flight_state
+        qvz_target = RotateE2Q(fs.evx_target, fs.evy_target, fs.evz_target, fs.pa, fs.ra, fs.ya)[2]
+        fs.qvz_target = qvz_target
 
-    elif i_am_zoe:
+        pids = self.control_loop.pids
+        self.vertical(pids[PID_QVZ].Compute(fs.qvz_input, qvz_target, v_time))
+        self.rates(pids[PID_PA].Compute(fs.pa, 0.0, v_time), pids[PID_RA].Compute(fs.ra, 0.0, v_time), pids[PID_YA].Compute(fs.ya, 0.0, v_time))
+
+
+class RateTuning(ControlMode):
+
+    name = "rate tuning"
+    pids = (PID_QVZ,)
+
+    def velocity(self, v_time):
         #-------------------------------------------------------------------------------------------
-        # Phoebe's PID configuration due to using her ESCs / motors / props
+        # Take-off from a horizontal platform with the rate targets fixed at zero, to tune the
+        # pr*_gain and rr*_gain PID gains for stability; only the vertical speed is controlled.
         #-------------------------------------------------------------------------------------------
-        cli_hover_target = 600
+        fs = self.flight_state
+        qvz_target = RotateE2Q(fs.evx_target, fs.evy_target, fs.evz_target, fs.pa, fs.ra, fs.ya)[2]
+        fs.qvz_target = qvz_target
+
+        self.vertical(self.control_loop.pids[PID_QVZ].Compute(fs.qvz_input, qvz_target, v_time))
+        self.rates(0.0, 0.0, 0.0)
+
 
+class MotorSpin(ControlMode):
+
+    name = "motor spin"
+    in_flight = False
+
+    def __init__(self, spin_target, names = None, ramp_time = 1.0, spin_time = 5.0):
+        ControlMode.__init__(self)
+        self.spin_target = spin_target
+        self.names = names
+        self.ramp_time = ramp_time
+        self.spin_time = spin_time
+
+    def enter(self, control_loop, previous):
+        ControlMode.enter(self, control_loop, previous)
+        self.outputs = [0] * len(control_loop.motor_outputs)
+        self.motor = -1
+        self.elapsed_time = self.ramp_time + self.spin_time
+
+    def plan(self, p_time):
         #-------------------------------------------------------------------------------------------
-        # Defaults for vertical velocity PIDs
+        # Spin up each blade in turn to the spin target, hold it there, and stop it before moving
+        # on to the next; the loop ends after the last.
         #-------------------------------------------------------------------------------------------
-        cli_vvp_gain = 360.0
-        cli_vvi_gain = 180.0
-        cli_vvd_gain = 0.0
+        outputs = self.outputs
+        self.elapsed_time += p_time
+        if self.elapsed_time >= self.ramp_time + self.spin_time:
+            outputs[self.motor] = 0
+            self.motor += 1
+            self.elapsed_time = 0.0
+            if self.motor == len(outputs):
+                self.motor = 0
+                self.flight_state.keep_looping = False
+                return
 
+            name = "motor %d" % self.motor if self.names is None else self.names[self.motor]
+            logger.critical("%s prop should rotate %s.", name, "clockwise" if self.control_loop.yaw_mix[self.motor] == 1 else "anti-clockwise")
+
+        outputs[self.motor] = int(self.spin_target * min(1.0, self.elapsed_time / self.ramp_time))
+
+    def rate(self, qrx, qry, qrz, dt):
+        return self.outputs
+
+
+class Handover(ControlMode):
+
+    def __init__(self, mode, handover_time):
+        self.mode = mode
+        self.name = mode.name
+        self.pids = mode.pids
+        self.rate = mode.rate
+        self.handover_time = handover_time
+        ControlMode.__init__(self)
+
+    def enter(self, control_loop, previous):
         #-------------------------------------------------------------------------------------------
-        # Defaults for horizontal velocity PIDs
+        # The new mode's rate targets start offset to where the previous mode left them, and the
+        # offset fades out over the handover time; then the new mode takes over for real.
         #-------------------------------------------------------------------------------------------
-        cli_hvp_gain = 0.6
-        cli_hvi_gain = 0.4
-        cli_hvd_gain = 0.1
+        ControlMode.enter(self, control_loop, previous)
+        self.mode.enter(control_loop, previous)
+        fs = self.flight_state
+        self.previous_targets = (fs.pr_target, fs.rr_target, fs.yr_target)
+        self.offsets = None
+        self.elapsed_time = 0.0
+
+    def plan(self, p_time):
+        self.mode.plan(p_time)
+
+    def velocity(self, v_time):
+        fs = self.flight_state
+        self.mode.velocity(v_time)
+        if self.offsets is None:
+            previous_targets = self.previous_targets
+            self.offsets = (previous_targets[0] - fs.pr_target, previous_targets[1] - fs.rr_target, previous_targets[2] - fs.yr_target)
+
+        self.elapsed_time += v_time
+        if self.elapsed_time >= self.handover_time:
+            logger.critical("%s control mode handover complete", self.name)
+            self.control_loop.activate(self.mode)
+            return
+
+        remaining = 1.0 - self.elapsed_time / self.handover_time
+
+        offsets = self.offsets
+        fs.pr_target += offsets[0] * remaining
+        fs.rr_target += offsets[1] * remaining
+        fs.yr_target += offsets[2] * remaining
 
+####################################################################################################
+#
+# The motion processing engine: attitude and velocity estimation, the flight plan, the PIDs and the
+# motor mixer, run by the multi-rate task scheduler.  step() takes a batch of averaged sensor data
+# and the time it covers and returns the spin rate for each motor.  It touches no hardware, so the
+# same flight code can be driven by go() from the MPU6050 and ESCs, or by simulated or replayed
+# data e.g. from qcbench.py.
+#
+####################################################################################################
+class ControlLoop:
+
+    _ZEROS = (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+    def __init__(self, flight_state, gains, motors, sample_rate, rate_period, attitude_period, velocity_period, plan_period, tau, hover_target, rtf_period, mode, use_ekf, grav_accel, scale = None, gyro_bias = None, compass = None):
         #-------------------------------------------------------------------------------------------
-        # Defaults for pitch angle PIDs
+        # Everything the flight loop works out is held in the flight state.  'scale' converts the
+        # raw sensor batch to g's and radians per second; without it the batch is already scaled.
+        # 'gyro_bias' is a GyroBiasTracker whose bias is taken off the scaled gyro rates, and which
+        # the attitude task updates.  'compass' is a Compass the attitude task corrects the yaw
+        # angle with.  'mode' is the ControlMode to start in.
         #-------------------------------------------------------------------------------------------
-        cli_prp_gain = 120.0
-        cli_pri_gain = 60.0
-        cli_prd_gain = 0.0
+        self.flight_state = flight_state
+        self.scale = scale
+        self.gyro_bias = gyro_bias
+        self.compass = compass
+
+        self.rate_period = rate_period
+        self.tau = tau
+        self.hover_target = hover_target
+        self.rtf_period = rtf_period
+        self.use_ekf = use_ekf
+        self.grav_accel = grav_accel
 
         #-------------------------------------------------------------------------------------------
-        # Defaults for roll angle PIDs
+        # The PIDs, gains ordered as per PID_QVX etc.  The control mode runs the PIDs it uses in the
+        # velocity task, and the rate task runs the rate PIDs.  The PID bank's only made for PIDs
+        # given options by configurePID().
         #-------------------------------------------------------------------------------------------
-        cli_rrp_gain = 110.0
-        cli_rri_gain = 55.0
-        cli_rrd_gain = 0.0
+        self.gains = gains
+        self.pids = [PID(p_gain, i_gain, d_gain) for p_gain, i_gain, d_gain in gains]
+        self.pid_bank = None
 
         #-------------------------------------------------------------------------------------------
-        # Defaults for yaw angle PIDs
+        # The butterworth LP filters run in the attitude task, so at the sample rate / attitude
+        # period e.g. 50Hz.  The warm-up in go() primes them before flight.
         #-------------------------------------------------------------------------------------------
-        cli_yrp_gain = 60.0
-        cli_yri_gain = 30.0
-        cli_yrd_gain = 0.0
+        self.bfx = BUTTERWORTH(sample_rate / attitude_period, 0.20, 4, 0.0)
+        self.bfy = BUTTERWORTH(sample_rate / attitude_period, 0.20, 4, 0.0)
+        self.bfz = BUTTERWORTH(sample_rate / attitude_period, 0.20, 4, 1.0)
+        self.ekf = None
 
-    elif i_am_hog:
         #-------------------------------------------------------------------------------------------
-        # Chloe's PID configuration due to using her frame / ESCs / motors / props
+        # The rate PIDs and mixer run every step, the rest at integer divisors of that rate.
         #-------------------------------------------------------------------------------------------
-        cli_hover_target = 500
+        self.scheduler = Scheduler(1.0 / sample_rate)
+        self.rate_task = self.scheduler.addTask("rate", rate_period)
+        self.attitude_task = self.scheduler.addTask("attitude", attitude_period)
+        self.velocity_task = self.scheduler.addTask("velocity", velocity_period)
+        self.plan_task = self.scheduler.addTask("plan", plan_period)
 
         #-------------------------------------------------------------------------------------------
-        # Defaults for vertical velocity PIDs
+        # Mixer: for each motor, the sign with which the pitch, roll and yaw rate PID outputs apply
+        # given its location and rotation.
+        # - For a left downwards roll, the x gyro goes negative, so the PID error is positive,
+        #   meaning PID output is positive, meaning this needs to be added to the left blades and
+        #   subtracted from the right.
+        # - For a forward downwards pitch, the y gyro goes positive The PID error is negative as a
+        #   result, meaning PID output is negative, meaning this needs to be subtracted from the
+        #   front blades and added to the back.
+        # - For CW yaw, the z gyro goes negative, so the PID error is postitive, meaning PID output
+        #   is positive, meaning this need to be added to the ACW (FL and BR) blades and subtracted
+        #   from the CW (FR & BL) blades.
         #-------------------------------------------------------------------------------------------
-        cli_vvp_gain = 360.0      # 300 on GitHub
-        cli_vvi_gain = 180.0
-        cli_vvd_gain = 0.0
+        self.roll_mix = [-1 if location & MOTOR_LOCATION_RIGHT else 1 for location, rotation in motors]
+        self.pitch_mix = [1 if location & MOTOR_LOCATION_BACK else -1 for location, rotation in motors]
+        self.yaw_mix = [1 if rotation == MOTOR_ROTATION_CW else -1 for location, rotation in motors]
+        self.motor_outputs = [0] * len(motors)
 
         #-------------------------------------------------------------------------------------------
-        # Defaults for horizontal velocity PIDs
+        # Sensor batches averaged between attitude task runs, and the take-off state
         #-------------------------------------------------------------------------------------------
-        cli_hvp_gain = 0.6
-        cli_hvi_gain = 0.3
-        cli_hvd_gain = 0.1
+        self.averaged = list(self._ZEROS)
+        self.averaged_count = 0
+        self.ready_to_fly = False
+        self.fp = None
 
         #-------------------------------------------------------------------------------------------
-        # Defaults for pitch angle PIDs
+        # The control mode, which the flight plan, velocity and rate tasks call on
         #-------------------------------------------------------------------------------------------
-        cli_prp_gain = 100.0      # 80 on GitHub
-        cli_pri_gain = 50.0
-        cli_prd_gain = 0.0
+        self.started = False
+        self.mode = None
+        self.setMode(mode)
 
+    def configurePID(self, index, i_limit = 0.0, d_on_measurement = False, d_tau = 0.0, output_limit = 0.0):
         #-------------------------------------------------------------------------------------------
-        # Defaults for roll angle PIDs
+        # Give a PID the PID bank's options (see PIDBank.configure()), moving it onto the bank
+        # afresh; the PIDs left without options stay as they are.
         #-------------------------------------------------------------------------------------------
-        cli_rrp_gain = 90.0       # 75 on GitHub
-        cli_rri_gain = 45.0
-        cli_rrd_gain = 0.0
+        if self.pid_bank is None:
+            self.pid_bank = PIDBank(self.gains)
+        self.pid_bank.configure(index, i_limit, d_on_measurement, d_tau, output_limit)
+        self.pid_bank.reset((index,))
+        self.pids[index] = BankedPID(self.pid_bank, index)
 
+    def setMode(self, mode, handover_time = HANDOVER_TIME):
         #-------------------------------------------------------------------------------------------
-        # Defaults for yaw angle PIDs
+        # Switch to a new control mode, returning whether it's taken over.  Before start() the
+        # switch is immediate; after, the motors are live, so both modes must be able to fly, and
+        # the new one takes over through a Handover at the next velocity task.
         #-------------------------------------------------------------------------------------------
-        cli_yrp_gain = 50.0       # 45 on GitHub
-        cli_yri_gain = 25.0
-        cli_yrd_gain = 0.0
-
-
-    #-----------------------------------------------------------------------------------------------
-    # Other configuration defaults
-    #-----------------------------------------------------------------------------------------------
-    cli_test_case = 0
-    cli_alpf = 3
-    cli_glpf = 1
-    cli_diagnostics = False
-    cli_rtf_period = 1.0
-    cli_tau = 0.5
-
-    hover_target_defaulted = True
-    prp_set = False
-    pri_set = False
-    prd_set = False
-    rrp_set = False
-    rri_set = False
-    rrd_set = False
-    yrp_set = False
-    yri_set = False
-    yrd_set = False
-
-    #-----------------------------------------------------------------------------------------------
-    # Right, let's get on with reading the command line and checking consistency
-    #-----------------------------------------------------------------------------------------------
-    try:
-        opts, args = getopt.getopt(argv,'dfgvh:r:', ['tc=', 'tau=', 'vvp=', 'vvi=', 'vvd=', 'hvp=', 'hvi=', 'hvd=', 'prp=', 'pri=', 'prd=', 'rrp=', 'rri=', 'rrd=', 'tau=', 'yrp=', 'yri=', 'yrd=', 'alpf=', 'glpf='])
-    except getopt.GetoptError:
-        logger.critical('Must specify one of -f or -g or --tc')
-        logger.critical('  qcpi.py')
-        logger.critical('  -f set whether to fly')
-        logger.critical('  -h set the hover speed for manual testing')
-        logger.critical('  -g calibrate gravity against temperature, save and end')
-        logger.critical('  -d enable diagnostics')
-        logger.critical('  -v video the flight')
-        logger.critical('  -r ??  set the ready-to-fly period')
-        logger.critical('  --tc   select which testcase to run')
-        logger.critical('  --tau ??  set the angle CF -3dB point')
-        logger.critical('  --vvp  set vertical speed PID P gain')
-        logger.critical('  --vvi  set vertical speed PID P gain')
-        logger.critical('  --vvd  set vertical speed PID P gain')
-        logger.critical('  --hvp  set horizontal speed PID P gain')
-        logger.critical('  --hvi  set horizontal speed PID I gain')
-        logger.critical('  --hvd  set horizontal speed PID D gain')
-        logger.critical('  --prp  set pitch rotation rate PID P gain')
-        logger.critical('  --pri  set pitch rotation rate PID I gain')
-        logger.critical('  --prd  set pitch rotation rate PID D gain')
-        logger.critical('  --rrp  set roll rotation rate PID P gain')
-        logger.critical('  --rri  set roll rotation rate PID I gain')
-        logger.critical('  --rrd  set roll rotation rate PID D gain')
-        logger.critical('  --yrp  set yaw rotation rate PID P gain')
-        logger.critical('  --yri  set yaw rotation rate PID I gain')
-        logger.critical('  --yrd  set yaw rotation rate PID D gain')
-        logger.critical('  --alpf set the accelerometer low pass filter')
-        logger.critical('  --glpf set the gyroscope low pass filter')
-        sys.exit(2)
+        if self.started:
+            if not (self.mode.in_flight and mode.in_flight):
+                logger.critical("Can't switch control mode from %s to %s in flight", self.mode.name, mode.name)
+                return False
+            mode = Handover(mode, handover_time)
 
-    for opt, arg in opts:
-        if opt == '-f':
-            cli_fly = True
+        logger.critical("%s control mode", mode.name)
+        mode.enter(self, self.mode)
+        self.activate(mode)
+        return True
 
-        elif opt in '-h':
-            cli_hover_target = int(arg)
-            hover_target_defaulted = False
+    def activate(self, mode):
+        self.mode = mode
+        self.rate_stage = self.rate if mode.rate is None else mode.rate
 
-        elif opt in '-v':
-            cli_video = True
+    def start(self, pa, ra, ya, egx, egy, egz):
+        #-------------------------------------------------------------------------------------------
+        # Start from the take-off surface tilt and gravity found while warming up
+        #-------------------------------------------------------------------------------------------
+        fs = self.flight_state
+        fs.pa = pa
+        fs.ra = ra
+        fs.ya = ya
+        fs.egx = egx
+        fs.egy = egy
+        fs.egz = egz
 
-        elif opt in '-g':
-            cli_calibrate_gravity = True
+        if self.use_ekf:
+            self.ekf = EKF(self.grav_accel)
+            self.ekf.reset(pa, ra, ya)
 
-        elif opt in '-d':
-            cli_diagnostics = True
+        if self.compass is not None:
+            self.compass.reset()
 
-        elif opt in '-r':
-            cli_rtf_period = float(arg)
+        self.started = True
 
-        elif opt in '--tc':
-            cli_test_case = int(arg)
+    def step(self, raw_batch, dt):
+        fs = self.flight_state
 
-        elif opt in '--tau':
-            cli_tau = float(arg)
+        #-------------------------------------------------------------------------------------------
+        # Sort out units and calibration for the incoming data
+        #-------------------------------------------------------------------------------------------
+        if self.scale is None:
+            qax, qay, qaz, qrx, qry, qrz = raw_batch
+        else:
+            qax, qay, qaz, qrx, qry, qrz = self.scale(*raw_batch)
 
-        elif opt in '--vvp':
-            cli_vvp_gain = float(arg)
+        if self.gyro_bias is not None:
+            gyro_bias = self.gyro_bias.bias
+            qrx -= gyro_bias[0]
+            qry -= gyro_bias[1]
+            qrz -= gyro_bias[2]
 
-        elif opt in '--vvi':
-            cli_vvi_gain = float(arg)
+        fs.qax = qax
+        fs.qay = qay
+        fs.qaz = qaz
+        fs.qrx = qrx
+        fs.qry = qry
+        fs.qrz = qrz
+        fs.i_time = dt
 
-        elif opt in '--vvd':
-            cli_vvd_gain = float(arg)
+        scheduler = self.scheduler
+        scheduler.tick(self.rate_period, dt)
 
-        elif opt in '--hvp':
-            cli_hvp_gain = float(arg)
+        #-------------------------------------------------------------------------------------------
+        # Average the batches between attitude task runs
+        #-------------------------------------------------------------------------------------------
+        averaged = self.averaged
+        averaged[0] += qax
+        averaged[1] += qay
+        averaged[2] += qaz
+        averaged[3] += qrx
+        averaged[4] += qry
+        averaged[5] += qrz
+        self.averaged_count += 1
 
-        elif opt in '--hvi':
-            cli_hvi_gain = float(arg)
+        if scheduler.due(self.attitude_task):
+            self.attitude()
 
-        elif opt in '--hvd':
-            cli_hvd_gain = float(arg)
+        if scheduler.due(self.plan_task):
+            self.plan()
 
-        elif opt in '--prp':
-            cli_prp_gain = float(arg)
-            prp_set = True
+        if scheduler.due(self.velocity_task):
+            self.velocity()
 
-        elif opt in '--pri':
-            cli_pri_gain = float(arg)
-            pri_set = True
+        return self.rate_stage(qrx, qry, qrz, dt)
 
-        elif opt in '--prd':
-            cli_prd_gain = float(arg)
-            prd_set = True
+    def attitude(self):
+        #===========================================================================================
+        # Attitude task: angles and velocity estimation
+        #===========================================================================================
+        self.attitude_task.begin()
+        a_time = self.attitude_task.dt
+        fs = self.flight_state
+
+        averaged = self.averaged
+        averaged_count = self.averaged_count
+        aqax = averaged[0] / averaged_count
+        aqay = averaged[1] / averaged_count
+        aqaz = averaged[2] / averaged_count
+        aqrx = averaged[3] / averaged_count
+        aqry = averaged[4] / averaged_count
+        aqrz = averaged[5] / averaged_count
+        averaged[:] = self._ZEROS
+        self.averaged_count = 0
+
+        if self.gyro_bias is not None:
+            self.gyro_bias.update(aqax, aqay, aqaz, aqrx, aqry, aqrz, a_time)
+
+        #-------------------------------------------------------------------------------------------
+        # The EKF estimates angles and velocity directly from the averaged sensors.
+        #-------------------------------------------------------------------------------------------
+        if self.ekf is not None:
+            ekf = self.ekf
+            ekf.predict(aqax, aqay, aqaz, aqrx, aqry, aqrz, a_time)
+            ekf.update(aqax, aqay, aqaz)
+
+            fs.pa = ekf.x[0]
+            fs.ra = ekf.x[1]
+            fs.ya = ekf.x[2]
+            fs.qvx_input = ekf.x[3]
+            fs.qvy_input = ekf.x[4]
+            fs.qvz_input = ekf.x[5]
+            fs.qgx = ekf.qgx
+            fs.qgy = ekf.qgy
+            fs.qgz = ekf.qgz
 
-        elif opt in '--rrp':
-            cli_rrp_gain = float(arg)
-            rrp_set = True
+        else:
+            pa = fs.pa
+            ra = fs.ra
+            ya = fs.ya
 
-        elif opt in '--rri':
-            cli_rri_gain = float(arg)
-            rri_set = True
+            #---------------------------------------------------------------------------------------
+            # Get angles in radians for Euler and quad frame: rotate the accelerometer readings to
+            # earth frame, pass them through the butterworth filter, rotate the new gravity back to
+            # the quad frame, and get the revised angles.
+            #---------------------------------------------------------------------------------------
+            eax, eay, eaz = RotateQ2E(aqax, aqay, aqaz, pa, ra, ya)
+            egx = self.bfx.filter(eax)
+            egy = self.bfy.filter(eay)
+            egz = self.bfz.filter(eaz)
+            qgx, qgy, qgz = RotateE2Q(egx, egy, egz, pa, ra, ya)
+            uap, uar = GetRotationAngles(qgx, qgy, qgz)
 
-        elif opt in '--rrd':
-            cli_rrd_gain = float(arg)
-            rrd_set = True
+            #---------------------------------------------------------------------------------------
+            # Convert the gyro quad-frame rotation rates into the Euler frames rotation rates using
+            # the revised angles from the Butterworth filter
+            #---------------------------------------------------------------------------------------
+            urp, urr, ury = Body2EulerRates(aqry, aqrx, aqrz, uap, uar)
 
-        elif opt in '--yrp':
-            cli_yrp_gain = float(arg)
-            yrp_set = True
+            #---------------------------------------------------------------------------------------
+            # Merge rotation frames angles with a complementary filter and fill in the blanks
+            #---------------------------------------------------------------------------------------
+            tau_fraction = self.tau / (self.tau + a_time)
+            pa = tau_fraction * (pa + urp * a_time) + (1 - tau_fraction) * uap
+            ra = tau_fraction * (ra + urr * a_time) + (1 - tau_fraction) * uar
+            ya += aqrz * a_time
 
-        elif opt in '--yri':
-            cli_yri_gain = float(arg)
-            yri_set = True
+            #---------------------------------------------------------------------------------------
+            # Redistribute gravity around the new orientation of the quad
+            #---------------------------------------------------------------------------------------
+            qgx, qgy, qgz = RotateE2Q(egx, egy, egz, pa, ra, ya)
 
-        elif opt in '--yrd':
-            cli_yrd_gain = float(arg)
-            yrd_set = True
+            #---------------------------------------------------------------------------------------
+            # Delete reorientated gravity from raw accelerometer readings and sum to make velocity
+            # all in quad frame
+            #---------------------------------------------------------------------------------------
+            fs.qvx_input += (aqax - qgx) * a_time * self.grav_accel
+            fs.qvy_input += (aqay - qgy) * a_time * self.grav_accel
+            fs.qvz_input += (aqaz - qgz) * a_time * self.grav_accel
 
-        elif opt in '--alpf':
-            cli_alpf = int(arg)
+            fs.pa = pa
+            fs.ra = ra
+            fs.ya = ya
+            fs.egx = egx
+            fs.egy = egy
+            fs.egz = egz
+            fs.qgx = qgx
+            fs.qgy = qgy
+            fs.qgz = qgz
 
-        elif opt in '--glpf':
-            cli_glpf = int(arg)
+        #-------------------------------------------------------------------------------------------
+        # Pull the yaw angle towards the tilt compensated magnetometer heading
+        #-------------------------------------------------------------------------------------------
+        if self.compass is not None:
+            fs.ya = self.compass.correct(fs.pa, fs.ra, fs.ya, a_time)
+            if self.ekf is not None:
+                self.ekf.x[2] = fs.ya
 
-    if not cli_fly and not cli_calibrate_gravity and cli_test_case == 0:
-        logger.critical('Must specify one of -f or --tc')
-        sys.exit(2)
+        self.attitude_task.end()
 
-    elif cli_hover_target < 0 or cli_hover_target > 1000:
-        logger.critical('Hover speed must lie in the following range')
-        logger.critical('0 <= hover speed <= 1000')
-        sys.exit(2)
+    def plan(self):
+        #===========================================================================================
+        # Flight plan task
+        #===========================================================================================
+        self.plan_task.begin()
+        self.mode.plan(self.plan_task.dt)
+        self.plan_task.end()
 
-    elif cli_test_case == 0 and cli_fly:
-        logger.critical('Pre-flight checks passed, enjoy your flight, sir!')
+    def velocity(self):
+        #===========================================================================================
+        # Velocity task: the control mode turns the motion into rate targets and vertical output
+        #===========================================================================================
+        self.velocity_task.begin()
+        self.mode.velocity(self.velocity_task.dt)
+        self.velocity_task.end()
 
-    elif cli_test_case == 0 and cli_calibrate_gravity:
-        logger.critical('Calibrate gravity is it, sir!')
-        cli_alpf = 6
+    def rate(self, qrx, qry, qrz, dt):
+        #===========================================================================================
+        # Rate task: Run the rotation rate PIDs each rotation axis on the latest gyro batch to
+        # determine overall PWM output.
+        #===========================================================================================
+        self.rate_task.begin()
+        fs = self.flight_state
 
-    elif cli_test_case == 0:
-        logger.critical('You must specify flight (-f) or gravity calibration (-g)')
-        sys.exit(2)
+        pids = self.pids
 
-    elif cli_fly or cli_calibrate_gravity:
-        logger.critical('Choose a specific test case (--tc) or fly (-f) or calibrate gravity (-g)')
-        sys.exit(2)
+        #-------------------------------------------------------------------------------------------
+        # Convert the rotation rate PID outputs direct to PWM pulse width
+        #-------------------------------------------------------------------------------------------
+        pr_out = int(round(pids[PID_PR].Compute(qry, fs.pr_target, dt) / 2))
+        rr_out = int(round(pids[PID_RR].Compute(qrx, fs.rr_target, dt) / 2))
+        yr_out = int(round(pids[PID_YR].Compute(qrz, fs.yr_target, dt) / 2))
+        fs.pr_out = pr_out
+        fs.rr_out = rr_out
+        fs.yr_out = yr_out
 
-    elif cli_test_case != 1 and cli_test_case != 2:
-        logger.critical('Only 1 or 2 are valid testcases')
-        sys.exit(2)
+        #===========================================================================================
+        # PID output distribution: apply the PID outputs to each motor according to where it's
+        # sited on the frame
+        #===========================================================================================
+        vert_out = fs.vert_out
+        roll_mix = self.roll_mix
+        pitch_mix = self.pitch_mix
+        yaw_mix = self.yaw_mix
+        motor_outputs = self.motor_outputs
+        for motor in range(len(motor_outputs)):
+            motor_outputs[motor] = vert_out + roll_mix[motor] * rr_out + pitch_mix[motor] * pr_out + yaw_mix[motor] * yr_out
 
-    elif cli_test_case == 1 and hover_target_defaulted:
-        logger.critical('You must choose a specific hover speed (-h) for test case 1 - try 200')
-        sys.exit(2)
+        self.rate_task.end()
+        return motor_outputs
 
+####################################################################################################
+#
+# Functions to lock memory to prevent paging
+#
+####################################################################################################
+MCL_CURRENT = 1
+MCL_FUTURE  = 2
+def mlockall(flags = MCL_CURRENT| MCL_FUTURE):
+    import ctypes
+    import ctypes.util
+    libc_name = ctypes.util.find_library("c")
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    result = libc.mlockall(flags)
+    if result != 0:
+        raise Exception("cannot lock memory, errno=%s" % ctypes.get_errno())
+
+def munlockall():
+    import ctypes
+    import ctypes.util
+    libc_name = ctypes.util.find_library("c")
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    result = libc.munlockall()
+    if result != 0:
+        raise Exception("cannot lock memmory, errno=%s" % ctypes.get_errno())
 
-    return cli_calibrate_gravity, cli_fly, cli_hover_target, cli_video, cli_vvp_gain, cli_vvi_gain, cli_vvd_gain, cli_hvp_gain, cli_hvi_gain, cli_hvd_gain, cli_prp_gain, cli_pri_gain, cli_prd_gain, cli_rrp_gain, cli_rri_gain, cli_rrd_gain, cli_yrp_gain, cli_yri_gain, cli_yrd_gain, cli_test_case, cli_alpf, cli_glpf, cli_rtf_period, cli_tau, cli_diagnostics
+####################################################################################################
+#
+# Functions to keep the cyclic garbage collector out of flight.  The heap built up by warm-up is
+# collected then frozen (Python 3.7+) so no later collection ever scans it, and the collector is
+# disabled until shutdown; the motion loop's reference counted temporaries are still freed as
+# they go, and the count of container allocations left pending shows whether anything's piling up.
+#
+####################################################################################################
+def GCFreeze():
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    gc.disable()
+
+def GCRelease():
+    pending = gc.get_count()
+    frozen = gc.get_freeze_count() if hasattr(gc, "get_freeze_count") else 0
+    if hasattr(gc, "unfreeze"):
+        gc.unfreeze()
+    gc.enable()
+    logger.critical("gc: disabled for flight, %d objects frozen, %d / %d / %d pending", frozen, pending[0], pending[1], pending[2])
 
 ####################################################################################################
 #
-# Shutdown triggered by early Ctrl-C or end of script
+# Out-of-process logging.  The flight controller's log handler only enqueues the raw record onto a
+# bounded queue without blocking; a separate logger process owns the formatting, the console and
+# the /dev/shm log file.  If the queue is full the record is dropped and counted rather than
+# stalling the motion loop.
 #
 ####################################################################################################
-def CleanShutdown():
+class LogQueueHandler(logging.Handler):
+
+    def __init__(self, log_queue, dropped):
+        logging.Handler.__init__(self)
+        self.log_queue = log_queue
+        self.dropped = dropped
+
+    def emit(self, record):
+        #-------------------------------------------------------------------------------------------
+        # Only the unformatted message and its arguments cross to the logger process.
+        #-------------------------------------------------------------------------------------------
+        try:
+            self.log_queue.put_nowait((record.levelno, record.threadName, record.funcName, record.lineno, record.msg, record.args))
+        except Queue.Full:
+            self.dropped.value += 1
+
 
+def LogSinkProcess(log_queue, dropped, file_name, max_bytes, backups):
     #-----------------------------------------------------------------------------------------------
-    # Stop the signal handler
+    # Ctrl-C is for the flight controller; the log sink runs until it's told to stop so that the
+    # shutdown logs still get written.
     #-----------------------------------------------------------------------------------------------
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
     #-----------------------------------------------------------------------------------------------
-    # Stop the blades spinning
+    # Clear out any logs left behind in /dev/shm by a previous run that didn't shut down cleanly;
+    # the rotation below caps /dev/shm usage at max_bytes * (backups + 1).
     #-----------------------------------------------------------------------------------------------
-    for esc in esc_list:
-        esc.update(0)
+    for log_file_name in LogSink.fileNames(file_name, backups):
+        if os.path.exists(log_file_name):
+            os.remove(log_file_name)
 
-    #-----------------------------------------------------------------------------------------------
-    # Stop the video if it's running
-    #-----------------------------------------------------------------------------------------------
-    if shoot_video:
-        video.send_signal(signal.SIGINT)
+    import logging.handlers
+    file_handler = logging.handlers.RotatingFileHandler(file_name, 'a', max_bytes, backups)
+    file_handler.setLevel(logging.WARNING)
+    file_handler.setFormatter(logging.Formatter('[%(levelname)s] (%(threadName)-10s) %(funcName)s %(lineno)d, %(message)s'))
 
-    #-----------------------------------------------------------------------------------------------
-    # If the sensor data acquisition is running, then stop it
-    #-----------------------------------------------------------------------------------------------
-    if sensordata is not None:
-        logger.critical("lps: %f", sensordata.elapsed_loop_count / sensordata.elapsed_loop_time)
-        sensordata.go = False;
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.CRITICAL)
+    console_handler.setFormatter(logging.Formatter('%(message)s'))
 
-    #-----------------------------------------------------------------------------------------------
-    # Record MPU6050 / i2c bus data misses.
-    #-----------------------------------------------------------------------------------------------
-    if mpu6050 is not None:
-        mpu6050_misses, i2c_misses = mpu6050.getMisses()
-        logger.critical("mpu6050 %d misses, i2c %d misses", mpu6050_misses, i2c_misses)
+    handlers = [console_handler, file_handler]
 
-    #-----------------------------------------------------------------------------------------------
-    # Copy logs from /dev/shm (shared / virtual memory) to the Logs directory.
-    #-----------------------------------------------------------------------------------------------
-    now = datetime.now()
-    now_string = now.strftime("%y%m%d-%H:%M:%S")
-    log_file_name = "qcstats" + now_string + ".csv"
-    shutil.move("/dev/shm/qclogs", log_file_name)
+    while True:
+        entry = log_queue.get()
+        if entry is None:
+            break
 
-    #-----------------------------------------------------------------------------------------------
-    # Unlock memory we've used from RAM
-    #-----------------------------------------------------------------------------------------------
-    munlockall()
+        levelno, thread_name, func_name, lineno, msg, args = entry
+        record = logging.LogRecord('QC logger', levelno, '', lineno, msg, args, None, func_name)
+        record.threadName = thread_name
 
-    #-----------------------------------------------------------------------------------------------
-    # Clean up PWM / GPIO, but pause beforehand to give the ESCs time to stop properly
-    #-----------------------------------------------------------------------------------------------
-    time.sleep(1.0)
-    RpioCleanup()
+        for handler in handlers:
+            if levelno >= handler.level:
+                handler.handle(record)
 
     #-----------------------------------------------------------------------------------------------
-    # Reset the signal handler to default
+    # Report how many records the flight controller couldn't queue.
     #-----------------------------------------------------------------------------------------------
-    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    record = logging.LogRecord('QC logger', logging.CRITICAL, '', 0, "log sink dropped %d records", (dropped.value,), None, 'LogSinkProcess')
+    for handler in handlers:
+        handler.handle(record)
+        handler.close()
 
-    sys.exit(0)
 
-####################################################################################################
-#
-# Signal handler for Ctrl-C => abort cleanly
-#
-####################################################################################################
-def ShutdownSignalHandler(signal, frame):
-    global keep_looping
-    global woken_by
-    global SIG_SHUTDOWN
+class LogSink:
 
-    if not keep_looping:
-        CleanShutdown()
-    keep_looping = False
-    woken_by = SIG_SHUTDOWN
+    _QUEUE_SIZE = 4096
+    _MAX_BYTES = 16 * 1024 * 1024
+    _BACKUPS = 3
+
+    def __init__(self, file_name):
+        import multiprocessing
+
+        self.file_name = file_name
+        self.log_queue = multiprocessing.Queue(self._QUEUE_SIZE)
+        self.dropped = multiprocessing.Value('i', 0)
+        self.process = multiprocessing.Process(target = LogSinkProcess,
+                                               name = "QC log sink",
+                                               args = (self.log_queue, self.dropped, file_name, self._MAX_BYTES, self._BACKUPS))
+        self.process.start()
+        self.running = True
+
+    @staticmethod
+    def fileNames(file_name, backups):
+        #-------------------------------------------------------------------------------------------
+        # Oldest first, matching RotatingFileHandler's .1 (newest backup) to .N (oldest) naming.
+        #-------------------------------------------------------------------------------------------
+        return ["%s.%d" % (file_name, index) for index in range(backups, 0, -1)] + [file_name]
+
+    def files(self):
+        return [log_file_name for log_file_name in self.fileNames(self.file_name, self._BACKUPS) if os.path.exists(log_file_name)]
+
+    def handler(self):
+        return LogQueueHandler(self.log_queue, self.dropped)
+
+    def stop(self):
+        #-------------------------------------------------------------------------------------------
+        # Wait for the sink to drain the queue so everything logged so far is on file.
+        #-------------------------------------------------------------------------------------------
+        if not self.running:
+            return
+        self.running = False
+        self.log_queue.put(None)
+        self.process.join(10.0)
 
 ####################################################################################################
 #
-# Signal handler for new data ready to process
+# Out-of-process deadline watchdog.  The motion loop bumps a heartbeat counter in shared memory each
+# pass, along with the ESC pulse widths it's just set.  The watchdog process polls the counter; if
+# it stops changing for longer than the deadline (I2C retries, a blocked data ready wait, a GC pause
+# or anything else holding up the loop, the GIL included), it takes over the PWM directly: all
+# motors step down through the descent profile from the average of the last pulse widths, then cut.
+# The motion loop can also hand over to the descent straight away with failsafe(), when it knows
+# it can't fly on, e.g. the i2c bus or data ready interrupt has failed.
+#
+# Every stall beyond the warning threshold is measured and bucketed for the shutdown report.  The
+# process is forked so it inherits the PWM set up by RpioSetup().
 #
 ####################################################################################################
-def DataReadySignalHandler(signal, frame):
-    global woken_by
-    global SIG_DATA_READY
+WATCHDOG_STALLS, WATCHDOG_TOTAL_STALL, WATCHDOG_MAX_STALL, WATCHDOG_TRIP_STALL = range(4)
+WATCHDOG_BUCKETS = 4
+WATCHDOG_STATS = 4 + WATCHDOG_BUCKETS
 
+def WatchdogBuckets(warning, deadline):
     #-----------------------------------------------------------------------------------------------
-    # This does nothing other than wake the main thread up
+    # Stall bucket lower bounds
     #-----------------------------------------------------------------------------------------------
-    woken_by = SIG_DATA_READY
+    return tuple(sorted((warning, 2 * warning, deadline, 2 * deadline)))
 
-####################################################################################################
-#
-# Flight plan management
-#
-####################################################################################################
-class FlightPlan:
 
+def WatchdogPulse(pin, pulse_width):
+    PWM.add_channel_pulse(RPIO_DMA_CHANNEL, pin, 0, pulse_width)
+
+
+def WatchdogProcess(heartbeat, running, tripped, failsafe, pulse_widths, stats, pins, deadline, warning, period, descent, min_pulse_width, pulse):
     #-----------------------------------------------------------------------------------------------
-    # The flight plan - move to file at some point to allow various FP's to be saved, and selected
-    # per flight.
+    # Ctrl-C is for the flight controller, which stops the watchdog as part of shutting down.
     #-----------------------------------------------------------------------------------------------
-    fp_evx_target  = [0.0,       0.0,       0.0,       0.0,       0.0]
-    fp_evy_target  = [0.0,       0.0,       0.0,       0.0,       0.0]
-    fp_evz_target  = [0.0,       0.75,       0.0,      -0.75,       0.0]
-    fp_time        = [0.0,       2.0,       5.0,       2.0,       0.0]
-    fp_name        = ["RTF",  "ASCENT",   "HOVER", "DESCENT",    "STOP"]
-    _FP_STEPS = 5
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    def __init__(self):
+    bucket_bounds = WatchdogBuckets(warning, deadline)
 
-        self.fp_index = 0
-        self.fp_prev_index = 0
-        self.elapsed_time = 0.0
+    last_beat = heartbeat.value
+    last_beat_time = time.time()
+    while running.value:
+        time.sleep(period)
+        if failsafe.value:
+            break
 
+        time_now = time.time()
+        beat = heartbeat.value
+        stall = time_now - last_beat_time
+        ongoing = beat == last_beat
 
-    def getTargets(self, delta_time):
-        global keep_looping
+        if not ongoing:
+            last_beat = beat
+            last_beat_time = time_now
+            if stall < warning:
+                continue
 
-        self.elapsed_time += delta_time
+        elif stall < deadline:
+            continue
 
-        fp_total_time = 0.0
-        for fp_index in range(0, self._FP_STEPS):
-            fp_total_time += self.fp_time[fp_index]
-            if self.elapsed_time < fp_total_time:
+        #-------------------------------------------------------------------------------------------
+        # A stall beyond the warning threshold, either over now or ongoing beyond the deadline.
+        #-------------------------------------------------------------------------------------------
+        stats[WATCHDOG_STALLS] += 1
+        stats[WATCHDOG_TOTAL_STALL] += stall
+        if stall > stats[WATCHDOG_MAX_STALL]:
+            stats[WATCHDOG_MAX_STALL] = stall
+        for bucket in range(WATCHDOG_BUCKETS - 1, -1, -1):
+            if stall >= bucket_bounds[bucket]:
+                stats[4 + bucket] += 1
                 break
-        else:
-            keep_looping = False
 
-        if fp_index != self.fp_prev_index:
-            logger.critical("%s", self.fp_name[fp_index])
-            self.fp_prev_index = fp_index
+        if not ongoing:
+            continue
 
-        return self.fp_evx_target[fp_index], self.fp_evy_target[fp_index], self.fp_evz_target[fp_index]
+        stats[WATCHDOG_TRIP_STALL] = stall
+        break
+
+    else:
+        return
+
+    #-----------------------------------------------------------------------------------------------
+    # Deadline missed or failsafe: tell the motion loop it's no longer in charge, then fly the
+    # descent and cut the motors.
+    #-----------------------------------------------------------------------------------------------
+    tripped.value = 1
+
+    spin = sum(pulse_widths) / len(pulse_widths) - min_pulse_width
+    for duration, fraction in descent:
+        pulse_width = int(min_pulse_width + spin * fraction)
+        for pin in pins:
+            pulse(pin, pulse_width)
+        time.sleep(duration)
+
+    for pin in pins:
+        pulse(pin, min_pulse_width)
+
+
+class Watchdog:
+
+    #-----------------------------------------------------------------------------------------------
+    # The descent profile: (seconds, fraction of the last average spin above minimum) steps.
+    #-----------------------------------------------------------------------------------------------
+    DESCENT = ((0.5, 0.9), (1.0, 0.8), (1.0, 0.7), (1.0, 0.6))
+
+    def __init__(self, pins, deadline = 0.05, warning = 0.015, period = 0.002, descent = DESCENT, min_pulse_width = 1000, pulse = WatchdogPulse):
+        import multiprocessing
+
+        self.deadline = deadline
+        self.warning = warning
+        self.descent = descent
+
+        self.heartbeat = multiprocessing.RawValue('i', 0)
+        self.running = multiprocessing.RawValue('i', 1)
+        self.tripped_flag = multiprocessing.RawValue('i', 0)
+        self.failsafe_flag = multiprocessing.RawValue('i', 0)
+        self.pulse_widths = multiprocessing.RawArray('i', [min_pulse_width] * len(pins))
+        self.stats = multiprocessing.RawArray('d', WATCHDOG_STATS)
+
+        context = multiprocessing.get_context("fork") if hasattr(multiprocessing, "get_context") else multiprocessing
+        self.process = context.Process(target = WatchdogProcess,
+                                       name = "QC watchdog",
+                                       args = (self.heartbeat, self.running, self.tripped_flag, self.failsafe_flag, self.pulse_widths, self.stats,
+                                               pins, deadline, warning, period, descent, min_pulse_width, pulse))
+        self.process.daemon = True
+        self.process.start()
+
+    def beat(self, esc_list):
+        pulse_widths = self.pulse_widths
+        for index in range(len(esc_list)):
+            pulse_widths[index] = esc_list[index].pulse_width
+        self.heartbeat.value += 1
+
+    def tripped(self):
+        return self.tripped_flag.value != 0
+
+    def failsafe(self):
+        #-------------------------------------------------------------------------------------------
+        # Have the watchdog take the motors and fly the descent now, from the last pulse widths
+        # beaten, rather than at the deadline.  This waits until it has them, so a stop() straight
+        # after doesn't end it first; if it's gone, stop() and the shutdown cut the motors.
+        #-------------------------------------------------------------------------------------------
+        self.failsafe_flag.value = 1
+        start_time = time.time()
+        while not self.tripped() and self.process.is_alive() and time.time() - start_time < self.deadline + 1.0:
+            time.sleep(0.001)
+        return self.tripped()
+
+    def stop(self):
+        #-------------------------------------------------------------------------------------------
+        # If the watchdog's tripped, this waits for its descent to finish.
+        #-------------------------------------------------------------------------------------------
+        self.running.value = 0
+        self.process.join(sum([duration for duration, fraction in self.descent]) + 1.0)
+
+    def report(self):
+        stats = self.stats
+        logger.critical("watchdog: deadline %.0fms, warning %.0fms, %d stalls, max %.1fms, total %.1fms, %s",
+                        self.deadline * 1000, self.warning * 1000, stats[WATCHDOG_STALLS], stats[WATCHDOG_MAX_STALL] * 1000,
+                        stats[WATCHDOG_TOTAL_STALL] * 1000, ("failsafe descent" if self.failsafe_flag.value else "tripped after %.1fms" % (stats[WATCHDOG_TRIP_STALL] * 1000)) if self.tripped() else "not tripped")
+        bounds = WatchdogBuckets(self.warning, self.deadline)
+        for bucket in range(WATCHDOG_BUCKETS):
+            logger.critical("watchdog stalls >= %.0fms: %d", bounds[bucket] * 1000, stats[4 + bucket])
 
 ####################################################################################################
 #
-# Functions to lock memory to prevent paging
+# Statistical profiler for the flight code, cheap enough to leave running in flight.  A sampler
+# thread wakes at the sample rate and records the control thread's stack, as the tuple of its
+# frames' code objects, against a count in a fixed size table; stacks beyond the table's capacity
+# are only counted as overflows.  Labels are only made from the code objects when the collapsed
+# stacks ("root;caller;callee count" per line, as taken by flamegraph.pl) are written out.
+#
+# Switched on by --prof or toggled by SIGUSR2.  The sampler thread only starts on first use.
+#
+# The sampler keeps to its own schedule, but it needs the GIL to take each sample, and while the
+# control thread is running Python rather than waiting on the IMU it only gets that when the
+# interpreter switches threads.  Python 2 switches every 100 bytecodes so the sampler keeps up
+# to 1000Hz; Python 3 switches on a 5ms timer (sys.getswitchinterval()), which holds it to about
+# 300Hz.  The rate actually achieved, samples over the time spent switched on, is what's
+# reported.
 #
 ####################################################################################################
-MCL_CURRENT = 1
-MCL_FUTURE  = 2
-def mlockall(flags = MCL_CURRENT| MCL_FUTURE):
-    libc_name = ctypes.util.find_library("c")
-    libc = ctypes.CDLL(libc_name, use_errno=True)
-    result = libc.mlockall(flags)
-    if result != 0:
-        raise Exception("cannot lock memory, errno=%s" % ctypes.get_errno())
+class SamplingProfiler:
+
+    _MAX_STACKS = 1024
+    _MAX_DEPTH = 32
+
+    def __init__(self, thread_id, rate):
+        self.thread_id = thread_id
+        self.rate = rate
+        self.interval = 1.0 / rate
+
+        self.stacks = {}
+        self.counts = array('i', [0] * self._MAX_STACKS)
+        self.samples = 0
+        self.overflows = 0
+        self.sample_time = 0.0
+
+        self.enabled = False
+        self.enabled_time = 0.0
+        self.enabled_at = 0.0
+        self.running = False
+
+    def start(self):
+        if not self.enabled:
+            self.enabled_at = time.time()
+            self.enabled = True
+        if not self.running:
+            self.running = True
+            thread.start_new_thread(self.sampler, ())
+
+    def stop(self):
+        if self.enabled:
+            self.enabled = False
+            self.enabled_time += time.time() - self.enabled_at
+
+    def toggle(self):
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
 
-def munlockall():
-    libc_name = ctypes.util.find_library("c")
-    libc = ctypes.CDLL(libc_name, use_errno=True)
-    result = libc.munlockall()
-    if result != 0:
-        raise Exception("cannot lock memmory, errno=%s" % ctypes.get_errno())
+    def shutdown(self):
+        self.stop()
+        self.running = False
+
+    def sampler(self):
+        #-------------------------------------------------------------------------------------------
+        # Sleep until the next sample is due rather than for a whole interval, so the time taken
+        # by the samples doesn't slow the rate; once behind, restart the schedule from now rather
+        # than trying to catch up with a burst of samples.
+        #-------------------------------------------------------------------------------------------
+        next_time = time.time()
+        while self.running:
+            next_time += self.interval
+            sleep_time = next_time - time.time()
+            if sleep_time > 0.0:
+                time.sleep(sleep_time)
+            else:
+                next_time -= sleep_time
+            if self.enabled:
+                self.sample()
+
+    def sample(self):
+        start_time = time.time()
+
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None and len(stack) < self._MAX_DEPTH:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+
+        stack = tuple(stack)
+        index = self.stacks.get(stack)
+        if index is None:
+            index = len(self.stacks)
+            if index == self._MAX_STACKS:
+                self.overflows += 1
+                return
+            self.stacks[stack] = index
+
+        self.counts[index] += 1
+        self.samples += 1
+        self.sample_time += time.time() - start_time
+
+    @staticmethod
+    def label(code):
+        return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def collapsed(self):
+        #-------------------------------------------------------------------------------------------
+        # (collapsed stack, count) pairs, most frequent first; the stacks are sampled innermost
+        # frame first, and collapsed root first.
+        #-------------------------------------------------------------------------------------------
+        lines = [(";".join([self.label(code) for code in reversed(stack)]), self.counts[index]) for stack, index in self.stacks.items()]
+        lines.sort(key = lambda line: line[1], reverse = True)
+        return lines
+
+    def write(self, file_name):
+        with open(file_name, "w") as collapsed_file:
+            for stack, count in self.collapsed():
+                collapsed_file.write("%s %d\n" % (stack, count))
+
+    def enabledTime(self):
+        if self.enabled:
+            return self.enabled_time + time.time() - self.enabled_at
+        return self.enabled_time
+
+    def achievedRate(self):
+        enabled_time = self.enabledTime()
+        return self.samples / enabled_time if enabled_time > 0.0 else 0.0
+
+    def report(self):
+        logger.critical("profiler: %d samples at %.0fHz (set to %dHz) over %.1fs, %d stacks, %d overflows, %.1fus per sample",
+                        self.samples, self.achievedRate(), self.rate, self.enabledTime(), len(self.stacks), self.overflows,
+                        self.sample_time * 1000000 / self.samples if self.samples else 0.0)
 
 ####################################################################################################
 #
@@ -1426,13 +4958,21 @@ def go():
     # Global variables
     #-----------------------------------------------------------------------------------------------
     global logger
-    global keep_looping
+    global flight_state
     global temp_now
     global start_time
     global threading
     global mpu6050
+    global data_ready
+    global watchdog
+    global profiler
+    global gc_frozen
+    global temperature_model
+    global gyro_bias
+    global imu_capture
+    global notch_bank
+    global compass
     global sensordata
-    global woken_by
     global i_am_phoebe
     global i_am_chloe
     global i_am_zoe
@@ -1441,6 +4981,8 @@ def go():
     global shoot_video
     global data_acquisition_loops
     global data_acquisition_time
+    global log_sink
+    global scheduler
 
     #-----------------------------------------------------------------------------------------------
     # Global constants
@@ -1451,6 +4993,11 @@ def go():
     global SIG_SHUTDOWN
     global SIG_NONE
 
+    #-----------------------------------------------------------------------------------------------
+    # Time each phase of startup through to take-off
+    #-----------------------------------------------------------------------------------------------
+    phase_timer = PhaseTimer()
+
     #-----------------------------------------------------------------------------------------------
     # Who am I?
     #-----------------------------------------------------------------------------------------------
@@ -1460,25 +5007,27 @@ def go():
     i_am_hog = False
     my_name = os.uname()[1]
     if my_name == "phoebe.local":
-        print "Hi, I'm Phoebe. Nice to meet you!"
+        print("Hi, I'm Phoebe. Nice to meet you!")
         i_am_phoebe = True
     elif my_name == "chloe.local":
-        print "Hi, I'm Chloe.  Nice to meet you!"
+        print("Hi, I'm Chloe.  Nice to meet you!")
         i_am_chloe = True
     elif my_name == "zoe.local":
-        print "Hi, I'm Zoe.  Nice to meet you!"
+        print("Hi, I'm Zoe.  Nice to meet you!")
         i_am_zoe = True
     elif my_name == "hog.local":
-        print "Hi, I'm HoG.  Nice to meet you!"
+        print("Hi, I'm HoG.  Nice to meet you!")
         i_am_hog = True
     else:
-        print "Sorry, I'm not qualified to fly this quadcopter."
+        print("Sorry, I'm not qualified to fly this quadcopter.")
         sys.exit(0)
+    phase_timer.lap("hostname")
 
     #-----------------------------------------------------------------------------------------------
     # Lock code permanently in memory - no swapping to disk
     #-----------------------------------------------------------------------------------------------
     mlockall()
+    phase_timer.lap("mlockall")
 
     #-----------------------------------------------------------------------------------------------
     # Set the BCM output / intput assigned to LED and sensor interrupt respectively
@@ -1501,29 +5050,17 @@ def go():
     logger.setLevel(logging.INFO)
 
     #-----------------------------------------------------------------------------------------------
-    # Create file and console logger handlers - the file is written into shared memory and only
-    # dumped to disk / SD card at the end of a flight for performance reasons
-    #-----------------------------------------------------------------------------------------------
-    file_handler = logging.FileHandler("/dev/shm/qclogs", 'w')
-    file_handler.setLevel(logging.WARNING)
-
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.CRITICAL)
-
-    #-----------------------------------------------------------------------------------------------
-    # Create a formatter and add it to both handlers
+    # Start the logger process that owns the file and console logging - the file is written into
+    # shared memory and only dumped to disk / SD card at the end of a flight for performance
+    # reasons.  Here, logging is just a non-blocking enqueue of anything WARNING or above.
     #-----------------------------------------------------------------------------------------------
-    console_formatter = logging.Formatter('%(message)s')
-    console_handler.setFormatter(console_formatter)
-
-    file_formatter = logging.Formatter('[%(levelname)s] (%(threadName)-10s) %(funcName)s %(lineno)d, %(message)s')
-    file_handler.setFormatter(file_formatter)
+    log_sink = LogSink("/dev/shm/qclogs")
+    atexit.register(log_sink.stop)
 
-    #-----------------------------------------------------------------------------------------------
-    # Add both handlers to the logger
-    #-----------------------------------------------------------------------------------------------
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+    queue_handler = log_sink.handler()
+    queue_handler.setLevel(logging.WARNING)
+    logger.addHandler(queue_handler)
+    phase_timer.lap("logging")
 
     #-----------------------------------------------------------------------------------------------
     # Initialize the numeric globals
@@ -1531,38 +5068,33 @@ def go():
     SIG_NONE = 0
     SIG_DATA_READY = 1
     SIG_SHUTDOWN = 2
-    woken_by = SIG_NONE
 
     #-----------------------------------------------------------------------------------------------
-    # Set up the bits of state setup before takeoff
+    # The flight state shared with the signal handlers, sensor thread, diagnostics and shutdown
     #-----------------------------------------------------------------------------------------------
-    evx_target = 0.0
-    evy_target = 0.0
-    evz_target = 0.0
-
-    qvx_input = 0.0
-    qvy_input = 0.0
-    qvz_input = 0.0
-
-    qvx_diags = "0.0, 0.0, 0.0"
-    qvy_diags = "0.0, 0.0, 0.0"
-    qvz_diags = "0.0, 0.0, 0.0"
-    pr_diags = "0.0, 0.0, 0.0"
-    rr_diags = "0.0, 0.0, 0.0"
-    yr_diags = "0.0, 0.0, 0.0"
-
-    hover_speed = 0
-    ready_to_fly = False
-    keep_looping = False
+    flight_state = FlightState()
+    flight_state.woken_by = SIG_NONE
 
     mpu6050 = None
+    data_ready = None
+    watchdog = None
+    profiler = None
+    gc_frozen = False
+    temperature_model = None
+    gyro_bias = None
+    imu_capture = None
+    notch_bank = None
+    compass = None
     sensordata = None
+    scheduler = None
 
     #-----------------------------------------------------------------------------------------------
     # Enable RPIO for beeper, MPU 6050 interrupts and PWM.  This must be set up prior to adding
     # the SignalHandler below or it will override what we set thus killing the "Kill Switch"..
     #-----------------------------------------------------------------------------------------------
+    RequireHardware()
     RpioSetup()
+    phase_timer.lap("RpioSetup")
 
     #-----------------------------------------------------------------------------------------------
     # Set the signal handler here so the core processing loop can be stopped (or not started) by
@@ -1594,88 +5126,224 @@ def go():
         ESC_BCM_FR = 17
         ESC_BCM_BR = 19
 
-    MOTOR_LOCATION_FRONT = 0b00000001
-    MOTOR_LOCATION_BACK =  0b00000010
-    MOTOR_LOCATION_LEFT =  0b00000100
-    MOTOR_LOCATION_RIGHT = 0b00001000
+    pin_list = [ESC_BCM_FL, ESC_BCM_FR, ESC_BCM_BL, ESC_BCM_BR]
+    location_list = [MOTOR_LOCATION_FRONT | MOTOR_LOCATION_LEFT, MOTOR_LOCATION_FRONT | MOTOR_LOCATION_RIGHT, MOTOR_LOCATION_BACK | MOTOR_LOCATION_LEFT, MOTOR_LOCATION_BACK | MOTOR_LOCATION_RIGHT]
+    rotation_list = [MOTOR_ROTATION_ACW, MOTOR_ROTATION_CW, MOTOR_ROTATION_CW, MOTOR_ROTATION_ACW]
+    name_list = ['front left', 'front right', 'back left', 'back right']
+
+    #-----------------------------------------------------------------------------------------------
+    # Prime the ESCs with the default 0 spin rotors to stop their whining!
+    #-----------------------------------------------------------------------------------------------
+    esc_list = []
+    for esc_index in range(0, 4):
+        esc = ESC(pin_list[esc_index], location_list[esc_index], rotation_list[esc_index], name_list[esc_index])
+        esc_list.append(esc)
+    phase_timer.lap("ESC priming")
+
+    #-----------------------------------------------------------------------------------------------
+    # Check the command line for calibration or flight parameters
+    #-----------------------------------------------------------------------------------------------
+    calibrate_gravity, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, yrp_gain, yri_gain, yrd_gain, test_case, alpf, glpf, rtf_period, tau, diagnostics, diagnostics_rate, rate_period, attitude_period, velocity_period, plan_period, use_ekf, watchdog_deadline, profile_rate, gc_off, calibrate_temperature, gyro_tracking, capture_time, notch, compass_tau = CheckCLI(sys.argv[1:])
+    logger.warning("calibrate_gravity = %s, fly = %s, hover_target = %d, shoot_video = %s, vvp_gain = %f, vvi_gain = %f, vvd_gain= %f, hvp_gain = %f, hvi_gain = %f, hvd_gain = %f, prp_gain = %f, pri_gain = %f, prd_gain = %f, rrp_gain = %f, rri_gain = %f, rrd_gain = %f, yrp_gain = %f, yri_gain = %f, yrd_gain = %f, test_case = %d, alpf = %d, glpf = %d, rtf_period = %f, tau = %f, diagnostics = %s, diagnostics_rate = %d, rate_period = %d, attitude_period = %d, velocity_period = %d, plan_period = %d, use_ekf = %s, watchdog_deadline = %f, profile_rate = %d, gc_off = %s, calibrate_temperature = %s, gyro_tracking = %s, capture_time = %f, notch = %s, compass_tau = %f",
+            calibrate_gravity, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, yrp_gain, yri_gain, yrd_gain, test_case, alpf, glpf, rtf_period, tau, diagnostics, diagnostics_rate, rate_period, attitude_period, velocity_period, plan_period, use_ekf, watchdog_deadline, profile_rate, gc_off, calibrate_temperature, gyro_tracking, capture_time, notch, compass_tau)
+    phase_timer.lap("CheckCLI")
+
+    #-----------------------------------------------------------------------------------------------
+    # Report which math kernels are in use, JIT compiling / loading them now if they're numba's
+    #-----------------------------------------------------------------------------------------------
+    KernelReport()
+    phase_timer.lap("kernels")
+
+    #-----------------------------------------------------------------------------------------------
+    # The IMU sample rate all the task periods are counted in - I'll tidy this later once I've
+    # tracked down why I'm getting 1kHz despite SMPLRT_DIV != 0
+    #-----------------------------------------------------------------------------------------------
+    IMU_SAMPLE_RATE = 1000
+
+    #-----------------------------------------------------------------------------------------------
+    # Set up the global constants
+    # - gravity in meters per second squared
+    # - accelerometer in g's
+    # - gyroscope in radians per second
+    #-----------------------------------------------------------------------------------------------
+    GRAV_ACCEL = 9.80665
+
+    #-----------------------------------------------------------------------------------------------
+    # Initialize the gyroscope / accelerometer I2C object
+    #-----------------------------------------------------------------------------------------------
+    mpu6050 = MPU6050(0x68, alpf, glpf, data_ready = data_ready)
+
+    #-----------------------------------------------------------------------------------------------
+    # Use the temperature model from the last --rls calibration in place of the built-in offsets
+    #-----------------------------------------------------------------------------------------------
+    loaded_model = TemperatureModel.load(TEMPERATURE_MODEL_FILE)
+    if loaded_model is not None:
+        logger.critical("Using temperature model from %s", TEMPERATURE_MODEL_FILE)
+        mpu6050.setTemperatureModel(loaded_model)
+
+    #-----------------------------------------------------------------------------------------------
+    # Slave the magnetometer to the MPU6050 for the yaw angle correction
+    #-----------------------------------------------------------------------------------------------
+    if compass_tau and mpu6050.enableMagnetometer():
+        compass = Compass(mpu6050, compass_tau)
+
+    #-----------------------------------------------------------------------------------------------
+    # Capture the raw samples from here on, warm-up included, if asked to
+    #-----------------------------------------------------------------------------------------------
+    if capture_time:
+        imu_capture = ImuCapture(IMU_CAPTURE_FILE, int(capture_time * IMU_SAMPLE_RATE), mpu6050.range_factors[0], mpu6050.range_factors[4])
+        mpu6050.capture = imu_capture
+    phase_timer.lap("MPU6050")
+
+    #-----------------------------------------------------------------------------------------------
+    # Calibrate 0g gravity offsets now.
+    #-----------------------------------------------------------------------------------------------
+    if calibrate_gravity:
+        mpu6050.calibrateGravity("qcoffsets.csv")
+        CleanShutdown()
+
+    #-----------------------------------------------------------------------------------------------
+    # Calibrate gyros - this is a one-off unless tracking the gyro bias, which starts from the
+    # offsets the last flight ended with where there are any.
+    #-----------------------------------------------------------------------------------------------
+    if gyro_tracking:
+        gyro_bias = GyroBiasTracker()
+
+    if gyro_bias is not None and mpu6050.loadGyroOffsets(GYRO_OFFSETS_FILE):
+        logger.critical("Gyro offsets from %s", GYRO_OFFSETS_FILE)
+    else:
+        mpu6050.calibrateGyros()
+    phase_timer.lap("calibrateGyros")
+
+    #-----------------------------------------------------------------------------------------------
+    # Calibrating the temperature model starts from the one in use; it's saved by CleanShutdown()
+    #-----------------------------------------------------------------------------------------------
+    if calibrate_temperature:
+        temperature_model = mpu6050.getTemperatureModel()
+
+    #===============================================================================================
+    # Tuning: Set up the PID gains - some are hard coded mathematical approximations, some come
+    # from the CLI parameters to allow for tuning  - 7 in all
+    # - Quad X axis speed speed
+    # - Quad Y axis speed speed
+    # - Quad Z axis speed speed
+    # - Pitch rotation rate
+    # - Roll Rotation rate
+    # - Yaw angle
+    # = Yaw Rotation rate
+    #===============================================================================================
+
+    #-----------------------------------------------------------------------------------------------
+    # The quad X axis speed controls forward / backward speed
+    #-----------------------------------------------------------------------------------------------
+    PID_QVX_P_GAIN = hvp_gain
+    PID_QVX_I_GAIN = hvi_gain
+    PID_QVX_D_GAIN = hvd_gain
 
-    MOTOR_ROTATION_CW = 1
-    MOTOR_ROTATION_ACW = 2
+    #-----------------------------------------------------------------------------------------------
+    # The quad Y axis speed controls left / right speed
+    #-----------------------------------------------------------------------------------------------
+    PID_QVY_P_GAIN = hvp_gain
+    PID_QVY_I_GAIN = hvi_gain
+    PID_QVY_D_GAIN = hvd_gain
 
-    pin_list = [ESC_BCM_FL, ESC_BCM_FR, ESC_BCM_BL, ESC_BCM_BR]
-    location_list = [MOTOR_LOCATION_FRONT | MOTOR_LOCATION_LEFT, MOTOR_LOCATION_FRONT | MOTOR_LOCATION_RIGHT, MOTOR_LOCATION_BACK | MOTOR_LOCATION_LEFT, MOTOR_LOCATION_BACK | MOTOR_LOCATION_RIGHT]
-    rotation_list = [MOTOR_ROTATION_ACW, MOTOR_ROTATION_CW, MOTOR_ROTATION_CW, MOTOR_ROTATION_ACW]
-    name_list = ['front left', 'front right', 'back left', 'back right']
+    #-----------------------------------------------------------------------------------------------
+    # The quad Z axis speed controls rise / fall speed
+    #-----------------------------------------------------------------------------------------------
+    PID_QVZ_P_GAIN = vvp_gain
+    PID_QVZ_I_GAIN = vvi_gain
+    PID_QVZ_D_GAIN = vvd_gain
 
     #-----------------------------------------------------------------------------------------------
-    # Prime the ESCs with the default 0 spin rotors to stop their whining!
+    # The pitch rate PID controls stable rotation rate around the Y-axis
     #-----------------------------------------------------------------------------------------------
-    esc_list = []
-    for esc_index in range(0, 4):
-        esc = ESC(pin_list[esc_index], location_list[esc_index], rotation_list[esc_index], name_list[esc_index])
-        esc_list.append(esc)
+    PID_PR_P_GAIN = prp_gain
+    PID_PR_I_GAIN = pri_gain
+    PID_PR_D_GAIN = prd_gain
 
     #-----------------------------------------------------------------------------------------------
-    # Check the command line for calibration or flight parameters
+    # The roll rate PID controls stable rotation rate around the X-axis
     #-----------------------------------------------------------------------------------------------
-    calibrate_gravity, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, yrp_gain, yri_gain, yrd_gain, test_case, alpf, glpf, rtf_period, tau, diagnostics = CheckCLI(sys.argv[1:])
-    logger.warning("calibrate_gravity = %s, fly = %s, hover_target = %d, shoot_video = %s, vvp_gain = %f, vvi_gain = %f, vvd_gain= %f, hvp_gain = %f, hvi_gain = %f, hvd_gain = %f, prp_gain = %f, pri_gain = %f, prd_gain = %f, rrp_gain = %f, rri_gain = %f, rrd_gain = %f, yrp_gain = %f, yri_gain = %f, yrd_gain = %f, test_case = %d, alpf = %d, glpf = %d, rtf_period = %f, tau = %f, diagnostics = %s",
-            calibrate_gravity, flying, hover_target, shoot_video, vvp_gain, vvi_gain, vvd_gain, hvp_gain, hvi_gain, hvd_gain, prp_gain, pri_gain, prd_gain, rrp_gain, rri_gain, rrd_gain, yrp_gain, yri_gain, yrd_gain, test_case, alpf, glpf, rtf_period, tau, diagnostics)
+    PID_RR_P_GAIN = rrp_gain
+    PID_RR_I_GAIN = rri_gain
+    PID_RR_D_GAIN = rrd_gain
 
-    #===============================================================================================
-    # START TESTCASE 1 CODE: spin up each blade individually for 10s each and check they all turn
-    #                        the right way
-    #===============================================================================================
-    if test_case == 1:
-        logger.critical("TESTCASE 1: Check props are spinning as expected")
-        for esc in esc_list:
-            logger.critical("%s prop should rotate %s.", esc.name, "anti-clockwise" if esc.motor_rotation == MOTOR_ROTATION_ACW else "clockwise")
-            for count in range(0, hover_target, 10):
-                #-----------------------------------------------------------------------------------
-                # Spin up to user determined (-h) hover speeds ~200
-                #-----------------------------------------------------------------------------------
-                esc.update(count)
-                time.sleep(0.01)
-            time.sleep(5.0)
-            esc.update(0)
-        CleanShutdown()
-    #===============================================================================================
-    # END TESTCASE 1 CODE: spin up each blade individually for 10s each and check they all turn the
-    #                      right way
-    #===============================================================================================
+    #-----------------------------------------------------------------------------------------------
+    # The yaw angle PID controls stable angles around the Z-axis
+    #-----------------------------------------------------------------------------------------------
+    PID_YA_P_GAIN = 6.0 # yap_gain
+    PID_YA_I_GAIN = 3.0 # yai_gain
+    PID_YA_D_GAIN = 1.0 # yad_gain
 
     #-----------------------------------------------------------------------------------------------
-    # Initialize the butterworth LP filters. 50 = 1kHz pulses / 20 loops - I'll tidy these later once
-    # I've tracked down why I'm getting 1kHz despite SMPLRT_DIV != 0
+    # The yaw rate PID controls stable rotation speed around the Z-axis
     #-----------------------------------------------------------------------------------------------
-    bfx = BUTTERWORTH(50, 0.20, 4, 0.0)
-    bfy = BUTTERWORTH(50, 0.20, 4, 0.0)
-    bfz = BUTTERWORTH(50, 0.20, 4, 1.0)
+    PID_YR_P_GAIN = yrp_gain
+    PID_YR_I_GAIN = yri_gain
+    PID_YR_D_GAIN = yrd_gain
 
     #-----------------------------------------------------------------------------------------------
-    # Set up the global constants
-    # - gravity in meters per second squared
-    # - accelerometer in g's
-    # - gyroscope in radians per second
+    # The pitch and roll angle PIDs hold the quad level in the attitude level control mode
     #-----------------------------------------------------------------------------------------------
-    GRAV_ACCEL = 9.80665
+    PID_PA_P_GAIN = 2.0 # pap_gain
+    PID_PA_I_GAIN = 0.5 # pai_gain
+    PID_PA_D_GAIN = 0.0 # pad_gain
+    PID_RA_P_GAIN = 2.0 # rap_gain
+    PID_RA_I_GAIN = 0.5 # rai_gain
+    PID_RA_D_GAIN = 0.0 # rad_gain
 
     #-----------------------------------------------------------------------------------------------
-    # Initialize the gyroscope / accelerometer I2C object
+    # The control mode, chosen once here by the test case:
+    # - 1: spin up each blade individually and check they all turn the right way
+    # - 2: take-off from a horizontal platform and tune the rate PID gains for stability
+    # - 3: use angles to maintain horizontal flight regardless of take-off platform angle
     #-----------------------------------------------------------------------------------------------
-    mpu6050 = MPU6050(0x68, alpf, glpf)
+    if test_case == 1:
+        control_mode = MotorSpin(hover_target, [motor.name for motor in esc_list])
+    elif test_case == 2:
+        control_mode = RateTuning()
+    elif test_case == 3:
+        control_mode = AttitudeLevel()
+    else:
+        control_mode = VelocityHold()
 
     #-----------------------------------------------------------------------------------------------
-    # Calibrate 0g gravity offsets now.
+    # The motion processing engine, driven below by the sensor data and driving the ESCs.
     #-----------------------------------------------------------------------------------------------
-    if calibrate_gravity:
-        mpu6050.calibrateGravity("qcoffsets.csv")
-        CleanShutdown()
+    control_loop = ControlLoop(flight_state,
+                               [(PID_QVX_P_GAIN, PID_QVX_I_GAIN, PID_QVX_D_GAIN),
+                                (PID_QVY_P_GAIN, PID_QVY_I_GAIN, PID_QVY_D_GAIN),
+                                (PID_QVZ_P_GAIN, PID_QVZ_I_GAIN, PID_QVZ_D_GAIN),
+                                (PID_YA_P_GAIN, PID_YA_I_GAIN, PID_YA_D_GAIN),
+                                (PID_PR_P_GAIN, PID_PR_I_GAIN, PID_PR_D_GAIN),
+                                (PID_RR_P_GAIN, PID_RR_I_GAIN, PID_RR_D_GAIN),
+                                (PID_YR_P_GAIN, PID_YR_I_GAIN, PID_YR_D_GAIN),
+                                (PID_PA_P_GAIN, PID_PA_I_GAIN, PID_PA_D_GAIN),
+                                (PID_RA_P_GAIN, PID_RA_I_GAIN, PID_RA_D_GAIN)],
+                               list(zip(location_list, rotation_list)),
+                               IMU_SAMPLE_RATE,
+                               rate_period,
+                               attitude_period,
+                               velocity_period,
+                               plan_period,
+                               tau,
+                               hover_target,
+                               rtf_period,
+                               control_mode,
+                               use_ekf,
+                               GRAV_ACCEL,
+                               mpu6050.scaleSensors,
+                               gyro_bias,
+                               compass)
 
     #-----------------------------------------------------------------------------------------------
-    # Calibrate gyros - this is a one-off
+    # The dynamic notch filters on the raw samples, scheduled as part of the motion processing
     #-----------------------------------------------------------------------------------------------
-    mpu6050.calibrateGyros()
+    if notch is not None:
+        notch_bank = NotchFilterBank(IMU_SAMPLE_RATE, rate_period, notch[0], notch[1], scheduler = control_loop.scheduler)
+        for channel, centre in notch[2].items():
+            notch_bank.setCentre(channel, centre)
+    phase_timer.lap("PID setup")
 
     #-----------------------------------------------------------------------------------------------
     # 20 seconds of loops here to fill up the butterworth filter with valid values, and get an
@@ -1706,9 +5374,9 @@ def go():
 
     next_log_time = loops_start
     settled = False
-    keep_looping = True
+    flight_state.keep_looping = True
 
-    while keep_looping:
+    while flight_state.keep_looping:
         qax, qay, qaz, qrx, qry, qrz = mpu6050.readSensors()
 
         loops_count += 1
@@ -1721,16 +5389,28 @@ def go():
         qrz_averaged += qrz
 
         #-------------------------------------------------------------------------------------------
-        # Every 'motion period' convert the averaged quad frame values to earth frame
+        # Every attitude period convert the averaged quad frame values to earth frame
         # and add to the array of values.  Run butterworth each time to ensure it's well
         # primed.
         #-------------------------------------------------------------------------------------------
-        if loops_count == 20:
+        if loops_count == attitude_period:
 
             time_now = time.time()
             loops_period = time_now - loops_start
             loops_start = time_now
 
+            #---------------------------------------------------------------------------------------
+            # Update the temperature model from the averaged raw sensors if calibrating it
+            #---------------------------------------------------------------------------------------
+            if temperature_model is not None:
+                mpu6050.calibrateTemperature(temperature_model,
+                                             qax_averaged / loops_count,
+                                             qay_averaged / loops_count,
+                                             qaz_averaged / loops_count,
+                                             qrx_averaged / loops_count,
+                                             qry_averaged / loops_count,
+                                             qrz_averaged / loops_count)
+
             #---------------------------------------------------------------------------------------
             # Work out the average acceleration due to gravity in the quad reference frame
             #---------------------------------------------------------------------------------------
@@ -1741,6 +5421,15 @@ def go():
                                                                 qry_averaged / loops_count,
                                                                 qrz_averaged / loops_count)
 
+            #---------------------------------------------------------------------------------------
+            # Track the gyro bias as the flight will, sitting still here
+            #---------------------------------------------------------------------------------------
+            if gyro_bias is not None:
+                qrx -= gyro_bias.bias[0]
+                qry -= gyro_bias.bias[1]
+                qrz -= gyro_bias.bias[2]
+                gyro_bias.update(qax, qay, qaz, qrx, qry, qrz, loops_period)
+
 
             #---------------------------------------------------------------------------------------
             # Get angles in radians for Euler and quad frame: rotate the accelerometer
@@ -1748,9 +5437,9 @@ def go():
             # the new gravity back to the quad frame, and get the revised angles.
             #---------------------------------------------------------------------------------------
             eax, eay, eaz = RotateQ2E(qax, qay, qaz, pa, ra, ya)
-            egx = bfx.filter(eax)
-            egy = bfy.filter(eay)
-            egz = bfz.filter(eaz)
+            egx = control_loop.bfx.filter(eax)
+            egy = control_loop.bfy.filter(eay)
+            egz = control_loop.bfz.filter(eaz)
             qgx, qgy, qgz = RotateE2Q(egx, egy, egz, pa, ra, ya)
             uap, uar = GetRotationAngles(qgx, qgy, qgz)
 
@@ -1829,12 +5518,16 @@ def go():
             if egx_error < 0.001 and egy_error < 0.001 and egz_error < 0.001:
                 settled = True
 
-            if time_now >= next_log_time:
+            if time_now >= next_log_time and temperature_model is not None:
+                logger.critical("%d samples, %foC", temperature_model.samples, temp_now / 333.87 + 21.0)
+                next_log_time += 10.0
+
+            elif time_now >= next_log_time:
                 logger.critical("%d...%f", 20 - int(round(time_now - start_time)), temp_now / 333.87 + 21.0)
                 next_log_time += 1.0
 #                logger.critical("%f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %s", time_now - start_time, pa * 180 / math.pi, ra * 180 / math.pi, ya * 180 / math.pi, qax, qay, qaz, eax, eay, eaz, egx, egy, egz, qgx, qgy, qgz, settled)
 
-            if time_now - start_time > 20.0: # settled:
+            if time_now - start_time > 20.0 and temperature_model is None: # settled:
                 break
 
     #-----------------------------------------------------------------------------------------------
@@ -1845,6 +5538,16 @@ def go():
     logger.critical("pitch %f, roll %f", math.degrees(pa), math.degrees(ra))
     logger.critical("earth frame gravity: x = %f, y = %f, z: = %f", egx, egy, egz)
 
+    #-----------------------------------------------------------------------------------------------
+    # If the gyro bias couldn't be tracked sitting still, the last flight's offsets are too far
+    # out for the tracker to lock on, so calibrate afresh and track from there.
+    #-----------------------------------------------------------------------------------------------
+    if gyro_bias is not None and gyro_bias.tracking_time == 0.0:
+        logger.critical("Gyro bias not tracked while warming up, recalibrating gyros")
+        mpu6050.calibrateGyros()
+        gyro_bias.bias[:] = [0.0, 0.0, 0.0]
+    phase_timer.lap("warm-up")
+
     #-----------------------------------------------------------------------------------------------
     # Clean up now we have a stable system
     #-----------------------------------------------------------------------------------------------
@@ -1856,12 +5559,12 @@ def go():
     qry_integrated = 0.0
     qrz_integrated = 0.0
 
-    keep_looping = False
+    flight_state.keep_looping = False
 
     #-----------------------------------------------------------------------------------------------
     # If the warming up period was ctrl-C'd, stop now!
     #-----------------------------------------------------------------------------------------------
-    if woken_by == SIG_SHUTDOWN:
+    if flight_state.woken_by == SIG_SHUTDOWN:
         CleanShutdown()
 
     #-----------------------------------------------------------------------------------------------
@@ -1873,102 +5576,29 @@ def go():
         os.setpgrp()
 
     if shoot_video:
+        from datetime import datetime
+        import subprocess
+
         now = datetime.now()
         now_string = now.strftime("%y%m%d-%H:%M:%S")
         video = subprocess.Popen(["raspivid", "-rot", "180", "-w", "1280", "-h", "720", "-o", "/home/pi/Videos/qcvid_" + now_string + ".h264", "-n", "-t", "0", "-fps", "30", "-b", "5000000"], preexec_fn =  Daemonize)
 
-    #===============================================================================================
-    # Tuning: Set up the PID gains - some are hard coded mathematical approximations, some come
-    # from the CLI parameters to allow for tuning  - 7 in all
-    # - Quad X axis speed speed
-    # - Quad Y axis speed speed
-    # - Quad Z axis speed speed
-    # - Pitch rotation rate
-    # - Roll Rotation rate
-    # - Yaw angle
-    # = Yaw Rotation rate
-    #===============================================================================================
-
-    #-----------------------------------------------------------------------------------------------
-    # The quad X axis speed controls forward / backward speed
-    #-----------------------------------------------------------------------------------------------
-    PID_QVX_P_GAIN = hvp_gain
-    PID_QVX_I_GAIN = hvi_gain
-    PID_QVX_D_GAIN = hvd_gain
-
-    #-----------------------------------------------------------------------------------------------
-    # The quad Y axis speed controls left / right speed
-    #-----------------------------------------------------------------------------------------------
-    PID_QVY_P_GAIN = hvp_gain
-    PID_QVY_I_GAIN = hvi_gain
-    PID_QVY_D_GAIN = hvd_gain
-
-    #-----------------------------------------------------------------------------------------------
-    # The quad Z axis speed controls rise / fall speed
-    #-----------------------------------------------------------------------------------------------
-    PID_QVZ_P_GAIN = vvp_gain
-    PID_QVZ_I_GAIN = vvi_gain
-    PID_QVZ_D_GAIN = vvd_gain
-
-    #-----------------------------------------------------------------------------------------------
-    # The pitch rate PID controls stable rotation rate around the Y-axis
-    #-----------------------------------------------------------------------------------------------
-    PID_PR_P_GAIN = prp_gain
-    PID_PR_I_GAIN = pri_gain
-    PID_PR_D_GAIN = prd_gain
-
-    #-----------------------------------------------------------------------------------------------
-    # The roll rate PID controls stable rotation rate around the X-axis
-    #-----------------------------------------------------------------------------------------------
-    PID_RR_P_GAIN = rrp_gain
-    PID_RR_I_GAIN = rri_gain
-    PID_RR_D_GAIN = rrd_gain
-
-    #-----------------------------------------------------------------------------------------------
-    # The yaw angle PID controls stable angles around the Z-axis
-    #-----------------------------------------------------------------------------------------------
-    PID_YA_P_GAIN = 6.0 # yap_gain
-    PID_YA_I_GAIN = 3.0 # yai_gain
-    PID_YA_D_GAIN = 1.0 # yad_gain
-
-    #-----------------------------------------------------------------------------------------------
-    # The yaw rate PID controls stable rotation speed around the Z-axis
-    #-----------------------------------------------------------------------------------------------
-    PID_YR_P_GAIN = yrp_gain
-    PID_YR_I_GAIN = yri_gain
-    PID_YR_D_GAIN = yrd_gain
+    phase_timer.lap("video")
 
     logger.critical('Thunderbirds are go!')
 
     #-----------------------------------------------------------------------------------------------
     # Diagnostic log header
     #-----------------------------------------------------------------------------------------------
+    diags = Diagnostics(diagnostics_rate)
     if diagnostics:
-        logger.warning('time, dt, loop, qrx, qry, qrz, qax, qay, qaz, efrgv_x, efrgv_y, efrgv_z, qfrgv_x, qfrgv_y, qfrgv_z, qvx_input, qvy_input, qvz_input, pitch, roll, yaw, evx_target, qvx_target, qxp, qxi, qxd, pr_target, prp, pri, prd, pr_out, evy_yarget, qvy_target, qyp, qyi, qyd, rr_target, rrp, rri, rrd, rr_out, evz_target, qvz_target, qzp, qzi, qzd, qvz_out, yr_target, yrp, yri, yrd, yr_out, FL spin, FR spin, BL spin, BR spin')
-
-    #===============================================================================================
-    # Initialize critical timing immediately before starting the PIDs.  This is done by reading the
-    # sensors, and that also gives us a starting position of the rolling average from.
-    #===============================================================================================
-
-    #-----------------------------------------------------------------------------------------------
-    # Start the X, Y (horizontal) and Z (vertical) velocity PIDs
-    #-----------------------------------------------------------------------------------------------
-    qvx_pid = PID(PID_QVX_P_GAIN, PID_QVX_I_GAIN, PID_QVX_D_GAIN)
-    qvy_pid = PID(PID_QVY_P_GAIN, PID_QVY_I_GAIN, PID_QVY_D_GAIN)
-    qvz_pid = PID(PID_QVZ_P_GAIN, PID_QVZ_I_GAIN, PID_QVZ_D_GAIN)
-
-    #-----------------------------------------------------------------------------------------------
-    # Start the yaw angle PID
-    #-----------------------------------------------------------------------------------------------
-    ya_pid = PID(PID_YA_P_GAIN, PID_YA_I_GAIN, PID_YA_D_GAIN)
+        diags.header()
 
     #-----------------------------------------------------------------------------------------------
-    # Start the pitch, roll and yaw rate PIDs
+    # Start the motion processing from the take-off surface tilt and gravity found while warming up
     #-----------------------------------------------------------------------------------------------
-    pr_pid = PID(PID_PR_P_GAIN, PID_PR_I_GAIN, PID_PR_D_GAIN)
-    rr_pid = PID(PID_RR_P_GAIN, PID_RR_I_GAIN, PID_RR_D_GAIN)
-    yr_pid = PID(PID_YR_P_GAIN, PID_YR_I_GAIN, PID_YR_D_GAIN)
+    control_loop.start(pa, ra, ya, egx, egy, egz)
+    scheduler = control_loop.scheduler
 
     #-----------------------------------------------------------------------------------------------
     # Set up the data ready signal handler if using the multithreaded model.
@@ -1980,7 +5610,7 @@ def go():
     #-----------------------------------------------------------------------------------------------
     # Set up the sensor data retrieval thread
     #-----------------------------------------------------------------------------------------------
-    sensordata = SENSORDATA()
+    sensordata = SENSORDATA(rate_period, flight_state, notch_bank)
 
     #===============================================================================================
     #
@@ -1995,267 +5625,102 @@ def go():
     # ur? = euler rotation between frames
     #
     #===============================================================================================
+    #-----------------------------------------------------------------------------------------------
+    # Profile this, the motion loop's thread, from now if asked to, and let SIGUSR2 switch the
+    # profiler on and off; it defaults to 100Hz sampling if it's only signalled.
+    #-----------------------------------------------------------------------------------------------
+    profiler = SamplingProfiler(thread.get_ident(), profile_rate if profile_rate else 100)
+    signal.signal(signal.SIGUSR2, ProfilerSignalHandler)
+    if profile_rate:
+        profiler.start()
+
+    #-----------------------------------------------------------------------------------------------
+    # The batch handed to the motion processing is refilled each loop, and optionally the garbage
+    # collector's kept out of the flight from here on.
+    #-----------------------------------------------------------------------------------------------
+    raw_batch = [0.0] * 6
+    if gc_off:
+        GCFreeze()
+        gc_frozen = True
+
+    #-----------------------------------------------------------------------------------------------
+    # Record where the startup time went now we're about to take off
+    #-----------------------------------------------------------------------------------------------
+    phase_timer.lap("flight setup")
+    phase_timer.report()
+
+    #-----------------------------------------------------------------------------------------------
+    # Start the watchdog last of all, as the motion loop's about to start beating: its deadline
+    # runs from here, so nothing slow e.g. the garbage collection above can come after it.
+    #-----------------------------------------------------------------------------------------------
+    watchdog = Watchdog([esc.bcm_pin for esc in esc_list], watchdog_deadline)
 
-    keep_looping = True
-    while keep_looping:
+    flight_state.keep_looping = True
+    while flight_state.keep_looping:
         #-------------------------------------------------------------------------------------------
         # Wait for the next batch of data to be available either from the separate thread or by
         # getting the data directly
         #-------------------------------------------------------------------------------------------
         if threading:
             signal.pause()
-            if woken_by == SIG_DATA_READY:
+            if flight_state.woken_by == SIG_DATA_READY:
                 pass
-            elif woken_by == SIG_SHUTDOWN:
+            elif flight_state.woken_by == SIG_SHUTDOWN:
                 break
-            woken_by = SIG_NONE
+            flight_state.woken_by = SIG_NONE
         else:
 
             sensordata.integrator()
 
         #-------------------------------------------------------------------------------------------
-        # Copy the latest data into the local copy and run with it
-        #-------------------------------------------------------------------------------------------
-        qax, qay, qaz, qrx, qry, qrz, i_time = sensordata.collect()
-
-        #-------------------------------------------------------------------------------------------
-        # Sort out units and calibration for the incoming data
-        #-------------------------------------------------------------------------------------------
-        qax, qay, qaz, qrx, qry, qrz = mpu6050.scaleSensors(qax,
-                                                            qay,
-                                                            qaz,
-                                                            qrx,
-                                                            qry,
-                                                            qrz)
-
-        i_qrx = qrx * i_time
-        i_qry = qry * i_time
-        i_qrz = qrz * i_time
-
-
-        #-------------------------------------------------------------------------------------------
-        # Get angles in radians for Euler and quad frame: rotate the accelerometer readings to earth
-        # frame, pass them through the butterworth filter, rotate the new gravity back to the quad
-        # frame, and get the revised angles.
-        #-------------------------------------------------------------------------------------------
-        eax, eay, eaz = RotateQ2E(qax, qay, qaz, pa, ra, ya)
-        egx = bfx.filter(eax)
-        egy = bfy.filter(eay)
-        egz = bfz.filter(eaz)
-        qgx, qgy, qgz = RotateE2Q(egx, egy, egz, pa, ra, ya)
-        uap, uar = GetRotationAngles(qgx, qgy, qgz)
-
-        #-------------------------------------------------------------------------------------------
-        # Convert the gyro quad-frame rotation rates into the Euler frames rotation rates using the
-        # revised angles from the Butterworth filter
-        #-------------------------------------------------------------------------------------------
-        urp, urr, ury = Body2EulerRates(qry, qrx, qrz, uap, uar)
-
-        #-------------------------------------------------------------------------------------------
-        # Merge rotation frames angles with a complementary filter and fill in the blanks
-        #-------------------------------------------------------------------------------------------
-        tau_fraction = tau / (tau + i_time)
-        pa = tau_fraction * (pa + urp * i_time) + (1 - tau_fraction) * uap
-        ra = tau_fraction * (ra + urr * i_time) + (1 - tau_fraction) * uar
-        ya += i_qrz
-
-        #-------------------------------------------------------------------------------------------
-        # Get the curent flight plan targets
-        #-------------------------------------------------------------------------------------------
-        if not ready_to_fly:
-            if hover_speed >= hover_target:
-                hover_speed = hover_target
-                ready_to_fly = True
-
-                #-----------------------------------------------------------------------------------
-                # Register the flight plan with the authorities
-                #-----------------------------------------------------------------------------------
-                fp = FlightPlan()
-
-            else:
-                hover_speed += int(hover_target * i_time / rtf_period)
-
-        else:
-            evx_target, evy_target, evz_target = fp.getTargets(i_time)
-
-        #-------------------------------------------------------------------------------------------
-        # Convert earth-frame velocity targets to quadcopter frame.
-        #-------------------------------------------------------------------------------------------
-        qvx_target, qvy_target, qvz_target = RotateE2Q(evx_target, evy_target, evz_target, pa, ra, ya)
-
-        #-------------------------------------------------------------------------------------------
-        # Redistribute gravity around the new orientation of the quad
-        #-------------------------------------------------------------------------------------------
-        qgx, qgy, qgz = RotateE2Q(egx, egy, egz, pa, ra, ya)
-
-        #-------------------------------------------------------------------------------------------
-        # Delete reorientated gravity from raw accelerometer readings and sum to make velocity all
-        # in quad frame
-        #-------------------------------------------------------------------------------------------
-        qvx_input += (qax - qgx) * i_time * GRAV_ACCEL
-        qvy_input += (qay - qgy) * i_time * GRAV_ACCEL
-        qvz_input += (qaz - qgz) * i_time * GRAV_ACCEL
-
-        #=======================================================================================
-        # Motion PIDs: Run the horizontal speed PIDs each rotation axis to determine targets for
-        # absolute angle PIDs and the verical speed PID to control height.
-        #=======================================================================================
-        [p_out, i_out, d_out] = qvx_pid.Compute(qvx_input, qvx_target, i_time)
-        qvx_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-        qvx_out = p_out + i_out + d_out
-
-        [p_out, i_out, d_out] = qvy_pid.Compute(qvy_input, qvy_target, i_time)
-        qvy_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-        qvy_out =  p_out + i_out + d_out
-
-        [p_out, i_out, d_out] = qvz_pid.Compute(qvz_input, qvz_target, i_time)
-        qvz_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-        qvz_out = p_out + i_out + d_out
-
-        #-------------------------------------------------------------------------------------------
-        # Convert the horizontal velocity PID output i.e. the horizontal acceleration target in q's
-        # into the pitch and roll angle PID targets in radians
-        # - A forward unintentional drift is a positive input and negative output from the velocity
-        #   PID.  This represents corrective acceleration.  To achieve corrective backward
-        #   acceleration, the negative velocity PID output needs to trigger a negative pitch
-        #   rotation rate
-        # - A left unintentional drift is a positive input and negative output from the velocity
-        #   PID.  To achieve corrective right acceleration, the negative velocity PID output needs
-        #   to trigger a positive roll rotation rate
-        #-------------------------------------------------------------------------------------------
-
-        #-------------------------------------------------------------------------------------------
-        # Use a bit of hokey trigonometry to convert desired quad frame acceleration (qv*_out) into
-        # the target quad frame angle that provides that acceleration (*a_target
+        # Failsafe if the i2c bus has failed: there's no sensor data to fly with, so hand the motors
+        # to the watchdog to fly its descent; the shutdown waits for that before cutting them.
         #-------------------------------------------------------------------------------------------
-        pr_target = math.atan(qvx_out)
-        rr_target = -math.atan(qvy_out)
+        if mpu6050.i2c.breakerOpen():
+            logger.critical("i2c bus failed, failsafe descent")
+            watchdog.failsafe()
+            break
 
         #-------------------------------------------------------------------------------------------
-        # Convert the vertical velocity PID output direct to PWM pulse width.
+        # Likewise if the MPU6050 data ready interrupt has stopped.
         #-------------------------------------------------------------------------------------------
-        vert_out = hover_speed + int(round(qvz_out))
-
-        #===========================================================================================
-        # START TESTCASE 3 CODE: Override motion processing results; instead use angles to maintain
-        #                        horizontal flight regardless of take-off platform angle.
-        #------------------------------------------------------------------------------------------=-
-        if test_case == 3:
-                pa_target = 0.0
-                [p_out, i_out, d_out] = pa_pid.Compute(pa, pa_target, i_time)
-                pa_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-                pa_out = p_out + i_out + d_out
-                pr_target = pa_out
-
-                ra_target = 0.0
-                [p_out, i_out, d_out] = ra_pid.Compute(ra, ra_target, i_time)
-                ra_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-                ra_out = p_out + i_out + d_out
-                rr_target = ra_out
-        #===========================================================================================
-        # END TESTCASE 3 CODE: Override motion processing results; instead use angles to maintain
-        #                      horizontal flight regardless of take-off platform angle.
-        #===========================================================================================
+        if data_ready.stuck():
+            logger.critical("mpu6050 data ready interrupt stuck, failsafe descent")
+            watchdog.failsafe()
+            break
 
         #-------------------------------------------------------------------------------------------
-        # For the moment, we just want yaw to not exist.  It's only required if we want the front of
-        # the quad to face the direction it's travelling.
+        # Run the motion processing on the latest batch of data from the flight state, and apply
+        # the results to the ESCs' PWM signals
         #-------------------------------------------------------------------------------------------
-        ya_target = 0.0
-        [p_out, i_out, d_out] = ya_pid.Compute(ya, ya_target, i_time)
-        ya_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-        ya_out = p_out + i_out + d_out
-        yr_target = ya_out
-
-        #===========================================================================================
-        # START TESTCASE 2 CODE: Override motion processing results; take-off from horizontal
-        #                        platform, tune the pr*_gain and rr*_gain PID gains for
-        #                        stability.
-        #===========================================================================================
-        if test_case == 2:
-            pr_target = 0.0
-            rr_target = 0.0
-            yr_target = 0.0
-        #===========================================================================================
-        # END TESTCASE 2 CODE: Override motion processing results; take-off from horizontal
-        #                      platform, turn the pr*_gain and rr*_gain PID gains for
-        #                      stability.
-        #===========================================================================================
-
-        #===========================================================================================
-        # Attitude PIDs: Run the rotation rate PIDs each rotation axis to determine overall PWM
-        # output.
-        #===========================================================================================
-        [p_out, i_out, d_out] = pr_pid.Compute(qry, pr_target, i_time)
-        pr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-        pr_out = p_out + i_out + d_out
-
-        [p_out, i_out, d_out] = rr_pid.Compute(qrx, rr_target, i_time)
-        rr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-        rr_out = p_out + i_out + d_out
-
-        [p_out, i_out, d_out] = yr_pid.Compute(qrz, yr_target, i_time)
-        yr_diags = "%f, %f, %f" % (p_out, i_out, d_out)
-        yr_out = p_out + i_out + d_out
+        raw_batch[0] = flight_state.i_qax
+        raw_batch[1] = flight_state.i_qay
+        raw_batch[2] = flight_state.i_qaz
+        raw_batch[3] = flight_state.i_qrx
+        raw_batch[4] = flight_state.i_qry
+        raw_batch[5] = flight_state.i_qrz
+        motor_outputs = control_loop.step(raw_batch, flight_state.i_time)
 
         #-------------------------------------------------------------------------------------------
-        # Convert the rotation rate PID outputs direct to PWM pulse width
+        # Once the watchdog's tripped it has the motors; leave it to finish its descent.
         #-------------------------------------------------------------------------------------------
-        pr_out = int(round(pr_out / 2))
-        rr_out = int(round(rr_out / 2))
-        yr_out = int(round(yr_out / 2))
-
-        #===========================================================================================
-        # PID output distribution: Walk through the ESCs, and apply the PID outputs i.e. the updates
-        # PWM pulse widths according to where the ESC is sited on the frame
-        #===========================================================================================
-        for esc in esc_list:
-            #---------------------------------------------------------------------------------------
-            # Update all blades' power in accordance with the z error
-            #---------------------------------------------------------------------------------------
-            delta_spin = vert_out
-
-            #---------------------------------------------------------------------------------------
-            # For a left downwards roll, the x gyro goes negative, so the PID error is positive,
-            # meaning PID output is positive, meaning this needs to be added to the left blades
-            # and subtracted from the right.
-            #---------------------------------------------------------------------------------------
-            if esc.motor_location & MOTOR_LOCATION_RIGHT:
-                delta_spin -= rr_out
-            else:
-                delta_spin += rr_out
+        if watchdog.tripped():
+            logger.critical("watchdog tripped, failsafe descent")
+            break
 
-            #---------------------------------------------------------------------------------------
-            # For a forward downwards pitch, the y gyro goes positive The PID error is negative as a
-            # result, meaning PID output is negative, meaning this needs to be subtracted from the
-            # front blades and added to the back.
-            #---------------------------------------------------------------------------------------
-            if esc.motor_location & MOTOR_LOCATION_BACK:
-                delta_spin += pr_out
-            else:
-                delta_spin -= pr_out
+        for motor in range(0, 4):
+            esc_list[motor].update(motor_outputs[motor])
 
-            #---------------------------------------------------------------------------------------
-            # For CW yaw, the z gyro goes negative, so the PID error is postitive, meaning PID
-            # output is positive, meaning this need to be added to the ACW (FL and BR) blades and
-            # subtracted from the CW (FR & BL) blades.
-            #---------------------------------------------------------------------------------------
-            if esc.motor_rotation == MOTOR_ROTATION_CW:
-                delta_spin += yr_out
-            else:
-                delta_spin -= yr_out
+        watchdog.beat(esc_list)
 
-            #---------------------------------------------------------------------------------------
-            # Apply the blended outputs to the esc PWM signal
-            #---------------------------------------------------------------------------------------
-            esc.update(delta_spin)
+        if imu_capture is not None:
+            imu_capture.throttle = max(0, int(motor_outputs[0] + motor_outputs[1] + motor_outputs[2] + motor_outputs[3]) // 4)
 
         #-------------------------------------------------------------------------------------------
-        # Diagnostic log - every motion loop
+        # Diagnostic log - every 'diagnostics_rate' motion loops
         #-------------------------------------------------------------------------------------------
-        if diagnostics:
-            logger.warning('%f, %f, %d, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %f, %s, %f, %s, %d, %f, %f, %s, %f, %s, %d, %f, %f, %s, %d, %f, %s, %d, %d, %d, %d, %d',
-                       sensordata.elapsed_loop_time, i_time, sensordata.elapsed_loop_count, qrx, qry, qrz, qax, qay, qaz, egx, egy, egz, qgx, qgy, qgz, qvx_input, qvy_input, qvz_input, math.degrees(pa), math.degrees(ra), math.degrees(ya), evx_target, qvx_target, qvx_diags, math.degrees(pr_target), pr_diags, pr_out, evy_target, qvy_target, qvy_diags, math.degrees(rr_target), rr_diags, rr_out, evz_target, qvz_target, qvz_diags, qvz_out, math.degrees(yr_target), yr_diags, yr_out, esc_list[0].pulse_width, esc_list[1].pulse_width, esc_list[2].pulse_width, esc_list[3].pulse_width)
+        if diagnostics and diags.due():
+            diags.emit(flight_state, control_loop.pids, esc_list)
 
 
     #-----------------------------------------------------------------------------------------------
@@ -2274,28 +5739,26 @@ def go():
 ####################################################################################################
 class SENSORDATA():
 
-    def __init__(self):
+    def __init__(self, batch, flight_state, notch_bank = None):
         #-------------------------------------------------------------------------------------------
-        # Main thread
+        # The number of samples averaged per motion loop i.e. the rate task period
         #-------------------------------------------------------------------------------------------
-        self.i_qax = 0
-        self.i_qay = 0
-        self.i_qaz = 0
-        self.i_qrx = 0
-        self.i_qry = 0
-        self.i_qrz = 0
-        self.i_time = 0.0
+        self.batch = batch
 
         #-------------------------------------------------------------------------------------------
-        # Read the sensors simply to get an initial time stamp prior to looping
+        # Any NotchFilterBank the raw samples go through before they're averaged
         #-------------------------------------------------------------------------------------------
-        mpu6050.readSensors()
+        self.notch_bank = notch_bank
+
+        #-------------------------------------------------------------------------------------------
+        # Each batch's averages and timing are written into the flight state for the main thread
+        #-------------------------------------------------------------------------------------------
+        self.flight_state = flight_state
 
         #-------------------------------------------------------------------------------------------
-        # Set up performance tracking.
+        # Read the sensors simply to get an initial time stamp prior to looping
         #-------------------------------------------------------------------------------------------
-        self.elapsed_loop_time = 0.0
-        self.elapsed_loop_count = 0
+        mpu6050.readSensors()
 
         #-------------------------------------------------------------------------------------------
         # Get a snapshot of the starting time and initialize the variables
@@ -2304,12 +5767,6 @@ class SENSORDATA():
             self.pid = os.getpid()
             thread.start_new_thread(self.integrator, ())
 
-    def collect(self):
-        #-------------------------------------------------------------------------------------------
-        # Main thread
-        #-------------------------------------------------------------------------------------------
-        return self.i_qax, self.i_qay, self.i_qaz, self.i_qrx, self.i_qry, self.i_qrz, self.i_time
-
     def integrator(self):
         #-------------------------------------------------------------------------------------------
         # Data collection + integration thread
@@ -2325,6 +5782,10 @@ class SENSORDATA():
         loops_count = 0
         loops_period = 0.0
 
+        notch_samples = None
+        if self.notch_bank is not None:
+            notch_samples = self.notch_bank.samples
+
         self.go = True
         while self.go:
             #=======================================================================================
@@ -2333,6 +5794,18 @@ class SENSORDATA():
             #=======================================================================================
             ax, ay, az, gx, gy, gz = mpu6050.readSensors()
 
+            #---------------------------------------------------------------------------------------
+            # Keep the raw samples for the notch filters to filter as a batch.
+            #---------------------------------------------------------------------------------------
+            if notch_samples is not None:
+                index = loops_count * 6
+                notch_samples[index] = ax
+                notch_samples[index + 1] = ay
+                notch_samples[index + 2] = az
+                notch_samples[index + 3] = gx
+                notch_samples[index + 4] = gy
+                notch_samples[index + 5] = gz
+
             #---------------------------------------------------------------------------------------
             # Now we have the sensor snapshot, tidy up the rest of the variable so that
             # processing takes zero time.
@@ -2362,26 +5835,32 @@ class SENSORDATA():
             # Motion Processing:  Use the recorded data to produce motion data and feed in the
             # motion PIDs
             #=======================================================================================
-            if loops_count == 20:
+            if loops_count == self.batch:
 
                 time_now = time.time()
                 loops_period = time_now - loops_start
                 loops_start = time_now
 
+                #-----------------------------------------------------------------------------------
+                # With the notch filters, the batch is the sum of the filtered samples instead.
+                #-----------------------------------------------------------------------------------
+                if notch_samples is not None:
+                    ax_integrated, ay_integrated, az_integrated, gx_integrated, gy_integrated, gz_integrated = self.notch_bank.filter(loops_count)
 
                 #-----------------------------------------------------------------------------------
                 # Maintained for diagnostic purposes only
                 #-----------------------------------------------------------------------------------
-                self.elapsed_loop_time += loops_period
-                self.elapsed_loop_count += loops_count
-
-                self.i_qax = ax_integrated / loops_count
-                self.i_qay = ay_integrated / loops_count
-                self.i_qaz = az_integrated / loops_count
-                self.i_qrx = gx_integrated / loops_count
-                self.i_qry = gy_integrated / loops_count
-                self.i_qrz = gz_integrated / loops_count
-                self.i_time = loops_period
+                fs = self.flight_state
+                fs.elapsed_time += loops_period
+                fs.loop_count += loops_count
+
+                fs.i_qax = ax_integrated / loops_count
+                fs.i_qay = ay_integrated / loops_count
+                fs.i_qaz = az_integrated / loops_count
+                fs.i_qrx = gx_integrated / loops_count
+                fs.i_qry = gy_integrated / loops_count
+                fs.i_qrz = gz_integrated / loops_count
+                fs.i_time = loops_period
 
                 #-----------------------------------------------------------------------------------
                 # Clear the integration for next time round
@@ -0,0 +1,1795 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+###############################################################################################
+#
+# Benchmarks for the flight controller's numeric code, run on the Pi itself so the results
+# reflect the real CPU budget.  No GPIO / I2C is touched, so they run under any interpreter the
+# flight code does, with or without the hardware drivers installed.
+#
+# qcbench.py            - run them all
+# qcbench.py ekf ...    - run the named benchmarks only
+#
+###############################################################################################
+from __future__ import division
+from __future__ import print_function
+import sys
+import os
+import platform
+import subprocess
+import multiprocessing
+import time
+import math
+import random
+import logging
+import struct
+
+import Quadcopter
+
+GRAV_ACCEL = 9.80665
+
+###############################################################################################
+#
+# Time 'iterations' calls of function, returning microseconds per call.  The best of 'repeats'
+# runs is taken to keep other processes' noise out of the results.
+#
+###############################################################################################
+def TimeIt(function, iterations, repeats = 5):
+    best_time = None
+    for repeat in range(0, repeats):
+        start_time = time.time()
+        for iteration in range(0, iterations):
+            function()
+        run_time = time.time() - start_time
+        if best_time is None or run_time < best_time:
+            best_time = run_time
+    return best_time * 1000000 / iterations
+
+#----------------------------------------------------------------------------------------------
+# The most memory a call of function allocates over what was allocated before it, with
+# tracemalloc tracing; the transient allocations that net growth checks can't see.
+#----------------------------------------------------------------------------------------------
+def TransientPeak(tracemalloc, function, calls = 1000):
+    peak = 0
+    for call in range(0, calls):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    return peak
+
+###############################################################################################
+#
+# Synthetic IMU data at 'rate' Hz: the quad rocks in pitch and roll about its centre of gravity,
+# so its true velocity is zero.  Gyro and accelerometer biases and noise are added.  Yields the
+# true pitch and roll, and the sensor readings in g's and radians per second.
+#
+###############################################################################################
+def SyntheticIMU(rate, duration, seed = 1):
+    random.seed(seed)
+    dt = 1.0 / rate
+    gyro_bias = (0.01, -0.008, 0.005)
+    accel_bias = (0.005, -0.003, 0.002)
+
+    for step in range(0, int(duration * rate)):
+        t = step * dt
+        pa = 0.10 * math.sin(0.5 * t)
+        ra = 0.08 * math.sin(0.7 * t)
+        pa_rate = 0.05 * math.cos(0.5 * t)
+        ra_rate = 0.056 * math.cos(0.7 * t)
+
+        #-------------------------------------------------------------------------------------
+        # With no yaw, the Euler rates map back to the quad frame like this (see
+        # Body2EulerRates())
+        #-------------------------------------------------------------------------------------
+        qrx = ra_rate + gyro_bias[0] + random.gauss(0.0, 0.01)
+        qry = pa_rate * math.cos(ra) + gyro_bias[1] + random.gauss(0.0, 0.01)
+        qrz = -pa_rate * math.sin(ra) + gyro_bias[2] + random.gauss(0.0, 0.01)
+
+        qax = -math.sin(pa) + accel_bias[0] + random.gauss(0.0, 0.02)
+        qay = math.sin(ra) * math.cos(pa) + accel_bias[1] + random.gauss(0.0, 0.02)
+        qaz = math.cos(pa) * math.cos(ra) + accel_bias[2] + random.gauss(0.0, 0.02)
+
+        yield pa, ra, qax, qay, qaz, qrx, qry, qrz, dt
+
+###############################################################################################
+#
+# The Butterworth + complementary filter attitude and velocity estimation as per the flight
+# loop's attitude task
+#
+###############################################################################################
+class ComplementaryEstimator:
+
+    def __init__(self, rate, tau):
+        self.tau = tau
+        self.bfx = Quadcopter.BUTTERWORTH(rate, 0.20, 4, 0.0)
+        self.bfy = Quadcopter.BUTTERWORTH(rate, 0.20, 4, 0.0)
+        self.bfz = Quadcopter.BUTTERWORTH(rate, 0.20, 4, 1.0)
+        self.pa = 0.0
+        self.ra = 0.0
+        self.ya = 0.0
+        self.qvx = 0.0
+        self.qvy = 0.0
+        self.qvz = 0.0
+
+    def step(self, qax, qay, qaz, qrx, qry, qrz, dt):
+        eax, eay, eaz = Quadcopter.RotateQ2E(qax, qay, qaz, self.pa, self.ra, self.ya)
+        egx = self.bfx.filter(eax)
+        egy = self.bfy.filter(eay)
+        egz = self.bfz.filter(eaz)
+        qgx, qgy, qgz = Quadcopter.RotateE2Q(egx, egy, egz, self.pa, self.ra, self.ya)
+        uap, uar = Quadcopter.GetRotationAngles(qgx, qgy, qgz)
+        urp, urr, ury = Quadcopter.Body2EulerRates(qry, qrx, qrz, uap, uar)
+
+        tau_fraction = self.tau / (self.tau + dt)
+        self.pa = tau_fraction * (self.pa + urp * dt) + (1 - tau_fraction) * uap
+        self.ra = tau_fraction * (self.ra + urr * dt) + (1 - tau_fraction) * uar
+        self.ya += qrz * dt
+
+        qgx, qgy, qgz = Quadcopter.RotateE2Q(egx, egy, egz, self.pa, self.ra, self.ya)
+        self.qvx += (qax - qgx) * dt * GRAV_ACCEL
+        self.qvy += (qay - qgy) * dt * GRAV_ACCEL
+        self.qvz += (qaz - qgz) * dt * GRAV_ACCEL
+
+        return self.pa, self.ra, self.qvx, self.qvy, self.qvz
+
+###############################################################################################
+#
+# EKF per-update cost against the attitude task budget, and its accuracy compared to the
+# complementary filter pipeline on the synthetic data.
+#
+###############################################################################################
+def BenchEKF():
+    rate = 50
+    samples = list(SyntheticIMU(rate, 20))
+
+    ekf = Quadcopter.EKF(GRAV_ACCEL)
+    state = {'index': 0}
+    def update():
+        pa, ra, qax, qay, qaz, qrx, qry, qrz, dt = samples[state['index'] % len(samples)]
+        state['index'] += 1
+        ekf.predict(qax, qay, qaz, qrx, qry, qrz, dt)
+        ekf.update(qax, qay, qaz)
+
+    cf = ComplementaryEstimator(rate, 0.5)
+    def step():
+        pa, ra, qax, qay, qaz, qrx, qry, qrz, dt = samples[state['index'] % len(samples)]
+        state['index'] += 1
+        cf.step(qax, qay, qaz, qrx, qry, qrz, dt)
+
+    ekf_time = TimeIt(update, 5000)
+    cf_time = TimeIt(step, 5000)
+    print("ekf: %.0fus per update, %.1f%% of the %dHz attitude task budget" % (ekf_time, ekf_time * rate / 10000, rate))
+    print("complementary filter: %.0fus per update, %.1f%% of the %dHz attitude task budget" % (cf_time, cf_time * rate / 10000, rate))
+
+    #-----------------------------------------------------------------------------------------
+    # Accuracy over a minute of synthetic data
+    #-----------------------------------------------------------------------------------------
+    ekf = Quadcopter.EKF(GRAV_ACCEL)
+    cf = ComplementaryEstimator(rate, 0.5)
+    ekf_errors = [0.0, 0.0]
+    cf_errors = [0.0, 0.0]
+    count = 0
+    for pa, ra, qax, qay, qaz, qrx, qry, qrz, dt in SyntheticIMU(rate, 60):
+        ekf.predict(qax, qay, qaz, qrx, qry, qrz, dt)
+        ekf.update(qax, qay, qaz)
+        cf_pa, cf_ra, cf_qvx, cf_qvy, cf_qvz = cf.step(qax, qay, qaz, qrx, qry, qrz, dt)
+
+        ekf_errors[0] += (ekf.x[0] - pa) ** 2
+        ekf_errors[1] += (ekf.x[1] - ra) ** 2
+        cf_errors[0] += (cf_pa - pa) ** 2
+        cf_errors[1] += (cf_ra - ra) ** 2
+        count += 1
+
+    print("ekf: rms pitch error %.2f degrees, rms roll error %.2f degrees, velocity drift %.2fm/s" %
+          (math.degrees(math.sqrt(ekf_errors[0] / count)), math.degrees(math.sqrt(ekf_errors[1] / count)),
+           math.sqrt(ekf.x[3] ** 2 + ekf.x[4] ** 2 + ekf.x[5] ** 2)))
+    print("complementary filter: rms pitch error %.2f degrees, rms roll error %.2f degrees, velocity drift %.2fm/s" %
+          (math.degrees(math.sqrt(cf_errors[0] / count)), math.degrees(math.sqrt(cf_errors[1] / count)),
+           math.sqrt(cf_qvx ** 2 + cf_qvy ** 2 + cf_qvz ** 2)))
+
+
+###############################################################################################
+#
+# A stand-in smbus backed by a bank of 256 registers per address.  A transfer fails with
+# probability 'failure_rate', or every transfer fails while 'dead' is set.  Writes are counted
+# per register, and transfers in total.
+#
+# A device attach()ed to an MPU6050's auxiliary i2c bus can only be reached directly with the
+# MPU6050's i2c bypass on and its i2c master off.  With the i2c master on, a block read from the
+# MPU6050 first copies what slave 0 is set to read into EXT_SENS_DATA_00 onwards, as the chip
+# does each sample.
+#
+###############################################################################################
+class FakeBus:
+
+    def __init__(self, failure_rate = 0.0, seed = 1):
+        self.failure_rate = failure_rate
+        self.dead = False
+        self.random = random.Random(seed)
+        self.registers = {}
+        self.writes = {}
+        self.transfers = 0
+        self.auxiliary = {}
+
+    def transfer(self, address):
+        self.transfers += 1
+        if self.dead or self.random.random() < self.failure_rate:
+            raise IOError(121, "Remote I/O error")
+
+        if address in self.auxiliary:
+            master = self.bank(self.auxiliary[address])
+            if master[0x6A] & 0x20 or not master[0x37] & 0x02:
+                raise IOError(121, "Remote I/O error")
+
+    def bank(self, address):
+        if address not in self.registers:
+            self.registers[address] = [0] * 256
+        return self.registers[address]
+
+    def attach(self, master, address, registers):
+        self.auxiliary[address] = master
+        bank = self.bank(address)
+        for reg in registers:
+            bank[reg] = registers[reg]
+
+    def masterRead(self, address):
+        bank = self.bank(address)
+        if bank[0x6A] & 0x20 and bank[0x27] & 0x80 and bank[0x25] & 0x80:
+            slave = self.bank(bank[0x25] & 0x7F)
+            length = bank[0x27] & 0x0F
+            bank[0x49:0x49 + length] = slave[bank[0x26]:bank[0x26] + length]
+
+    def write(self, address, reg, values):
+        bank = self.bank(address)
+        for index in range(0, len(values)):
+            bank[reg + index] = values[index] & 0xFF
+            self.writes[reg + index] = self.writes.get(reg + index, 0) + 1
+
+    def read_byte_data(self, address, reg):
+        self.transfer(address)
+        return self.bank(address)[reg]
+
+    def write_byte_data(self, address, reg, value):
+        self.transfer(address)
+        self.write(address, reg, [value])
+
+    def read_i2c_block_data(self, address, reg, length):
+        self.transfer(address)
+        self.masterRead(address)
+        return self.bank(address)[reg:reg + length]
+
+    def write_i2c_block_data(self, address, reg, list):
+        self.transfer(address)
+        self.write(address, reg, list)
+
+###############################################################################################
+#
+# I2C retry cost on a clean and a flaky bus, and the circuit breaker tripping on a dead bus and
+# recovering once it's back.
+#
+###############################################################################################
+def BenchI2C():
+    Quadcopter.logger = logging.getLogger('qcbench')
+    logging.basicConfig(level = logging.CRITICAL, format = '%(message)s')
+
+    for failure_rate in (0.0, 0.01, 0.10):
+        i2c = Quadcopter.I2C(0x68, FakeBus(failure_rate))
+        failures = [0]
+        def read():
+            try:
+                i2c.readList(0x3B, 14)
+            except IOError:
+                failures[0] += 1
+        read_time = TimeIt(read, 20000)
+        print("failure rate %.2f: %.1fus per read, %d misses, %d failed reads, breaker %s" %
+              (failure_rate, read_time, i2c.misses, failures[0], "open" if i2c.breakerOpen() else "closed"))
+        i2c.report()
+
+    bus = FakeBus(0.0)
+    i2c = Quadcopter.I2C(0x68, bus)
+    bus.dead = True
+    start_time = time.time()
+    for attempt in range(0, 20):
+        try:
+            i2c.readU8(0x75)
+        except IOError:
+            pass
+    print("dead bus: breaker %s after %d failed reads in %.1fms" %
+          ("open" if i2c.breakerOpen() else "closed", i2c.failures, (time.time() - start_time) * 1000))
+
+    bus.dead = False
+    time.sleep(Quadcopter.I2C._BREAKER_COOLDOWN)
+    i2c.readU8(0x75)
+    print("bus back: breaker %s" % ("open" if i2c.breakerOpen() else "closed"))
+
+
+###############################################################################################
+#
+# The data ready waiter on its pipe and eventfd stand-ins: edges one at a time, edges missed
+# while busy that coalesce into one wakeup, and a stuck line timing out.  Wakeup latency is
+# measured against a thread raising edges at the MPU6050's 1kHz.
+#
+###############################################################################################
+def BenchDataReady():
+    Quadcopter.logger = logging.getLogger('qcbench')
+    logging.basicConfig(level = logging.CRITICAL, format = '%(message)s')
+
+    def pipeEdges(write_fd, count):
+        os.write(write_fd, b"\x01" * count)
+
+    def eventfdEdges(waiter, count):
+        os.write(waiter.fd, Quadcopter.DataReadyWaiter._EVENTFD.pack(count))
+
+    pipe_waiter, write_fd = Quadcopter.DataReadyWaiter.fromPipe()
+    eventfd_waiter = Quadcopter.DataReadyWaiter.fromEventfd()
+    for waiter, edges in ((pipe_waiter, lambda count: pipeEdges(write_fd, count)),
+                          (eventfd_waiter, lambda count: eventfdEdges(eventfd_waiter, count))):
+        edges(1)
+        single = waiter.wait()
+        edges(3)
+        missed = waiter.wait()
+
+        start_time = time.time()
+        stuck_waits = 0
+        while not waiter.stuck():
+            waiter.wait()
+            stuck_waits += 1
+        stuck_time = time.time() - start_time
+
+        print("%s: single edge %d, 3 missed edges %d in one wakeup, stuck after %d waits / %.0fms (timeout %.0fms)" %
+              (waiter.source, single, missed, stuck_waits, stuck_time * 1000, waiter.timeout * 1000))
+
+        edges(1)
+        waiter.wait()
+        print("%s: edge after stuck %s" % (waiter.source, "clears it" if not waiter.stuck() else "doesn't clear it"))
+        waiter.report()
+
+    #-------------------------------------------------------------------------------------------
+    # Latency from edge to wakeup at 1kHz
+    #-------------------------------------------------------------------------------------------
+    edge_times = []
+    def raiseEdges():
+        for edge in range(0, 1000):
+            time.sleep(0.001)
+            edge_times.append(time.time())
+            os.write(write_fd, b"\x01")
+
+    thread = Quadcopter.thread
+    thread.start_new_thread(raiseEdges, ())
+    latencies = []
+    edges = 0
+    while edges < 1000:
+        count = pipe_waiter.wait(0.1)
+        if not count:
+            break
+        edges += count
+        latencies.append(pipe_waiter.timestamp - edge_times[edges - 1])
+
+    latencies.sort()
+    print("1kHz edges: %d wakeups for %d edges, latency median %.0fus, 99%% %.0fus, max %.0fus" %
+          (len(latencies), edges, latencies[len(latencies) // 2] * 1000000, latencies[int(len(latencies) * 0.99)] * 1000000, latencies[-1] * 1000000))
+
+    pipe_waiter.close()
+    os.close(write_fd)
+    eventfd_waiter.close()
+
+###############################################################################################
+#
+# The watchdog against a fake motion loop beating at 200Hz: short stalls are measured but
+# tolerated, then the beats stop and the watchdog should trip, fly its descent and cut the motors.
+# A second watchdog is handed the motors by failsafe(), as the motion loop does when the i2c bus
+# or data ready interrupt fails: it must take them before its deadline and fly the whole descent
+# before stop() returns.  The pulse widths it sets are recorded in shared memory in place of
+# driving the PWM.
+#
+###############################################################################################
+class FakeESC:
+
+    def __init__(self, pin, pulse_width):
+        self.bcm_pin = pin
+        self.pulse_width = pulse_width
+
+
+def BenchWatchdog():
+    Quadcopter.logger = logging.getLogger('qcbench')
+    logging.basicConfig(level = logging.CRITICAL, format = '%(message)s')
+
+    esc_list = [FakeESC(pin, 1400 + pin) for pin in range(0, 4)]
+    pulses = multiprocessing.RawArray('i', 64)
+    pulse_count = multiprocessing.RawValue('i', 0)
+    def pulse(pin, pulse_width):
+        if pin == 0 and pulse_count.value < len(pulses):
+            pulses[pulse_count.value] = pulse_width
+            pulse_count.value += 1
+
+    descent = ((0.05, 0.9), (0.05, 0.7), (0.05, 0.5))
+    watchdog = Quadcopter.Watchdog([esc.bcm_pin for esc in esc_list], descent = descent, pulse = pulse)
+
+    #-------------------------------------------------------------------------------------------
+    # 1s of beats with 20ms and 40ms stalls partway through, neither beyond the 50ms deadline
+    #-------------------------------------------------------------------------------------------
+    beat_time = TimeIt(lambda: watchdog.beat(esc_list), 10000, 1)
+    for beat in range(0, 200):
+        if beat == 50:
+            time.sleep(0.02)
+        elif beat == 100:
+            time.sleep(0.04)
+        time.sleep(0.005)
+        watchdog.beat(esc_list)
+    print("beat %.1fus, tripped after stalls: %s" % (beat_time, watchdog.tripped()))
+
+    #-------------------------------------------------------------------------------------------
+    # Now stall for good
+    #-------------------------------------------------------------------------------------------
+    start_time = time.time()
+    while not watchdog.tripped() and time.time() - start_time < 1.0:
+        time.sleep(0.001)
+    print("stalled: tripped %s after %.0fms" % (watchdog.tripped(), (time.time() - start_time) * 1000))
+
+    watchdog.stop()
+    print("descent pulse widths: %s" % list(pulses[0:pulse_count.value]))
+    watchdog.report()
+
+    #-------------------------------------------------------------------------------------------
+    # Failsafe after a few beats
+    #-------------------------------------------------------------------------------------------
+    pulse_count.value = 0
+    watchdog = Quadcopter.Watchdog([esc.bcm_pin for esc in esc_list], descent = descent, pulse = pulse)
+    for beat in range(0, 20):
+        time.sleep(0.005)
+        watchdog.beat(esc_list)
+    start_time = time.time()
+    tripped = watchdog.failsafe()
+    failsafe_time = time.time() - start_time
+    watchdog.stop()
+    failsafe_pulses = list(pulses[0:pulse_count.value])
+    print("failsafe: took the motors in %.1fms, descent pulse widths: %s" % (failsafe_time * 1000, failsafe_pulses))
+    watchdog.report()
+    if not tripped or failsafe_time >= watchdog.deadline or len(failsafe_pulses) != len(descent) + 1 or failsafe_pulses[-1] != 1000:
+        raise AssertionError("failsafe descent not flown")
+
+###############################################################################################
+#
+# MPU6050 register shadow and runtime reconfiguration on the stand-in bus: redundant writes are
+# skipped, a register the device won't hold is caught on read back, and a range change scales
+# the raw data to match.  Initialization takes a few seconds as per the real chip.
+#
+###############################################################################################
+def BenchMPU6050():
+    Quadcopter.logger = logging.getLogger('qcbench')
+    logging.basicConfig(level = logging.CRITICAL, format = '%(message)s')
+
+    bus = FakeBus()
+    mpu6050 = Quadcopter.MPU6050(0x68, 3, 1, bus)
+    print("init: %d register writes, %d registers shadowed" % (sum(bus.writes.values()), len(mpu6050.registers)))
+
+    bus.writes = {}
+    mpu6050.setDLPF(glpf = 1, alpf = 3)
+    mpu6050.setGyroRange(1000)
+    mpu6050.setAccelRange(8)
+    mpu6050.applyConfig()
+    print("reconfigure: %d register writes, %d skipped, range factors %s" % (sum(bus.writes.values()), mpu6050.skipped_writes, mpu6050.range_factors))
+
+    #-----------------------------------------------------------------------------------------
+    # The same 1g and 1 degree/s at the new ranges reads as at the default ones
+    #-----------------------------------------------------------------------------------------
+    accel = int(65536 / (2 * 8))
+    gyro = int(65536 / (2 * 1000))
+    data = [accel >> 8, accel & 0xFF, 0, 0, 0, 0, 0, 0, gyro >> 8, gyro & 0xFF, 0, 0, 0, 0]
+    bus.write(0x68, 0x3B, data)
+    mpu6050.readSensors()
+    ax, ay, az, gx, gy, gz = mpu6050.readSensors()
+    print("1g reads %.3fg, 1 degree/s reads %.3f degrees/s" % (ax * 4.0 / 65536, gx * 500.0 / 65536))
+
+    #-----------------------------------------------------------------------------------------
+    # A device that doesn't hold the value written
+    #-----------------------------------------------------------------------------------------
+    mpu6050.writeRegister(0x1A, 0x05)
+    bus.bank(0x68)[0x1A] = 0x00
+    print("read back: %d mismatches" % mpu6050.verifyRegisters())
+
+###############################################################################################
+#
+# Raw IMU capture: the cost per sample of MPU6050.readSensors() on the stand-in bus with and
+# without the capture, and that of the record itself, against the 1ms sample period.  Then the
+# ring is written 2.5 times round and read back: the header must count every sample, and the
+# records from the oldest kept on must be the latest samples, with their throttle, in order.
+#
+###############################################################################################
+def CaptureFile():
+    return os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else ".", "qcbench-imu")
+
+def BenchCapture():
+    Quadcopter.logger = logging.getLogger('qcbench')
+    logging.basicConfig(level = logging.CRITICAL, format = '%(message)s')
+
+    bus = FakeBus()
+    mpu6050 = Quadcopter.MPU6050(0x68, 3, 1, bus)
+    capture = Quadcopter.ImuCapture(CaptureFile(), 1000)
+    iterations = 100000
+
+    read_time = TimeIt(mpu6050.readSensors, iterations)
+    mpu6050.capture = capture
+    capture_time = TimeIt(mpu6050.readSensors, iterations)
+    data = bus.read_i2c_block_data(0x68, 0x3B, 14)
+    record_time = TimeIt(lambda: capture.record(data), iterations)
+    capture.close()
+    print("readSensors %.2fus, with capture %.2fus, record %.2fus: %.2f%% of the 1ms sample period" %
+          (read_time, capture_time, record_time, record_time / 10))
+
+    capacity = 1000
+    capture = Quadcopter.ImuCapture(CaptureFile(), capacity, 2, 4)
+    samples = [[(sample * 14 + index) & 0xFF for index in range(0, 14)] for sample in range(0, capacity * 5 // 2)]
+    for index, sample in enumerate(samples):
+        capture.throttle = index % 1000
+        capture.record(sample)
+    capture.close()
+
+    with open(capture.file_name, "rb") as capture_file:
+        contents = capture_file.read()
+    os.remove(capture.file_name)
+
+    header = Quadcopter.ImuCapture.HEADER
+    record = Quadcopter.ImuCapture.RECORD
+    magic, version, record_size, file_capacity, count, start_time, accel_factor, gyro_factor = header.unpack_from(contents, 0)
+    oldest = count - min(count, file_capacity)
+    mismatches = 0
+    last_time = start_time
+    for sample in range(oldest, count):
+        fields = record.unpack_from(contents, header.size + (sample % file_capacity) * record_size)
+        if list(fields[1:15]) != samples[sample] or fields[15] != sample % 1000 or fields[0] < last_time:
+            mismatches += 1
+        last_time = fields[0]
+    print("%s v%d: %d samples written, %d kept, %d mismatches, range factors %d / %d" %
+          (magic.decode(), version, count, count - oldest, mismatches, accel_factor, gyro_factor))
+    if count != len(samples) or mismatches:
+        raise AssertionError("capture ring corrupt")
+
+
+###############################################################################################
+#
+# qcspectrum.py on a synthetic capture written by ImuCapture: 60s at 1kHz with the throttle
+# ramping from 300 to 700 and motor vibration at 0.25Hz per unit of throttle on every axis, over
+# noise.  The time stamps are rewritten to the 1kHz sample times as the writer here isn't paced
+# by an IMU.  The motor vibration line must be found against throttle, and streaming the
+# capture in small chunks must give the same PSDs as reading it in one.  The vibration's lowest
+# peaks, around 80Hz on both sensors, must give --glpf 4 (20Hz) and --alpf 3 (41Hz).  Its sweep
+# passes 100Hz and 150Hz, which alias to 0Hz at the 50Hz attitude rate, so the Butterworth's
+# cutoff must be set by a peak near one of those, unfloored, with every aliased peak then
+# rejected by BUTTERWORTH_REJECTION between the averaging and the Butterworth.
+#
+###############################################################################################
+def BenchSpectrum():
+    try:
+        import numpy
+        import qcspectrum
+    except ImportError:
+        print("NumPy not installed")
+        return
+
+    rate = 1000
+    duration = 60
+    capture = Quadcopter.ImuCapture(CaptureFile(), rate * duration)
+    generator = numpy.random.RandomState(1)
+    phase = 0.0
+    for sample in range(0, rate * duration):
+        throttle = 300 + 400 * sample / (rate * duration)
+        phase += 2 * math.pi * 0.25 * throttle / rate
+        vibration = math.sin(phase)
+        noise = generator.normal(0.0, 50.0, 6)
+        values = [int(1600 * vibration + noise[0]), int(1200 * vibration + noise[1]), int(16384 + 2400 * vibration + noise[2]), 3000,
+                  int(800 * vibration + noise[3]), int(800 * vibration + noise[4]), int(400 * vibration + noise[5])]
+        capture.throttle = int(throttle)
+        capture.record(bytearray(struct.pack(">7h", *values)))
+    capture.close()
+
+    records = numpy.memmap(capture.file_name, dtype = qcspectrum.RECORD, mode = "r+", offset = qcspectrum.HEADER.size)
+    records["time"] = numpy.arange(len(records)) / rate
+    records.flush()
+    del records
+
+    try:
+        start_time = time.time()
+        stream, summary = qcspectrum.Analyse(qcspectrum.Capture(capture.file_name), chunk = 1000)
+        stream_time = time.time() - start_time
+        whole_stream, whole_summary = qcspectrum.Analyse(qcspectrum.Capture(capture.file_name), chunk = rate * duration)
+    finally:
+        os.remove(capture.file_name)
+
+    difference = numpy.max(numpy.abs(stream.psd() - whole_stream.psd())) / numpy.max(whole_stream.psd())
+    print("%d samples in 1000 sample chunks in %.2fs, relative PSD difference from one chunk %g" % (summary["samples"], stream_time, difference))
+    qcspectrum.Report(summary)
+    fit = summary["motor_vibration"]
+    if fit is None or abs(fit["hz_per_throttle"] - 0.25) > 0.02 or difference > 1e-9:
+        raise AssertionError("motor vibration not found or chunking changed the PSDs")
+
+    recommendations = summary["recommendations"]
+    if recommendations["glpf"]["setting"] != 4 or recommendations["alpf"]["setting"] != 3:
+        raise AssertionError("DLPF recommendations --glpf %d, --alpf %d" % (recommendations["glpf"]["setting"], recommendations["alpf"]["setting"]))
+
+    butterworth = recommendations["butterworth"]
+    cutoff = butterworth["cutoff"]
+    peak = butterworth["limiting_peak"]
+    rejections = [aliased_peak["averaging_db"] + 10 * math.log10(1 + (aliased_peak["aliased"] / cutoff) ** (2 * qcspectrum.BUTTERWORTH_ORDER))
+                  for aliased_peak in butterworth["aliased_peaks"]]
+    print("Butterworth: %.3fHz, least rejection of an aliased peak %.1fdB" % (cutoff, min(rejections)))
+    if (butterworth["floored"] or not qcspectrum.BUTTERWORTH_MIN_CUTOFF <= cutoff < butterworth["attitude_rate"] / 10 or
+        peak is None or min(abs(peak["frequency"] - 100.0), abs(peak["frequency"] - 150.0)) > 5.0 or
+        min(rejections) < qcspectrum.BUTTERWORTH_REJECTION - 0.01):
+        raise AssertionError("Butterworth recommendation %.3fHz" % cutoff)
+
+
+###############################################################################################
+#
+# The startup phases that run off the Pi timed by the PhaseTimer as go() does, with its report:
+# the MPU6050 initialization (mostly its settling sleeps) and gyro calibration on the stand-in
+# bus, the math kernels and the control loop set up.
+#
+###############################################################################################
+def BenchStartup():
+    Quadcopter.logger = logging.getLogger('qcbench')
+    logging.basicConfig(level = logging.CRITICAL, format = '%(message)s')
+
+    phase_timer = Quadcopter.PhaseTimer()
+    Quadcopter.EnableKernels()
+    Quadcopter.WarmKernels()
+    phase_timer.lap("kernels")
+
+    mpu6050 = Quadcopter.MPU6050(0x68, 3, 1, FakeBus())
+    phase_timer.lap("MPU6050")
+
+    mpu6050.calibrateGyros()
+    phase_timer.lap("calibrateGyros")
+
+    MakeControlLoop()
+    phase_timer.lap("PID setup")
+    phase_timer.report()
+
+
+###############################################################################################
+#
+# The temperature model's recursive least squares on a synthetic warm-up: 10 minutes of averaged
+# readings at 25Hz (the attitude period's decimation) while the chip warms from 25 to 40oC, with
+# offsets drifting linearly plus noise.  Starting from the built-in model, the fit must match
+# the batch least squares fit of the same samples and predict the true offsets to within a few
+# LSBs across the range.  The cost per update is timed, and the model saved and loaded back.
+#
+###############################################################################################
+RLS_RATE = 25
+RLS_DURATION = 600
+
+def BenchTemperatureModel():
+    Quadcopter.logger = logging.getLogger('qcbench')
+    logging.basicConfig(level = logging.CRITICAL, format = '%(message)s')
+
+    random.seed(1)
+    true_intercepts = [random.uniform(-500.0, 500.0) for axis in range(0, 6)]
+    true_slopes = [random.uniform(-0.1, 0.1) for axis in range(0, 6)]
+    samples = []
+    for index in range(0, RLS_RATE * RLS_DURATION):
+        celsius = 40.0 - 15.0 * math.exp(-index / (RLS_RATE * 120.0))
+        temperature = int(round((celsius - 21.0) * 333.87))
+        samples.append((temperature, [a + b * temperature + random.gauss(0.0, 5.0) for a, b in zip(true_intercepts, true_slopes)]))
+
+    builtin = Quadcopter.TemperatureModel((20.7368135, 50.97993518, 449.0789668, 0.0, 0.0, 0.0), (0.00557761, 0.016785824, -0.038043957, 0.0, 0.0, 0.0))
+    model = Quadcopter.TemperatureModel(builtin.intercepts(), builtin.slopes)
+    for temperature, offsets in samples:
+        model.update(temperature, offsets)
+
+    #-----------------------------------------------------------------------------------------
+    # Batch least squares for comparison, and the worst prediction error over 25 to 40oC
+    #-----------------------------------------------------------------------------------------
+    n = len(samples)
+    mean_t = sum(temperature for temperature, offsets in samples) / n
+    stt = sum((temperature - mean_t) ** 2 for temperature, offsets in samples)
+    span = [(25.0 - 21.0) * 333.87, (40.0 - 21.0) * 333.87]
+    for axis, name in enumerate(Quadcopter.TemperatureModel.AXES):
+        mean_o = sum(offsets[axis] for temperature, offsets in samples) / n
+        batch_slope = sum((temperature - mean_t) * (offsets[axis] - mean_o) for temperature, offsets in samples) / stt
+        batch_intercept = mean_o - batch_slope * mean_t
+        intercept = model.intercepts()[axis]
+        slope = model.slopes[axis]
+        error = max(abs(intercept + slope * t - true_intercepts[axis] - true_slopes[axis] * t) for t in span)
+        batch_difference = max(abs(intercept + slope * t - batch_intercept - batch_slope * t) for t in span)
+        print("%s: slope %f (true %f), worst offset error %.2f LSB, %.3f LSB from batch least squares" % (name, slope, true_slopes[axis], error, batch_difference))
+        if error > 5.0:
+            raise AssertionError("%s offset error %.2f LSB" % (name, error))
+
+    state = {'index': 0}
+    def update():
+        temperature, offsets = samples[state['index'] % n]
+        state['index'] += 1
+        model.update(temperature, offsets)
+    print("%d samples, %.1fus per update" % (n, TimeIt(update, 10000)))
+
+    file_name = "qcbench-tempmodel.csv"
+    model.save(file_name)
+    loaded = Quadcopter.TemperatureModel.load(file_name)
+    os.remove(file_name)
+    difference = max(abs(a - b) for a, b in zip(model.intercepts() + model.slopes, loaded.intercepts() + loaded.slopes))
+    print("saved and loaded back: max difference %g" % difference)
+
+
+###############################################################################################
+#
+# The PID bank against the equivalent PIDs: results must be identical with the options off,
+# through compute() and through BankedPIDs, and a PID given an output limit by configurePID()
+# must keep to it.  The time per motion loop is compared for the velocity task's four PIDs and
+# the rate task's three, timed in alternation PID_RUNS times each, and the median of each and
+# of the pairs' differences shown, along with the differences' range as the noise to read it
+# against: what the bank costs the PIDs that want its options.
+#
+###############################################################################################
+PID_RUNS = 9
+
+def BenchPIDBank():
+    random.seed(1)
+    gains = [(random.uniform(0.0, 2.0), random.uniform(0.0, 1.0), random.uniform(0.0, 0.1)) for index in range(0, 7)]
+    velocity_pids = (Quadcopter.PID_QVX, Quadcopter.PID_QVY, Quadcopter.PID_QVZ, Quadcopter.PID_YA)
+    rate_pids = (Quadcopter.PID_PR, Quadcopter.PID_RR, Quadcopter.PID_YR)
+    samples = [([random.gauss(0.0, 1.0) for index in range(0, 7)], [random.gauss(0.0, 1.0) for index in range(0, 7)], random.uniform(0.004, 0.006)) for sample in range(0, 1000)]
+
+    pids = [Quadcopter.PID(p_gain, i_gain, d_gain) for p_gain, i_gain, d_gain in gains]
+    pid_bank = Quadcopter.PIDBank(gains)
+    banked_pids = [Quadcopter.BankedPID(Quadcopter.PIDBank(gains), index) for index in range(0, 7)]
+    mismatches = 0
+    for inputs, targets, dt in samples:
+        outputs = pid_bank.compute(velocity_pids, inputs[0:4], targets[0:4], dt)
+        outputs = pid_bank.compute(rate_pids, inputs[4:7], targets[4:7], dt)
+        for index in range(0, 7):
+            output = pids[index].Compute(inputs[index], targets[index], dt)
+            banked_output = banked_pids[index].Compute(inputs[index], targets[index], dt)
+            if output != outputs[index] or banked_output != output or banked_pids[index].d_out != pids[index].d_out:
+                mismatches += 1
+    print("pid bank: %d mismatches against the PIDs over %d loops" % (mismatches, len(samples)))
+
+    Quadcopter.logger = logging.getLogger('qcbench.pid')
+    Quadcopter.logger.disabled = True
+    control_loop = MakeControlLoop()
+    control_loop.configurePID(Quadcopter.PID_PR, output_limit = 10.0)
+    limited_output = control_loop.pids[Quadcopter.PID_PR].Compute(0.0, 100.0, 0.005)
+    unbanked = sum([isinstance(pid, Quadcopter.PID) for pid in control_loop.pids])
+    print("configurePID: output %.1f against a limit of 10.0, %d of %d PIDs left unbanked" % (limited_output, unbanked, len(control_loop.pids)))
+    if mismatches or limited_output != 10.0 or unbanked != len(control_loop.pids) - 1:
+        raise AssertionError("PID bank results differ from the PIDs'")
+
+    state = {'index': 0}
+    def loopPIDs():
+        inputs, targets, dt = samples[state['index'] % len(samples)]
+        state['index'] += 1
+        qvx_pid, qvy_pid, qvz_pid, ya_pid, pr_pid, rr_pid, yr_pid = pids
+        qvx_out = qvx_pid.Compute(inputs[0], targets[0], dt)
+        qvy_out = qvy_pid.Compute(inputs[1], targets[1], dt)
+        qvz_out = qvz_pid.Compute(inputs[2], targets[2], dt)
+        yr_target = ya_pid.Compute(inputs[3], targets[3], dt)
+        pr_out = pr_pid.Compute(inputs[4], targets[4], dt)
+        rr_out = rr_pid.Compute(inputs[5], targets[5], dt)
+        yr_out = yr_pid.Compute(inputs[6], targets[6], dt)
+
+    PID_QVX, PID_QVY, PID_QVZ, PID_YA, PID_PR, PID_RR, PID_YR = velocity_pids + rate_pids
+    def loopBank():
+        inputs, targets, dt = samples[state['index'] % len(samples)]
+        state['index'] += 1
+        pid_outputs = pid_bank.compute(velocity_pids, (inputs[0], inputs[1], inputs[2], inputs[3]), (targets[0], targets[1], targets[2], targets[3]), dt)
+        qvx_out = pid_outputs[PID_QVX]
+        qvy_out = pid_outputs[PID_QVY]
+        qvz_out = pid_outputs[PID_QVZ]
+        yr_target = pid_outputs[PID_YA]
+        pid_outputs = pid_bank.compute(rate_pids, (inputs[4], inputs[5], inputs[6]), (targets[4], targets[5], targets[6]), dt)
+        pr_out = pid_outputs[PID_PR]
+        rr_out = pid_outputs[PID_RR]
+        yr_out = pid_outputs[PID_YR]
+
+    def median(values):
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    pids_times = []
+    bank_times = []
+    for run in range(0, PID_RUNS):
+        pids_times.append(TimeIt(loopPIDs, 20000, 3))
+        bank_times.append(TimeIt(loopBank, 20000, 3))
+    differences = sorted([bank_time - pids_time for pids_time, bank_time in zip(pids_times, bank_times)])
+    print("7 PIDs: %.2fus per loop, PID bank: %.2fus per loop, difference %+.2fus (pairs %+.2fus to %+.2fus)" %
+          (median(pids_times), median(bank_times), median(differences), differences[0], differences[-1]))
+
+    #-----------------------------------------------------------------------------------------
+    # With every option on, for the cost of the slow path
+    #-----------------------------------------------------------------------------------------
+    for index in range(0, 7):
+        pid_bank.configure(index, i_limit = 10.0, d_on_measurement = True, d_tau = 0.02, output_limit = 100.0)
+    options_time = TimeIt(loopBank, 20000, 20)
+    print("PID bank, all options on: %.2fus per loop" % options_time)
+
+###############################################################################################
+#
+# FlightState snapshots: round trip through the struct layout, and the cost of a snapshot into
+# the state's own buffer and into a preallocated ring of frames as a recorder would use.  With
+# tracemalloc, a snapshot mustn't allocate beyond FLIGHT_STATE_TRANSIENT bytes per call: room
+# for the field loop's iterator and the odd int, where a tuple of the fields takes ~900.
+#
+###############################################################################################
+FLIGHT_STATE_TRANSIENT = 128
+
+def BenchFlightState():
+    flight_state = Quadcopter.FlightState()
+    random.seed(1)
+    for name, code in Quadcopter.FLIGHT_STATE_LAYOUT:
+        if code == 'd':
+            setattr(flight_state, name, random.gauss(0.0, 1.0))
+        elif code == 'i':
+            setattr(flight_state, name, random.randint(-1000, 1000))
+
+    fields = Quadcopter.FlightState.unpack(flight_state.snapshot())
+    mismatches = 0
+    for name, value in zip(Quadcopter.FlightState.FIELDS, fields):
+        if getattr(flight_state, name) != value:
+            mismatches += 1
+    print("flight state: %d fields, %d bytes per snapshot, %d round trip mismatches" % (len(fields), flight_state.size(), mismatches))
+
+    frames = 1000
+    ring = bytearray(flight_state.size() * frames)
+    state = {'index': 0}
+    def snapshotRing():
+        flight_state.snapshot(ring, (state['index'] % frames) * flight_state.size())
+        state['index'] += 1
+
+    print("snapshot: %.1fus to own buffer, %.1fus to ring" % (TimeIt(flight_state.snapshot, 20000), TimeIt(snapshotRing, 20000)))
+
+    try:
+        import tracemalloc
+        tracemalloc.reset_peak
+    except (ImportError, AttributeError):
+        print("tracemalloc.reset_peak() not available for the allocation check")
+        return
+
+    tracemalloc.start()
+    try:
+        own_peak = TransientPeak(tracemalloc, flight_state.snapshot)
+        ring_peak = TransientPeak(tracemalloc, snapshotRing)
+    finally:
+        tracemalloc.stop()
+    print("transient peak per snapshot: %d bytes to own buffer, %d bytes to ring" % (own_peak, ring_peak))
+    if mismatches or max(own_peak, ring_peak) > FLIGHT_STATE_TRANSIENT:
+        raise AssertionError("snapshot round trip mismatches or allocations")
+
+###############################################################################################
+#
+# A ControlLoop set up as per the default CLI, with no scaling so it takes data in g's and
+# radians per second, in velocity hold control mode unless another is given.
+#
+###############################################################################################
+def MakeControlLoop(use_ekf = False, rate_period = 5, attitude_period = 20, velocity_period = 20, plan_period = 20, mode = None):
+    gains = [(0.6, 0.3, 0.0), (0.6, 0.3, 0.0), (360.0, 180.0, 0.0), (6.0, 3.0, 1.0), (120.0, 60.0, 0.0), (110.0, 55.0, 0.0), (50.0, 25.0, 0.0), (2.0, 0.5, 0.0), (2.0, 0.5, 0.0)]
+    if mode is None:
+        mode = Quadcopter.VelocityHold()
+    motors = [(Quadcopter.MOTOR_LOCATION_FRONT | Quadcopter.MOTOR_LOCATION_LEFT, Quadcopter.MOTOR_ROTATION_ACW),
+              (Quadcopter.MOTOR_LOCATION_FRONT | Quadcopter.MOTOR_LOCATION_RIGHT, Quadcopter.MOTOR_ROTATION_CW),
+              (Quadcopter.MOTOR_LOCATION_BACK | Quadcopter.MOTOR_LOCATION_LEFT, Quadcopter.MOTOR_ROTATION_CW),
+              (Quadcopter.MOTOR_LOCATION_BACK | Quadcopter.MOTOR_LOCATION_RIGHT, Quadcopter.MOTOR_ROTATION_ACW)]
+
+    flight_state = Quadcopter.FlightState()
+    flight_state.keep_looping = True
+    control_loop = Quadcopter.ControlLoop(flight_state, gains, motors, 1000, rate_period, attitude_period, velocity_period, plan_period, 0.5, 600, 1.5, mode, use_ekf, GRAV_ACCEL)
+    control_loop.start(0.0, 0.0, 0.0, 0.0, 0.0, 1.0)
+    return control_loop
+
+###############################################################################################
+#
+# The flight code run through the whole flight plan on synthetic IMU data, timing each step
+# against the motion loop budget.
+#
+###############################################################################################
+def BenchControlLoop():
+    Quadcopter.logger = logging.getLogger('qcbench')
+    logging.basicConfig(level = logging.CRITICAL, format = '%(message)s')
+
+    for use_ekf in (False, True):
+        control_loop = MakeControlLoop(use_ekf)
+        flight_state = control_loop.flight_state
+        samples = [(qax, qay, qaz, qrx, qry, qrz, dt) for pa, ra, qax, qay, qaz, qrx, qry, qrz, dt in SyntheticIMU(200, 15)]
+
+        steps = 0
+        start_time = time.time()
+        for qax, qay, qaz, qrx, qry, qrz, dt in samples:
+            motor_outputs = control_loop.step((qax, qay, qaz, qrx, qry, qrz), dt)
+            steps += 1
+            if not flight_state.keep_looping:
+                break
+        step_time = (time.time() - start_time) * 1000000 / steps
+
+        print("%s: flight plan done after %d steps, %.0fus per step, %.1f%% of the 200Hz budget" %
+              ("ekf" if use_ekf else "complementary filter", steps, step_time, step_time / 50))
+        control_loop.scheduler.report()
+
+###############################################################################################
+#
+# A crude quad simulator closing the loop around a ControlLoop.  The motor outputs, mixed as per
+# the ControlLoop's mixer, angularly accelerate the quad against some drag, and their total lifts
+# it, with the hover target's worth on each motor balancing gravity.  As per SyntheticIMU(),
+# horizontal motion is taken to be held steady by drag, so the accelerometers see only gravity
+# and the vertical acceleration, with noise.  Until it takes off, the quad sits still on its
+# take-off platform at the initial angles, as it did through the warm-up.  'torques' is a constant
+# disturbance to the pitch, roll and yaw angular accelerations, as if from an off-centre CoG.
+#
+###############################################################################################
+SIM_ANGULAR_GAIN = 0.05
+SIM_ANGULAR_DRAG = 1.0
+
+class QuadSim:
+
+    def __init__(self, control_loop, hover_target, pa = 0.0, ra = 0.0, torques = (0.0, 0.0, 0.0), seed = 1):
+        random.seed(seed)
+        self.control_loop = control_loop
+        self.hover_target = hover_target
+        self.torques = list(torques)
+        self.pa = pa
+        self.ra = ra
+        self.ya = 0.0
+        self.pa_rate = 0.0
+        self.ra_rate = 0.0
+        self.ya_rate = 0.0
+        self.vz = 0.0
+        self.height = 0.0
+        self.elapsed_time = 0.0
+        self.motor_outputs = list(control_loop.motor_outputs)
+
+        #-------------------------------------------------------------------------------------------
+        # Prime the gravity filters with 20s sitting on the platform, as go()'s warm-up does
+        #-------------------------------------------------------------------------------------------
+        for loop in range(0, 1000):
+            control_loop.bfx.filter(0.0)
+            control_loop.bfy.filter(0.0)
+            control_loop.bfz.filter(1.0)
+        control_loop.start(pa, ra, 0.0, 0.0, 0.0, 1.0)
+
+    def step(self, dt = 0.005):
+        control_loop = self.control_loop
+        motor_outputs = self.motor_outputs
+        thrust = sum(motor_outputs) / (len(motor_outputs) * self.hover_target)
+
+        vz_rate = (thrust * math.cos(self.pa) * math.cos(self.ra) - 1.0) * GRAV_ACCEL
+        if self.height <= 0.0 and vz_rate <= 0.0:
+            self.height = 0.0
+            self.vz = 0.0
+            vz_rate = 0.0
+        else:
+            pitch = sum(mix * output for mix, output in zip(control_loop.pitch_mix, motor_outputs))
+            roll = sum(mix * output for mix, output in zip(control_loop.roll_mix, motor_outputs))
+            yaw = sum(mix * output for mix, output in zip(control_loop.yaw_mix, motor_outputs))
+            self.pa_rate += (SIM_ANGULAR_GAIN * pitch + self.torques[0] - SIM_ANGULAR_DRAG * self.pa_rate) * dt
+            self.ra_rate += (SIM_ANGULAR_GAIN * roll + self.torques[1] - SIM_ANGULAR_DRAG * self.ra_rate) * dt
+            self.ya_rate += (SIM_ANGULAR_GAIN * yaw + self.torques[2] - SIM_ANGULAR_DRAG * self.ya_rate) * dt
+            self.pa += self.pa_rate * dt
+            self.ra += self.ra_rate * dt
+            self.ya += self.ya_rate * dt
+            self.vz += vz_rate * dt
+            self.height += self.vz * dt
+
+        pa = self.pa
+        ra = self.ra
+        g = 1.0 + vz_rate / GRAV_ACCEL
+        qrx = self.ra_rate + random.gauss(0.0, 0.005)
+        qry = self.pa_rate * math.cos(ra) + random.gauss(0.0, 0.005)
+        qrz = self.ya_rate - self.pa_rate * math.sin(ra) + random.gauss(0.0, 0.005)
+        qax = -math.sin(pa) * g + random.gauss(0.0, 0.01)
+        qay = math.sin(ra) * math.cos(pa) * g + random.gauss(0.0, 0.01)
+        qaz = math.cos(pa) * math.cos(ra) * g + random.gauss(0.0, 0.01)
+
+        self.motor_outputs = list(control_loop.step((qax, qay, qaz, qrx, qry, qrz), dt))
+        self.elapsed_time += dt
+        return self.motor_outputs
+
+    def fly(self, duration, callback = None):
+        #-------------------------------------------------------------------------------------------
+        # Fly until the control loop ends or for 'duration' seconds, calling 'callback' each step
+        #-------------------------------------------------------------------------------------------
+        flight_state = self.control_loop.flight_state
+        while flight_state.keep_looping and self.elapsed_time < duration:
+            self.step()
+            if callback is not None:
+                callback()
+
+###############################################################################################
+#
+# Each control mode flown in the simulator, and a handover between two in flight:
+# - velocity hold: flies the flight plan to completion, staying upright; the simulator has no
+#   horizontal velocity for it to hold, so the angles just wander with the gyro noise
+# - attitude level: takes off from a tilted platform with an off-centre CoG and levels out
+# - rate tuning: holds zero rotation rates through a torque kick, leaving the angles wherever
+#   the kick put them
+# - motor spin: spins each motor alone to the target in turn, then ends
+# - handover: velocity hold to attitude level while hovering on the tilted platform's angle,
+#   with and without blending the rate targets; motor spin is refused in flight
+#
+###############################################################################################
+def BenchModes():
+    Quadcopter.logger = logging.getLogger('qcbench.modes')
+    Quadcopter.logger.disabled = True
+    hover_target = 600
+    failures = []
+
+    def Check(name, passed, detail):
+        print("%s: %s, %s" % (name, "PASS" if passed else "FAIL", detail))
+        if not passed:
+            failures.append(name)
+
+    #-------------------------------------------------------------------------------------------
+    # Velocity hold
+    #-------------------------------------------------------------------------------------------
+    sim = QuadSim(MakeControlLoop(), hover_target)
+    tilts = []
+    heights = []
+    sim.fly(20.0, lambda: (tilts.append(max(abs(sim.pa), abs(sim.ra))), heights.append(sim.height)))
+    Check("velocity hold", not sim.control_loop.flight_state.keep_looping and max(heights) > 1.0 and max(tilts) < math.radians(15),
+          "flight plan done in %.1fs, max height %.2fm, max tilt %.1f degrees" % (sim.elapsed_time, max(heights), math.degrees(max(tilts))))
+
+    #-------------------------------------------------------------------------------------------
+    # Attitude level
+    #-------------------------------------------------------------------------------------------
+    sim = QuadSim(MakeControlLoop(mode = Quadcopter.AttitudeLevel()), hover_target, pa = 0.1, ra = -0.08, torques = (0.5, -0.3, 0.0))
+    sim.fly(8.0)
+    Check("attitude level", abs(sim.pa) < math.radians(1) and abs(sim.ra) < math.radians(1),
+          "from %.1f, %.1f degrees to %.2f, %.2f degrees" % (math.degrees(0.1), math.degrees(-0.08), math.degrees(sim.pa), math.degrees(sim.ra)))
+
+    #-------------------------------------------------------------------------------------------
+    # Rate tuning
+    #-------------------------------------------------------------------------------------------
+    sim = QuadSim(MakeControlLoop(mode = Quadcopter.RateTuning()), hover_target)
+    sim.fly(5.0)
+    sim.torques[0] = 2.0
+    sim.fly(5.2)
+    sim.torques[0] = 0.0
+    sim.fly(6.2)
+    Check("rate tuning", abs(sim.pa_rate) < 0.02 and abs(sim.ra_rate) < 0.02 and abs(sim.pa) > math.radians(0.1),
+          "rates %.3f, %.3f rad/s a second after the kick, pitch left at %.2f degrees" % (sim.pa_rate, sim.ra_rate, math.degrees(sim.pa)))
+
+    #-------------------------------------------------------------------------------------------
+    # Motor spin: note each motor's spell of being the only one spinning
+    #-------------------------------------------------------------------------------------------
+    sim = QuadSim(MakeControlLoop(mode = Quadcopter.MotorSpin(200)), hover_target)
+    spells = []
+    def Spin():
+        spinning = [motor for motor, output in enumerate(sim.motor_outputs) if output]
+        if len(spinning) > 1:
+            spells.append(None)
+        elif spinning and (not spells or spells[-1][0] != spinning[0]):
+            spells.append([spinning[0], 0])
+        if spinning and spells[-1] is not None:
+            spells[-1][1] = max(spells[-1][1], sim.motor_outputs[spinning[0]])
+    sim.fly(60.0, Spin)
+    Check("motor spin", spells == [[0, 200], [1, 200], [2, 200], [3, 200]] and not sim.control_loop.flight_state.keep_looping,
+          "spun %s in %.1fs" % (", ".join(["several motors at once" if spell is None else "motor %d to %d" % tuple(spell) for spell in spells]), sim.elapsed_time))
+
+    #-------------------------------------------------------------------------------------------
+    # Handover: the largest change in the pitch / roll rate targets between velocity task runs
+    # around the switch, blended and not
+    #-------------------------------------------------------------------------------------------
+    jumps = []
+    for handover_time in (0.0, Quadcopter.HANDOVER_TIME):
+        sim = QuadSim(MakeControlLoop(), hover_target, pa = 0.1, ra = -0.08)
+        sim.fly(4.0)
+        flight_state = sim.control_loop.flight_state
+        refused = not sim.control_loop.setMode(Quadcopter.MotorSpin(200))
+        sim.control_loop.setMode(Quadcopter.AttitudeLevel(), handover_time)
+        targets = [(flight_state.pr_target, flight_state.rr_target)]
+        def Targets():
+            if targets[-1] != (flight_state.pr_target, flight_state.rr_target):
+                targets.append((flight_state.pr_target, flight_state.rr_target))
+        sim.fly(10.0, Targets)
+        jumps.append(max(max(abs(a[0] - b[0]), abs(a[1] - b[1])) for a, b in zip(targets[:-1], targets[1:])))
+    Check("handover", refused and jumps[1] < jumps[0] / 2 and abs(sim.pa) < math.radians(1) and abs(sim.ra) < math.radians(1),
+          "largest rate target step %.3f rad/s switching outright, %.3f rad/s handing over, then level at %.2f, %.2f degrees; motor spin %s in flight" %
+          (jumps[0], jumps[1], math.degrees(sim.pa), math.degrees(sim.ra), "refused" if refused else "allowed"))
+
+    print("%s" % ("PASS: all control modes" if not failures else "FAIL: %s" % ", ".join(failures)))
+
+###############################################################################################
+#
+# Gyro bias tracking through the control loop on a synthetic 150s flight at 200Hz: 30s sitting
+# still, 60s manoeuvring, 60s hovering, with the true gyro bias drifting throughout as the chip
+# warms.  The yaw angle should stay at 0 as the quad never yaws; the drift is compared with the
+# bias fixed at the pre-flight calibration and tracked, along with the bias error at the end.
+#
+###############################################################################################
+def GyroDriftIMU(rate, seed = 1):
+    random.seed(seed)
+    dt = 1.0 / rate
+    for step in range(0, 150 * rate):
+        t = step * dt
+        bias = (0.002 + 0.00004 * t, -0.001 - 0.00003 * t, 0.00008 * t)
+        if 30.0 <= t < 90.0:
+            pa = 0.10 * math.sin(0.5 * t)
+            ra = 0.08 * math.sin(0.7 * t)
+            pa_rate = 0.05 * math.cos(0.5 * t)
+            ra_rate = 0.056 * math.cos(0.7 * t)
+        else:
+            pa = ra = pa_rate = ra_rate = 0.0
+
+        qrx = ra_rate + bias[0] + random.gauss(0.0, 0.01)
+        qry = pa_rate * math.cos(ra) + bias[1] + random.gauss(0.0, 0.01)
+        qrz = -pa_rate * math.sin(ra) + bias[2] + random.gauss(0.0, 0.01)
+        qax = -math.sin(pa) + random.gauss(0.0, 0.02)
+        qay = math.sin(ra) * math.cos(pa) + random.gauss(0.0, 0.02)
+        qaz = math.cos(pa) * math.cos(ra) + random.gauss(0.0, 0.02)
+        yield qax, qay, qaz, qrx, qry, qrz, dt, bias
+
+def BenchGyroBias():
+    Quadcopter.logger = logging.getLogger('qcbench.gyrobias')
+    Quadcopter.logger.disabled = True
+
+    samples = list(GyroDriftIMU(200))
+    for tracking in (False, True):
+        control_loop = MakeControlLoop()
+        flight_state = control_loop.flight_state
+        if tracking:
+            control_loop.gyro_bias = Quadcopter.GyroBiasTracker()
+
+        #-------------------------------------------------------------------------------------
+        # The pre-flight calibration measured the bias at the start; the readings given to the
+        # control loop have that taken off as scaleSensors() would.
+        #-------------------------------------------------------------------------------------
+        start_bias = samples[0][7]
+        for qax, qay, qaz, qrx, qry, qrz, dt, bias in samples:
+            control_loop.step((qax, qay, qaz, qrx - start_bias[0], qry - start_bias[1], qrz - start_bias[2]), dt)
+
+        residual = [bias[axis] - start_bias[axis] for axis in range(0, 3)]
+        if tracking:
+            gyro_bias = control_loop.gyro_bias
+            residual = [residual[axis] - gyro_bias.bias[axis] for axis in range(0, 3)]
+            print("tracked: yaw drift %.2f degrees, bias error %s degrees/s, tracked for %.0fs of %.0fs" %
+                  (math.degrees(flight_state.ya), ", ".join(["%.3f" % math.degrees(error) for error in residual]),
+                   gyro_bias.tracking_time, gyro_bias.elapsed_time))
+        else:
+            print("fixed: yaw drift %.2f degrees, bias error %s degrees/s" %
+                  (math.degrees(flight_state.ya), ", ".join(["%.3f" % math.degrees(error) for error in residual])))
+
+    gyro_bias = Quadcopter.GyroBiasTracker()
+    print("%.2fus per update" % TimeIt(lambda: gyro_bias.update(0.0, 0.0, 1.0, 0.001, 0.001, 0.001, 0.02), 100000))
+
+
+###############################################################################################
+#
+# The magnetometer through the MPU6050's auxiliary i2c master on the stand-in bus: an HMC5883L
+# is attached behind the MPU6050, set up through the bypass, and must then be unreachable
+# directly yet arrive in the one burst read per sample.  Then the yaw angle through the control
+# loop over a synthetic 150s flight at 200Hz, with and without the Compass: 30s still, 60s
+# manoeuvring with two full turns, 60s hovering, with the gyro bias drifting as the chip warms, and
+# the field distorted by the motor currents for 5s of it.  The magnetometer is written the true
+# field at 75Hz; with the Compass the yaw error must stay within a few degrees throughout, and
+# the distorted readings must be rejected.
+#
+###############################################################################################
+HMC5883L_REGISTERS = {0x00: 0x10, 0x01: 0x20, 0x02: 0x01, 0x0A: 0x48, 0x0B: 0x34, 0x0C: 0x33}
+EARTH_FIELD = (207.0, 0.0, -490.0)
+
+def RawSample(*values):
+    #-----------------------------------------------------------------------------------------
+    # Raw accel, temperature and gyro values as the MPU6050's big endian data registers
+    #-----------------------------------------------------------------------------------------
+    data = []
+    for value in values:
+        value = int(round(value)) & 0xFFFF
+        data += [value >> 8, value & 0xFF]
+    return data
+
+def WriteField(bank, mx, my, mz):
+    for index, value in enumerate((mx, mz, my)):
+        value = int(round(value)) & 0xFFFF
+        bank[0x03 + index * 2] = value >> 8
+        bank[0x04 + index * 2] = value & 0xFF
+
+def CompassIMU(rate, seed = 1):
+    random.seed(seed)
+    dt = 1.0 / rate
+    ya = 0.0
+    for step in range(0, 150 * rate):
+        t = step * dt
+        bias = (0.002 + 0.00004 * t, -0.001 - 0.00003 * t, 0.00008 * t)
+        if 30.0 <= t < 90.0:
+            pa = 0.10 * math.sin(0.5 * t)
+            ra = 0.08 * math.sin(0.7 * t)
+            pa_rate = 0.05 * math.cos(0.5 * t)
+            ra_rate = 0.056 * math.cos(0.7 * t)
+            ya_rate = 4 * math.pi / 60.0
+        else:
+            pa = ra = pa_rate = ra_rate = ya_rate = 0.0
+        ya += ya_rate * dt
+
+        qrx = ra_rate - ya_rate * math.sin(pa) + bias[0] + random.gauss(0.0, 0.01)
+        qry = pa_rate * math.cos(ra) + ya_rate * math.sin(ra) * math.cos(pa) + bias[1] + random.gauss(0.0, 0.01)
+        qrz = -pa_rate * math.sin(ra) + ya_rate * math.cos(ra) * math.cos(pa) + bias[2] + random.gauss(0.0, 0.01)
+        qax = -math.sin(pa) + random.gauss(0.0, 0.02)
+        qay = math.sin(ra) * math.cos(pa) + random.gauss(0.0, 0.02)
+        qaz = math.cos(pa) * math.cos(ra) + random.gauss(0.0, 0.02)
+        distortion = 1.5 if 100.0 <= t < 105.0 else 1.0
+        yield qax, qay, qaz, qrx, qry, qrz, dt, bias, pa, ra, ya, distortion
+
+def BenchCompass():
+    Quadcopter.logger = logging.getLogger('qcbench.compass')
+    Quadcopter.logger.disabled = True
+
+    bus = FakeBus()
+    bus.attach(0x68, 0x1E, HMC5883L_REGISTERS)
+    mpu6050 = Quadcopter.MPU6050(0x68, 3, 1, bus)
+    enabled = mpu6050.enableMagnetometer()
+    hmc5883l = bus.bank(0x1E)
+    print("magnetometer %s: config 0x%02x 0x%02x mode 0x%02x, %d byte burst read" %
+          ("enabled" if enabled else "missing", hmc5883l[0x00], hmc5883l[0x01], hmc5883l[0x02], mpu6050.burst_length))
+    if not enabled or hmc5883l[0x02] != 0x00:
+        raise AssertionError("magnetometer not set up")
+
+    try:
+        bus.read_byte_data(0x1E, 0x0A)
+        direct = "reachable"
+    except IOError:
+        direct = "unreachable"
+
+    WriteField(hmc5883l, *EARTH_FIELD)
+    bus.transfers = 0
+    mpu6050.readSensors()
+    print("magnetometer %s directly, %d transfer per sample, reads %s" % (direct, bus.transfers, list(mpu6050.mag_array)))
+    if direct != "unreachable" or bus.transfers != 1 or list(mpu6050.mag_array) != [int(field) for field in EARTH_FIELD]:
+        raise AssertionError("magnetometer not read in the burst")
+
+    mag_time = TimeIt(mpu6050.readSensors, 100000)
+    mpu6050.burst_length = 14
+    read_time = TimeIt(mpu6050.readSensors, 100000)
+    mpu6050.burst_length = 20
+    print("readSensors %.2fus, with the magnetometer %.2fus" % (read_time, mag_time))
+
+    samples = list(CompassIMU(200))
+    for use_compass in (False, True):
+        control_loop = MakeControlLoop()
+        flight_state = control_loop.flight_state
+        compass = None
+        if use_compass:
+            compass = Quadcopter.Compass(mpu6050)
+            control_loop.compass = compass
+
+        start_bias = samples[0][7]
+        max_error = 0.0
+        for step, (qax, qay, qaz, qrx, qry, qrz, dt, bias, pa, ra, ya, distortion) in enumerate(samples):
+            if step % 3 == 0:
+                mx, my, mz = Quadcopter.RotateE2Q(EARTH_FIELD[0], EARTH_FIELD[1], EARTH_FIELD[2], pa, ra, ya)
+                WriteField(hmc5883l, mx * distortion, my * distortion, mz * distortion)
+            mpu6050.readSensors()
+            control_loop.step((qax, qay, qaz, qrx - start_bias[0], qry - start_bias[1], qrz - start_bias[2]), dt)
+            error = abs((flight_state.ya - ya + math.pi) % (2 * math.pi) - math.pi)
+            max_error = max(max_error, error)
+
+        if compass is None:
+            print("gyro only: yaw error %.2f degrees at the end, %.2f at worst" % (math.degrees(error), math.degrees(max_error)))
+        else:
+            print("compass: yaw error %.2f degrees at the end, %.2f at worst, %d corrections, %d readings rejected" %
+                  (math.degrees(error), math.degrees(max_error), compass.corrections, compass.rejections))
+            if max_error > math.radians(8.0) or not compass.rejections:
+                raise AssertionError("yaw not held by the compass")
+
+    print("%.2fus per correction" % TimeIt(lambda: compass.correct(0.05, -0.03, 0.1, 0.02), 100000))
+
+
+###############################################################################################
+#
+# The dynamic notch filters on 30s of synthetic raw 1kHz IMU samples: slow 2Hz motion on every
+# axis, gravity on Z, noise, and a motor vibration line rising from 100Hz to 160Hz as the
+# throttle goes up.  The batch averages handed to the motion loop are compared with those of the
+# motion alone, with and without the notches, once they've had 5s to lock on.  Each axis' notch
+# should end up near the final vibration frequency, and the filter and tracker costs are shown
+# against their budgets, for Python and then the numba kernels if installed.
+#
+###############################################################################################
+NOTCH_DURATION = 30
+NOTCH_BATCH = 5
+
+def NotchIMU(rate, seed = 1):
+    random.seed(seed)
+    vibration_phase = 0.0
+    for step in range(0, NOTCH_DURATION * rate):
+        t = step / rate
+        vibration_hz = 100.0 + 60.0 * t / NOTCH_DURATION
+        vibration_phase += 2 * math.pi * vibration_hz / rate
+        motion = [math.sin(2 * math.pi * 2.0 * t + axis) for axis in range(0, 6)]
+        motion[2] += 1.0
+        raw = [motion[axis] + 3.0 * math.sin(vibration_phase + axis) + random.gauss(0.0, 0.1) for axis in range(0, 6)]
+        yield motion, raw, vibration_hz
+
+def BenchNotch():
+    Quadcopter.logger = logging.getLogger('qcbench.notch')
+    Quadcopter.logger.disabled = True
+
+    samples = list(NotchIMU(1000))
+    settled = 5 * 1000 // NOTCH_BATCH
+
+    def Run(kernels):
+        scheduler = Quadcopter.Scheduler(0.001)
+        notch_bank = Quadcopter.NotchFilterBank(1000, NOTCH_BATCH, 60.0, 300.0, scheduler = scheduler)
+        squared_errors = [0.0, 0.0]
+        batches = 0
+        for batch_start in range(0, len(samples), NOTCH_BATCH):
+            batch = samples[batch_start:batch_start + NOTCH_BATCH]
+            for ii, (motion, raw, vibration_hz) in enumerate(batch):
+                for axis in range(0, 6):
+                    notch_bank.samples[ii * 6 + axis] = raw[axis]
+            sums = notch_bank.filter(len(batch))
+
+            if batch_start // NOTCH_BATCH < settled:
+                continue
+            batches += 1
+            for axis in range(0, 6):
+                motion_average = sum(motion[axis] for motion, raw, vibration_hz in batch) / len(batch)
+                raw_average = sum(raw[axis] for motion, raw, vibration_hz in batch) / len(batch)
+                squared_errors[0] += (raw_average - motion_average) ** 2
+                squared_errors[1] += (sums[axis] / len(batch) - motion_average) ** 2
+
+        rms_errors = [math.sqrt(squared_error / (batches * 6)) for squared_error in squared_errors]
+        print("%s: batch average RMS error %.3f without the notches, %.3f with them" % (kernels, rms_errors[0], rms_errors[1]))
+        print("%s: notch centres %s Hz, vibration at %.1fHz" % (kernels, ", ".join(["%.1f" % centre for centre in notch_bank.centres]), samples[-1][2]))
+        for task in scheduler.tasks:
+            mean_time = task.total_time / task.runs
+            print("%s: %s %d runs, mean %.0fus, max %.0fus, budget %.0fus, %.1f%% CPU" %
+                  (kernels, task.name, task.runs, mean_time * 1000000, task.max_time * 1000000, task.budget * 1000000, mean_time / task.budget * 100))
+
+    if Quadcopter.numba is None:
+        Run("python")
+    if Quadcopter.EnableKernels():
+        Quadcopter.WarmKernels()
+        Run("jit")
+
+
+###############################################################################################
+#
+# The NumPy batch angle and frame conversions against the scalar versions on 10^6 samples: every
+# element must match to a tight tolerance, and the time for the whole batch is compared.
+#
+###############################################################################################
+def BenchBatch():
+    try:
+        Quadcopter.RequireNumpy()
+    except ImportError:
+        print("NumPy not installed")
+        return
+    numpy = Quadcopter.numpy
+
+    size = 1000000
+    tolerance = 1e-9
+    generator = numpy.random.RandomState(1)
+    vx, vy, vz = generator.uniform(-2.0, 2.0, (3, size))
+    pa, ra, ya = generator.uniform(-1.4, 1.4, (3, size))
+
+    functions = [("GetRotationAngles", Quadcopter.GetRotationAngles, Quadcopter.GetRotationAnglesArray, (vx, vy, vz)),
+                 ("GetAbsoluteAngles", Quadcopter.GetAbsoluteAngles, Quadcopter.GetAbsoluteAnglesArray, (vx, vy, vz)),
+                 ("Body2EulerRates", Quadcopter.Body2EulerRates, Quadcopter.Body2EulerRatesArray, (vx, vy, vz, pa, ra)),
+                 ("RotateE2Q", Quadcopter.RotateE2Q, Quadcopter.RotateE2QArray, (vx, vy, vz, pa, ra, ya)),
+                 ("RotateQ2E", Quadcopter.RotateQ2E, Quadcopter.RotateQ2EArray, (vx, vy, vz, pa, ra, ya))]
+
+    for name, scalar_function, array_function, arrays in functions:
+        start_time = time.time()
+        array_results = array_function(*arrays)
+        array_time = time.time() - start_time
+
+        lists = [array.tolist() for array in arrays]
+        start_time = time.time()
+        scalar_results = [scalar_function(*values) for values in zip(*lists)]
+        scalar_time = time.time() - start_time
+
+        scalar_results = numpy.array(scalar_results).T
+        mismatches = 0
+        for scalar_result, array_result in zip(scalar_results, array_results):
+            mismatches += numpy.count_nonzero(numpy.abs(scalar_result - array_result) > tolerance * numpy.maximum(1.0, numpy.abs(scalar_result)))
+
+        print("%s: %d mismatches, scalar %.2fs, batch %.3fs, %.0fx faster" % (name, mismatches, scalar_time, array_time, scalar_time / array_time))
+
+
+###############################################################################################
+#
+# The math kernels, Python against numba JIT when it's installed: the same inputs through both
+# variants must give the same results, and the per call times are compared.
+#
+###############################################################################################
+def BenchKernels():
+    iterations = 100000
+    Quadcopter.EnableKernels()
+    numba = Quadcopter.numba
+    if numba is None:
+        print("numba not installed: Python kernels only")
+    else:
+        print("numba %s: kernels ready in %fs" % (numba.__version__, Quadcopter.WarmKernels()))
+
+    calls = [("GetRotationAngles", (0.1, -0.2, 0.97)),
+             ("GetAbsoluteAngles", (0.1, -0.2, 0.97)),
+             ("Body2EulerRates", (0.01, -0.02, 0.03, 0.1, -0.2)),
+             ("RotateE2Q", (0.1, -0.2, 0.97, 0.1, -0.2, 0.3)),
+             ("RotateQ2E", (0.1, -0.2, 0.97, 0.1, -0.2, 0.3))]
+
+    for name, args in calls:
+        kernel = getattr(Quadcopter, name)
+        python_kernel = getattr(kernel, "py_func", kernel)
+        python_time = TimeIt(lambda: python_kernel(*args), iterations)
+        if numba is None:
+            print("%s: python %.2fus" % (name, python_time))
+        else:
+            error = max(abs(a - b) for a, b in zip(python_kernel(*args), kernel(*args)))
+            jit_time = TimeIt(lambda: kernel(*args), iterations)
+            print("%s: python %.2fus, jit %.2fus, max difference %g" % (name, python_time, jit_time, error))
+
+    #-------------------------------------------------------------------------------------------
+    # The Butterworth filter, through BUTTERWORTH so the Python variant is the unbound method
+    # on a second filter, fed the same input.
+    #-------------------------------------------------------------------------------------------
+    bf = Quadcopter.BUTTERWORTH(50, 0.2, 4, 0.0)
+    python_bf = Quadcopter.BUTTERWORTH(50, 0.2, 4, 0.0)
+    python_filter = Quadcopter.BUTTERWORTH.filter
+    python_time = TimeIt(lambda: python_filter(python_bf, 1.0), iterations)
+    if numba is None:
+        print("BUTTERWORTH.filter: python %.2fus" % python_time)
+    else:
+        jit_time = TimeIt(lambda: bf.filter(1.0), iterations)
+        error = abs(python_filter(python_bf, 0.5) - bf.filter(0.5))
+        print("BUTTERWORTH.filter: python %.2fus, jit %.2fus, difference %g" % (python_time, jit_time, error))
+
+
+###############################################################################################
+#
+# Motion loop throughput over repeated replays of the same synthetic flight, in windows so a
+# tracing JIT's (i.e. PyPy's) warm-up shows as the early windows running slower than the later
+# ones.  Each replay is a fresh ControlLoop; the code, and so any JIT traces, carry over.  Any
+# numba kernels are compiled first as they would be by go().
+#
+###############################################################################################
+THROUGHPUT_WINDOW = 500
+THROUGHPUT_REPLAYS = 10
+
+def BenchThroughput():
+    #-------------------------------------------------------------------------------------------
+    # The flight plan phase changes are logged; keep them out of the timings and the output.
+    #-------------------------------------------------------------------------------------------
+    Quadcopter.logger = logging.getLogger('qcbench.throughput')
+    Quadcopter.logger.disabled = True
+    Quadcopter.EnableKernels()
+    Quadcopter.WarmKernels()
+
+    samples = [(qax, qay, qaz, qrx, qry, qrz, dt) for pa, ra, qax, qay, qaz, qrx, qry, qrz, dt in SyntheticIMU(200, 15)]
+    window_rates = []
+    window_steps = 0
+    window_start = time.time()
+    total_steps = 0
+    total_start = window_start
+
+    for replay in range(0, THROUGHPUT_REPLAYS):
+        control_loop = MakeControlLoop()
+        flight_state = control_loop.flight_state
+        for qax, qay, qaz, qrx, qry, qrz, dt in samples:
+            control_loop.step((qax, qay, qaz, qrx, qry, qrz), dt)
+            window_steps += 1
+            if window_steps == THROUGHPUT_WINDOW:
+                time_now = time.time()
+                window_rates.append(window_steps / (time_now - window_start))
+                total_steps += window_steps
+                window_steps = 0
+                window_start = time_now
+            if not flight_state.keep_looping:
+                break
+
+    total_steps += window_steps
+    total_rate = total_steps / (time.time() - total_start)
+
+    #-------------------------------------------------------------------------------------------
+    # Steady state is the median of the second half of the windows; warm-up lasts until a
+    # window first gets within 10% of it.
+    #-------------------------------------------------------------------------------------------
+    steady_rates = sorted(window_rates[len(window_rates) // 2:])
+    steady_rate = steady_rates[len(steady_rates) // 2]
+    warm_windows = 0
+    while window_rates[warm_windows] < 0.9 * steady_rate:
+        warm_windows += 1
+
+    print("%s %s, %s kernels: %d steps, %.0f steps/s overall, %.0f steps/s steady state (%.0fus per step)" %
+          (platform.python_implementation(), platform.python_version(), "Python" if Quadcopter.numba is None else "numba",
+           total_steps, total_rate, steady_rate, 1000000 / steady_rate))
+    print("first window %.0f steps/s, warm after %d steps" % (window_rates[0], warm_windows * THROUGHPUT_WINDOW))
+    print("windows: %s" % " ".join(["%.0f" % rate for rate in window_rates]))
+
+###############################################################################################
+#
+# The sampling profiler's overhead: the same replays as the throughput benchmark, steps per
+# second with the profiler off and on at a range of sample rates.  The off and on runs
+# alternate in pairs, after a warm-up run, so drift in the machine's speed hits both alike;
+# the overhead is the median of the pairs' along with their range, which shows the noise it
+# has to be read against.  Where that noise swamps it, the sampler's own CPU time, which is
+# what it takes from the loop, is the steadier measure.  The replay never blocks, unlike the
+# flight loop, so the sampler only gets the GIL when the interpreter switches threads; the
+# rate it achieved over the time it was on is shown.  The profile's top stacks are shown as a
+# sanity check that it's seeing the motion loop.
+#
+###############################################################################################
+PROFILER_RUNS = 9
+
+def BenchProfiler():
+    Quadcopter.logger = logging.getLogger('qcbench.profiler')
+    Quadcopter.logger.disabled = True
+    Quadcopter.EnableKernels()
+    Quadcopter.WarmKernels()
+
+    samples = [(qax, qay, qaz, qrx, qry, qrz, dt) for pa, ra, qax, qay, qaz, qrx, qry, qrz, dt in SyntheticIMU(200, 15)]
+    def replay():
+        steps = 0
+        start_time = time.time()
+        for replay in range(0, THROUGHPUT_REPLAYS):
+            control_loop = MakeControlLoop()
+            for qax, qay, qaz, qrx, qry, qrz, dt in samples:
+                control_loop.step((qax, qay, qaz, qrx, qry, qrz), dt)
+                steps += 1
+                if not control_loop.flight_state.keep_looping:
+                    break
+        return steps / (time.time() - start_time)
+
+    def median(values):
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    replay()
+
+    for rate in (100, 250, 1000):
+        profiler = Quadcopter.SamplingProfiler(Quadcopter.thread.get_ident(), rate)
+        off_rates = []
+        on_rates = []
+        for run in range(0, PROFILER_RUNS):
+            off_rates.append(replay())
+            profiler.start()
+            on_rates.append(replay())
+            profiler.stop()
+        profiler.shutdown()
+        time.sleep(2 * profiler.interval)
+
+        overheads = sorted([(off / on - 1) * 100 for off, on in zip(off_rates, on_rates)])
+        print("profiler at %dHz: %.0f steps/s off, %.0f on, %.1f%% slower (pairs %.1f%% to %.1f%%), sampled at %.0fHz, %.1fus per sample, %.2f%% CPU, %d stacks" %
+              (rate, median(off_rates), median(on_rates), median(overheads), overheads[0], overheads[-1], profiler.achievedRate(),
+               profiler.sample_time * 1000000 / max(profiler.samples, 1), profiler.sample_time * 100 / profiler.enabledTime(), len(profiler.stacks)))
+
+    for stack, count in profiler.collapsed()[0:3]:
+        print("%5d %s" % (count, stack.split(";")[-1]))
+
+###############################################################################################
+#
+# Allocation regression check: the motion loop against the stand-in hardware (MPU6050 reads on
+# the fake bus with the magnetometer and raw IMU capture on, the notch filters, scaling, the
+# control loop with gyro bias tracking and the compass, the ESC pulse widths and watchdog beat)
+# with the garbage collector frozen and disabled as per --nogc.  After warming up, tracemalloc
+# must see no net growth attributable to the flight code: the blocks left over from a run of N
+# loops must be within a fixed slack (the latest values held, which differ from run to run) and
+# not grow with a run of 2N.  Tracing starts a run of N loops earlier still, so the values held
+# from before it started have all been replaced by traced ones.  The MPU6050 read with the
+# magnetometer, and the notch, compass and gyro bias paths are then checked for temporaries per
+# call.  Needs Python 3.4+ for tracemalloc.
+#
+###############################################################################################
+ALLOC_LOOPS = 1000
+ALLOC_SLACK = 32
+ALLOC_TRANSIENT = 512
+
+def BenchAllocations():
+    try:
+        import tracemalloc
+    except ImportError:
+        print("tracemalloc not available in %s %s" % (platform.python_implementation(), platform.python_version()))
+        return
+
+    Quadcopter.logger = logging.getLogger('qcbench.alloc')
+    Quadcopter.logger.disabled = True
+    Quadcopter.EnableKernels()
+    Quadcopter.WarmKernels()
+
+    bus = FakeBus()
+    bus.attach(0x68, 0x1E, HMC5883L_REGISTERS)
+    mpu6050 = Quadcopter.MPU6050(0x68, 3, 1, bus)
+    mpu6050.enableMagnetometer()
+    capture = Quadcopter.ImuCapture(CaptureFile(), 1000)
+    mpu6050.capture = capture
+    control_loop = MakeControlLoop()
+    control_loop.scale = mpu6050.scaleSensors
+    control_loop.gyro_bias = Quadcopter.GyroBiasTracker()
+    control_loop.compass = Quadcopter.Compass(mpu6050)
+    notch_bank = Quadcopter.NotchFilterBank(1000, control_loop.rate_period, 60.0, 300.0, scheduler = control_loop.scheduler)
+    notch_samples = notch_bank.samples
+    flight_state = control_loop.flight_state
+    esc_list = [FakeESC(pin, 1000) for pin in range(0, 4)]
+    watchdog = Quadcopter.Watchdog([esc.bcm_pin for esc in esc_list], pulse = lambda pin, pulse_width: None)
+    raw_batch = [0.0] * 6
+    random.seed(1)
+    data = [RawSample(random.gauss(0.0, 200.0), random.gauss(0.0, 200.0), 16384 + random.gauss(0.0, 200.0), 0,
+                      random.gauss(0.0, 50.0), random.gauss(0.0, 50.0), random.gauss(0.0, 50.0)) for sample in range(0, 64)]
+    fields = [[EARTH_FIELD[axis] + random.gauss(0.0, 5.0) for axis in range(0, 3)] for sample in range(0, 64)]
+    hmc5883l = bus.bank(0x1E)
+
+    def loops(count):
+        for loop in range(0, count):
+            bus.write(0x68, 0x3B, data[loop % len(data)])
+            WriteField(hmc5883l, *fields[loop % len(fields)])
+            for sample in range(0, control_loop.rate_period):
+                ax, ay, az, gx, gy, gz = mpu6050.readSensors()
+                index = sample * 6
+                notch_samples[index] = ax
+                notch_samples[index + 1] = ay
+                notch_samples[index + 2] = az
+                notch_samples[index + 3] = gx
+                notch_samples[index + 4] = gy
+                notch_samples[index + 5] = gz
+            sums = notch_bank.filter(control_loop.rate_period)
+            for axis in range(0, 6):
+                raw_batch[axis] = sums[axis] / control_loop.rate_period
+            motor_outputs = control_loop.step(raw_batch, 0.005)
+            for motor in range(0, 4):
+                esc_list[motor].pulse_width = 1000 + motor_outputs[motor]
+            watchdog.beat(esc_list)
+            flight_state.keep_looping = True
+
+    def flightBlocks(before, after):
+        blocks = 0
+        size = 0
+        for stat in after.compare_to(before, 'filename'):
+            if stat.traceback[0].filename in (Quadcopter.__file__, __file__):
+                blocks += stat.count_diff
+                size += stat.size_diff
+        return blocks, size
+
+    loops(ALLOC_LOOPS)
+    Quadcopter.GCFreeze()
+    tracemalloc.start()
+    try:
+        loops(ALLOC_LOOPS)
+        snapshots = [tracemalloc.take_snapshot()]
+        gc_count = Quadcopter.gc.get_count()[0]
+        for count in (ALLOC_LOOPS, 2 * ALLOC_LOOPS):
+            loops(count)
+            snapshots.append(tracemalloc.take_snapshot())
+        gc_pending = Quadcopter.gc.get_count()[0] - gc_count
+    finally:
+        tracemalloc.stop()
+        Quadcopter.gc.unfreeze()
+        Quadcopter.gc.enable()
+        watchdog.stop()
+        mpu6050.capture = None
+        capture.close()
+        os.remove(capture.file_name)
+
+    first_blocks, first_size = flightBlocks(snapshots[0], snapshots[1])
+    second_blocks, second_size = flightBlocks(snapshots[1], snapshots[2])
+    print("%d loops: %+d blocks / %+d bytes, then %d loops: %+d blocks / %+d bytes, %.3f pending gc containers per loop" %
+          (ALLOC_LOOPS, first_blocks, first_size, 2 * ALLOC_LOOPS, second_blocks, second_size, gc_pending / (3 * ALLOC_LOOPS)))
+    if abs(first_blocks) > ALLOC_SLACK or abs(second_blocks) > ALLOC_SLACK:
+        raise AssertionError("flight loop allocations grow: %+d blocks over %d loops, %+d over %d" % (first_blocks, ALLOC_LOOPS, second_blocks, 2 * ALLOC_LOOPS))
+    print("PASS: no net allocations per loop")
+
+    #-----------------------------------------------------------------------------------------
+    # Temporaries freed straight away don't show up above, so the per-sample and per-batch
+    # paths are checked for them separately: the most traced memory each reaches above where it
+    # started over many calls must be no more than the call itself takes (the float results,
+    # and the numba dispatch with the kernels).  Needs Python 3.9+ for tracemalloc.reset_peak().
+    #-----------------------------------------------------------------------------------------
+    if not hasattr(tracemalloc, "reset_peak"):
+        print("tracemalloc.reset_peak() not available for the transient check")
+        return
+
+    rate_period = control_loop.rate_period
+    paths = [("mpu6050 read", mpu6050.readSensors),
+             ("notch filter", lambda: notch_bank.filter(rate_period)),
+             ("notch tracker", notch_bank.track),
+             ("compass", lambda: control_loop.compass.correct(0.05, -0.03, 0.1, 0.02)),
+             ("gyro bias", lambda: control_loop.gyro_bias.update(0.0, 0.0, 1.0, 0.001, 0.001, 0.001, 0.02))]
+    tracemalloc.start()
+    try:
+        peaks = [(name, TransientPeak(tracemalloc, function)) for name, function in paths]
+    finally:
+        tracemalloc.stop()
+
+    print("transient peak per call: %s" % ", ".join(["%s %d bytes" % (name, peak) for name, peak in peaks]))
+    for name, peak in peaks:
+        if peak > ALLOC_TRANSIENT:
+            raise AssertionError("%s allocates %d bytes per call" % (name, peak))
+    print("PASS: no per call allocations")
+
+###############################################################################################
+#
+# Import time: 'import Quadcopter' in fresh interpreters, the median of several runs less that of
+# an interpreter doing nothing, so it's the module's own cost.  Importing must be definitions
+# only, so the hardware drivers and the heavy optional modules must not have been loaded by it;
+# they're imported when a driver is constructed or go() needs them.  Where the interpreter has
+# -X importtime (Python 3.7+), the slowest modules imported are shown.
+#
+###############################################################################################
+IMPORT_RUNS = 7
+IMPORT_LAZY = ("smbus", "RPi", "RPIO", "numpy", "numba", "multiprocessing", "subprocess", "ctypes", "socket", "shutil", "datetime")
+
+def BenchImportTime():
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code, options = ()):
+        process = subprocess.Popen([sys.executable] + list(options) + ["-c", code], cwd = directory, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        output, errors = process.communicate()
+        if process.returncode:
+            raise RuntimeError(errors.decode("utf-8", "replace"))
+        return output.decode("utf-8", "replace"), errors.decode("utf-8", "replace")
+
+    def median_time(code):
+        times = []
+        for index in range(0, IMPORT_RUNS):
+            start_time = time.time()
+            run(code)
+            times.append(time.time() - start_time)
+        return sorted(times)[IMPORT_RUNS // 2]
+
+    baseline = median_time("pass")
+    import_time = median_time("import Quadcopter")
+    print("%s %s: import Quadcopter %.0fms (interpreter startup %.0fms excluded)" %
+          (platform.python_implementation(), platform.python_version(), (import_time - baseline) * 1000, baseline * 1000))
+    if sys.dont_write_bytecode:
+        print("no bytecode cache is written here, so that includes compiling Quadcopter.py each time")
+
+    output, errors = run("import sys, Quadcopter; print(' '.join(sorted(sys.modules)))")
+    loaded = set(name.split(".")[0] for name in output.split())
+    eager = [name for name in IMPORT_LAZY if name in loaded]
+    if eager:
+        raise AssertionError("imported by 'import Quadcopter': %s" % ", ".join(eager))
+    print("none of %s imported" % ", ".join(IMPORT_LAZY))
+
+    if sys.version_info >= (3, 7):
+        output, errors = run("import Quadcopter", ("-X", "importtime"))
+        modules = []
+        for line in errors.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[1].strip().isdigit():
+                modules.append((int(fields[1]), fields[2].strip()))
+        for cumulative, name in sorted(modules, reverse = True)[0:5]:
+            print("%6.1fms %s" % (cumulative / 1000, name))
+
+
+###############################################################################################
+#
+# The throughput benchmark under each interpreter installed, for comparison on the same replay
+#
+###############################################################################################
+INTERPRETERS = ("python2", "python3", "pypy", "pypy3")
+
+def FindExecutable(name):
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def BenchInterpreters():
+    for name in INTERPRETERS:
+        path = FindExecutable(name)
+        if path is None:
+            print("%s: not installed" % name)
+            continue
+
+        process = subprocess.Popen([path, os.path.abspath(__file__), "throughput"], stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        output = process.communicate()[0].decode("utf-8", "replace")
+        if process.returncode:
+            print("%s: failed\n%s" % (name, output))
+        else:
+            print("%s: %s" % (name, "\n    ".join(output.splitlines()[1:])))
+
+
+BENCHMARKS = [("ekf", BenchEKF), ("i2c", BenchI2C), ("mpu6050", BenchMPU6050), ("capture", BenchCapture), ("spectrum", BenchSpectrum), ("startup", BenchStartup), ("rls", BenchTemperatureModel), ("dataready", BenchDataReady), ("watchdog", BenchWatchdog), ("pid", BenchPIDBank), ("flightstate", BenchFlightState), ("controlloop", BenchControlLoop), ("modes", BenchModes), ("gyrobias", BenchGyroBias), ("compass", BenchCompass), ("notch", BenchNotch), ("batch", BenchBatch), ("kernels", BenchKernels), ("throughput", BenchThroughput), ("profiler", BenchProfiler), ("alloc", BenchAllocations), ("importtime", BenchImportTime), ("interpreters", BenchInterpreters)]
+
+if __name__ == '__main__':
+    selected = sys.argv[1:]
+    for name, benchmark in BENCHMARKS:
+        if not selected or name in selected:
+            print("==== %s ====" % name)
+            benchmark()
@@ -0,0 +1,581 @@
+#!/usr/bin/env python
+
+###############################################################################################
+###############################################################################################
+##                                                                                           ##
+## Hove's Raspberry Pi Python Quadcopter Flight Controller.  Open Source @ GitHub            ##
+## PiStuffing/Quadcopter under GPL for non-commercial application.  Any code derived from    ##
+## this should retain this copyright comment.                                                ##
+##                                                                                           ##
+## Copyright 2014 Andy Baker (Hove) - andy@pistuffing.co.uk                                  ##
+##                                                                                           ##
+###############################################################################################
+###############################################################################################
+
+###############################################################################################
+#
+# Vibration analysis of the raw IMU captures written by Quadcopter.py --cap (qcimu*.bin), for
+# picking the MPU6050 DLPF settings (--alpf / --glpf) and the Butterworth cutoff on evidence
+# rather than trial and error.  The capture is streamed through in chunks so a long flight's
+# never all in memory, and per axis it works out:
+#
+# - the Welch power spectral density (Hann windowed segments, 50% overlap, averaged)
+# - a spectrogram, with neighbouring segments merged to keep it to a bounded number of columns
+# - the PSDs binned by throttle, and the vibration peaks in each bin, so motor and prop
+#   vibration shows as peaks moving up in frequency with throttle
+#
+# and from those, recommends the DLPF settings and Butterworth cutoff.  Results are written as
+# a JSON summary, and plots if matplotlib is installed.  Needs NumPy.
+#
+# qcspectrum.py [-o dir] [--nperseg=??] [--chunk=??] [--atp=??] qcimu<date>.bin
+#
+# -o        directory for the summary and plots (default: beside the capture)
+# --nperseg samples per Welch segment (default 512)
+# --chunk   samples read from the capture at a time (default 65536)
+# --atp     the flight's attitude task period in samples, for the Butterworth (default 20)
+#
+###############################################################################################
+from __future__ import division
+from __future__ import print_function
+import sys
+import os
+import getopt
+import json
+import math
+import struct
+
+import numpy
+
+###############################################################################################
+#
+# The capture file format, as per Quadcopter.ImuCapture: a header then a ring of records.
+# Version 1 captures have no throttle, so throttle reads as 0 throughout.
+#
+###############################################################################################
+HEADER = struct.Struct("<8sIIQQdII")
+MAGIC = b"QCIMU001"
+RECORD = numpy.dtype([("time", "<f8"), ("data", ">i2", (7,)), ("throttle", "<u2")])
+
+AXES = ("ax", "ay", "az", "gx", "gy", "gz")
+DATA_COLUMNS = (0, 1, 2, 4, 5, 6)
+
+#----------------------------------------------------------------------------------------------
+# Raw to g's and degrees per second at the +/- 2g and +/- 250 degrees/s ranges; the header's
+# range factors scale wider ranges to those.
+#----------------------------------------------------------------------------------------------
+ACCEL_SCALE = 4.0 / 65536
+GYRO_SCALE = 500.0 / 65536
+
+#----------------------------------------------------------------------------------------------
+# The DLPF settings and their bandwidths in Hz, as per the comments in MPU6050.__init__().  0
+# and 7 change the gyro sampling to 8kHz, so they're never recommended.
+#----------------------------------------------------------------------------------------------
+GYRO_DLPF = {1: 184, 2: 92, 3: 41, 4: 20, 5: 10, 6: 5}
+ACCEL_DLPF = {1: 184, 2: 92, 3: 41, 4: 20, 5: 10, 6: 5}
+
+#----------------------------------------------------------------------------------------------
+# Peaks are local maxima at least PEAK_FLOOR times the PSD's median over the band above
+# PEAK_MIN_FREQ; below that is flight motion rather than vibration.  The rate PIDs need the gyro
+# bandwidth to stay at or above GYRO_MIN_BANDWIDTH.
+#----------------------------------------------------------------------------------------------
+PEAK_MIN_FREQ = 10.0
+PEAK_FLOOR = 10.0
+MAX_PEAKS = 5
+GYRO_MIN_BANDWIDTH = 20
+ACCEL_MIN_BANDWIDTH = 5
+
+#----------------------------------------------------------------------------------------------
+# The Butterworth's order, as per Quadcopter.ControlLoop, and the rejection wanted of aliased
+# vibration in dB: what a 4th order filter gives at 5 times its cutoff.  The cutoff's kept no
+# lower than the flight's own 0.2Hz, where the filter already lags the quad's tilt by 2s.
+#----------------------------------------------------------------------------------------------
+BUTTERWORTH_ORDER = 4
+BUTTERWORTH_REJECTION = 56.0
+BUTTERWORTH_MIN_CUTOFF = 0.2
+
+THROTTLE_BIN = 50
+SPECTROGRAM_COLUMNS = 1024
+
+
+class CaptureError(Exception):
+    pass
+
+###############################################################################################
+#
+# Capture reader: the header, and the records oldest first as chunks of at most 'chunk' records
+#
+###############################################################################################
+class Capture(object):
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        with open(file_name, "rb") as capture_file:
+            header = capture_file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise CaptureError("%s: too short for a capture" % file_name)
+
+        magic, self.version, record_size, self.capacity, self.count, self.start_time, self.accel_factor, self.gyro_factor = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise CaptureError("%s: not an IMU capture" % file_name)
+
+        #-------------------------------------------------------------------------------------
+        # Version 1 had padding where version 2 has the throttle, so the records are the same
+        #-------------------------------------------------------------------------------------
+        if record_size != RECORD.itemsize:
+            raise CaptureError("%s: record size %d, expected %d" % (file_name, record_size, RECORD.itemsize))
+
+        self.samples = min(self.count, self.capacity)
+        self.wrapped = self.count > self.capacity
+
+    def chunks(self, chunk):
+        #-----------------------------------------------------------------------------------------
+        # A wrapped ring's oldest record is the one the next sample would have overwritten
+        #-----------------------------------------------------------------------------------------
+        if self.wrapped:
+            ranges = [(self.count % self.capacity, self.capacity), (0, self.count % self.capacity)]
+        else:
+            ranges = [(0, self.count)]
+
+        with open(self.file_name, "rb") as capture_file:
+            for first, last in ranges:
+                capture_file.seek(HEADER.size + first * RECORD.itemsize)
+                for start in range(first, last, chunk):
+                    records = numpy.fromfile(capture_file, dtype = RECORD, count = min(chunk, last - start))
+                    if records.size:
+                        yield records
+
+    def scale(self, records):
+        #-----------------------------------------------------------------------------------------
+        # Records to an (n, 6) array of accelerometer g's and gyro degrees per second
+        #-----------------------------------------------------------------------------------------
+        data = records["data"][:, DATA_COLUMNS].astype(numpy.float64)
+        data[:, 0:3] *= ACCEL_SCALE * self.accel_factor
+        data[:, 3:6] *= GYRO_SCALE * self.gyro_factor
+        return data
+
+###############################################################################################
+#
+# Streaming Welch PSD, spectrogram and throttle binned PSDs.  Samples carry over between chunks
+# so the segments and their overlaps are exactly as if the whole capture had been read at once.
+#
+###############################################################################################
+class SpectrumStream(object):
+
+    def __init__(self, sample_rate, nperseg, throttle_bin = THROTTLE_BIN, columns = SPECTROGRAM_COLUMNS):
+        self.sample_rate = sample_rate
+        self.nperseg = nperseg
+        self.hop = nperseg // 2
+        self.window = numpy.hanning(nperseg)
+        self.frequencies = numpy.fft.rfftfreq(nperseg, 1.0 / sample_rate)
+
+        #-----------------------------------------------------------------------------------------
+        # One sided density scaling; the DC and Nyquist bins aren't doubled
+        #-----------------------------------------------------------------------------------------
+        self.psd_scale = numpy.full(len(self.frequencies), 2.0 / (sample_rate * numpy.sum(self.window ** 2)))
+        self.psd_scale[0] /= 2
+        if nperseg % 2 == 0:
+            self.psd_scale[-1] /= 2
+
+        self.pending = numpy.zeros((0, 6))
+        self.pending_throttle = numpy.zeros(0)
+        self.psd_sum = numpy.zeros((len(self.frequencies), 6))
+        self.segments = 0
+        self.sum_squares = numpy.zeros(6)
+        self.sum_values = numpy.zeros(6)
+        self.peak_values = numpy.zeros(6)
+        self.samples = 0
+
+        self.throttle_bin = throttle_bin
+        self.throttle_psds = {}
+
+        #-----------------------------------------------------------------------------------------
+        # Spectrogram columns, each the mean of 'merge' segments; merge doubles whenever the
+        # columns fill, halving them by averaging neighbours.
+        #-----------------------------------------------------------------------------------------
+        self.max_columns = columns
+        self.merge = 1
+        self.columns = []
+        self.column_times = []
+        self.column_sum = None
+        self.column_count = 0
+        self.column_start = 0
+
+    def add(self, data, throttle):
+        self.samples += len(data)
+        self.sum_values += data.sum(axis = 0)
+        self.sum_squares += (data ** 2).sum(axis = 0)
+        self.peak_values = numpy.maximum(self.peak_values, numpy.abs(data).max(axis = 0))
+
+        data = numpy.concatenate((self.pending, data))
+        throttle = numpy.concatenate((self.pending_throttle, throttle))
+        start = 0
+        while start + self.nperseg <= len(data):
+            segment = data[start:start + self.nperseg]
+            segment = (segment - segment.mean(axis = 0)) * self.window[:, numpy.newaxis]
+            psd = numpy.abs(numpy.fft.rfft(segment, axis = 0)) ** 2 * self.psd_scale[:, numpy.newaxis]
+
+            self.psd_sum += psd
+            self.segments += 1
+            self.addThrottle(psd, throttle[start:start + self.nperseg].mean())
+            self.addColumn(psd)
+            start += self.hop
+
+        self.pending = data[start:]
+        self.pending_throttle = throttle[start:]
+
+    def addThrottle(self, psd, throttle):
+        throttle_bin = int(throttle // self.throttle_bin) * self.throttle_bin
+        if throttle_bin in self.throttle_psds:
+            psd_sum, count = self.throttle_psds[throttle_bin]
+            self.throttle_psds[throttle_bin] = (psd_sum + psd, count + 1)
+        else:
+            self.throttle_psds[throttle_bin] = (psd.copy(), 1)
+
+    def addColumn(self, psd):
+        if self.column_sum is None:
+            self.column_sum = numpy.zeros_like(psd)
+            self.column_start = (self.segments - 1) * self.hop
+        self.column_sum += psd
+        self.column_count += 1
+        if self.column_count < self.merge:
+            return
+
+        self.columns.append((self.column_sum / self.column_count).astype(numpy.float32))
+        self.column_times.append((self.column_start + ((self.merge - 1) * self.hop + self.nperseg) / 2) / self.sample_rate)
+        self.column_sum = None
+        self.column_count = 0
+
+        if len(self.columns) == self.max_columns:
+            self.columns = [(self.columns[index] + self.columns[index + 1]) / 2 for index in range(0, self.max_columns, 2)]
+            self.column_times = [(self.column_times[index] + self.column_times[index + 1]) / 2 for index in range(0, self.max_columns, 2)]
+            self.merge *= 2
+
+    def psd(self):
+        return self.psd_sum / max(self.segments, 1)
+
+    def rms(self):
+        #-----------------------------------------------------------------------------------------
+        # About the mean, i.e. the vibration and motion rather than gravity and bias
+        #-----------------------------------------------------------------------------------------
+        mean = self.sum_values / self.samples
+        return numpy.sqrt(numpy.maximum(self.sum_squares / self.samples - mean ** 2, 0.0))
+
+    def spectrogram(self):
+        return numpy.array(self.column_times), numpy.array(self.columns)
+
+###############################################################################################
+#
+# Peak finding and the recommendations
+#
+###############################################################################################
+def FindPeaks(frequencies, psd, min_freq = PEAK_MIN_FREQ, floor = PEAK_FLOOR, max_peaks = MAX_PEAKS):
+    band = frequencies >= min_freq
+    if numpy.count_nonzero(band) < 3:
+        return []
+
+    median = numpy.median(psd[band])
+    threshold = floor * median
+    peaks = []
+    for index in range(1, len(psd) - 1):
+        if band[index] and psd[index] > threshold and psd[index] >= psd[index - 1] and psd[index] > psd[index + 1]:
+            peaks.append((float(psd[index]), float(frequencies[index])))
+
+    peaks.sort(reverse = True)
+    return [{"frequency": frequency, "psd": power, "above_median": power / median} for power, frequency in peaks[0:max_peaks]]
+
+
+def RecommendDLPF(settings, lowest_peak, nyquist, min_bandwidth):
+    #-------------------------------------------------------------------------------------------
+    # The widest bandwidth at most half the lowest vibration peak and a quarter of the sample
+    # rate (so the DLPF's well down at Nyquist, against aliasing), but not below min_bandwidth.
+    #-------------------------------------------------------------------------------------------
+    limit = nyquist / 2
+    if lowest_peak is not None:
+        limit = min(limit, lowest_peak / 2)
+
+    for setting in sorted(settings):
+        if settings[setting] <= limit:
+            break
+    else:
+        setting = max(settings)
+
+    if settings[setting] < min_bandwidth:
+        setting = max(setting for setting in settings if settings[setting] >= min_bandwidth)
+
+    return setting, settings[setting], limit
+
+
+def AliasedFrequency(frequency, sample_rate):
+    return abs(frequency - round(frequency / sample_rate) * sample_rate)
+
+
+def AveragingGain(frequency, sample_rate, period):
+    #-------------------------------------------------------------------------------------------
+    # The gain at 'frequency' of the mean of 'period' samples, as the attitude task takes of the
+    # accelerometer before the Butterworth: zero at multiples of sample_rate / period.
+    #-------------------------------------------------------------------------------------------
+    denominator = period * math.sin(math.pi * frequency / sample_rate)
+    if abs(denominator) < 1e-12:
+        return 1.0
+    return abs(math.sin(math.pi * frequency * period / sample_rate) / denominator)
+
+
+def RecommendButterworth(peaks, sample_rate, attitude_period):
+    #-------------------------------------------------------------------------------------------
+    # The Butterworth runs on accelerometer averages at the attitude task rate, so vibration the
+    # DLPF lets through aliases to below that rate's Nyquist, but having first been attenuated
+    # by the averaging.  Each aliased peak needs the Butterworth to make up what the averaging
+    # leaves of BUTTERWORTH_REJECTION, which sets a cutoff for it; peaks the averaging already
+    # rejects set none.  The lowest cutoff is recommended, at most a tenth of the attitude rate
+    # and at least BUTTERWORTH_MIN_CUTOFF; below that, the vibration needs dealing with at the
+    # DLPF or the props.
+    #-------------------------------------------------------------------------------------------
+    attitude_rate = sample_rate / attitude_period
+    cutoff = attitude_rate / 10
+    limiting_peak = None
+    aliased_peaks = []
+    for frequency in peaks:
+        aliased = AliasedFrequency(frequency, attitude_rate)
+        averaging = -20 * math.log10(max(AveragingGain(frequency, sample_rate, attitude_period), 1e-6))
+        peak = {"frequency": frequency, "aliased": aliased, "averaging_db": averaging, "cutoff": None}
+        needed = BUTTERWORTH_REJECTION - averaging
+        if aliased > 0.0 and needed > 0.0:
+            peak["cutoff"] = aliased / (10 ** (needed / 10) - 1) ** (1 / (2 * BUTTERWORTH_ORDER))
+            if peak["cutoff"] < cutoff:
+                cutoff = peak["cutoff"]
+                limiting_peak = peak
+        aliased_peaks.append(peak)
+
+    return {"cutoff": max(cutoff, BUTTERWORTH_MIN_CUTOFF),
+            "floored": cutoff < BUTTERWORTH_MIN_CUTOFF,
+            "attitude_rate": attitude_rate,
+            "limiting_peak": limiting_peak,
+            "aliased_peaks": aliased_peaks}
+
+
+def Analyse(capture, nperseg = 512, chunk = 65536, attitude_period = 20):
+    #-------------------------------------------------------------------------------------------
+    # The sample rate's from the time stamps' median interval in the first chunk; the capture
+    # has the MPU6050's own timing, and the time stamps only Python's scheduling jitter.
+    #-------------------------------------------------------------------------------------------
+    stream = None
+    gaps = 0
+    last_time = None
+    throttle_seen = False
+    for records in capture.chunks(chunk):
+        times = records["time"]
+        if stream is None:
+            if len(times) < nperseg:
+                raise CaptureError("%s: only %d samples" % (capture.file_name, len(times)))
+            sample_period = float(numpy.median(numpy.diff(times)))
+            stream = SpectrumStream(1.0 / sample_period, nperseg)
+
+        if last_time is not None:
+            times = numpy.concatenate(([last_time], times))
+        gaps += int(numpy.count_nonzero(numpy.diff(times) > 1.5 * sample_period))
+        last_time = times[-1]
+
+        throttle = records["throttle"].astype(numpy.float64)
+        throttle_seen = throttle_seen or bool(throttle.any())
+        stream.add(capture.scale(records), throttle)
+
+    if stream is None or stream.segments == 0:
+        raise CaptureError("%s: too few samples for a %d sample segment" % (capture.file_name, nperseg))
+
+    frequencies = stream.frequencies
+    psd = stream.psd()
+    rms = stream.rms()
+    axes = {}
+    for axis, name in enumerate(AXES):
+        axes[name] = {"rms": float(rms[axis]),
+                      "peak": float(stream.peak_values[axis]),
+                      "units": "g" if axis < 3 else "degrees/s",
+                      "peaks": FindPeaks(frequencies, psd[:, axis])}
+
+    #-------------------------------------------------------------------------------------------
+    # Per throttle bin, the peaks of the gyro and accelerometer PSDs summed over their axes
+    #-------------------------------------------------------------------------------------------
+    throttle_bins = []
+    for throttle_bin in sorted(stream.throttle_psds):
+        psd_sum, count = stream.throttle_psds[throttle_bin]
+        bin_psd = psd_sum / count
+        throttle_bins.append({"throttle": throttle_bin,
+                              "segments": count,
+                              "gyro_peaks": FindPeaks(frequencies, bin_psd[:, 3:6].sum(axis = 1)),
+                              "accel_peaks": FindPeaks(frequencies, bin_psd[:, 0:3].sum(axis = 1))})
+
+    #-------------------------------------------------------------------------------------------
+    # Motor vibration: the strongest gyro peak in each throttle bin, fitted as a line against
+    # throttle where there's more than one bin with a peak.
+    #-------------------------------------------------------------------------------------------
+    motor_points = [(throttle_bin["throttle"] + THROTTLE_BIN / 2, throttle_bin["gyro_peaks"][0]["frequency"])
+                    for throttle_bin in throttle_bins if throttle_bin["gyro_peaks"]]
+    motor_fit = None
+    if throttle_seen and len(motor_points) > 1:
+        slope, intercept = numpy.polyfit([point[0] for point in motor_points], [point[1] for point in motor_points], 1)
+        motor_fit = {"hz_per_throttle": float(slope), "hz_at_zero": float(intercept)}
+
+    #-------------------------------------------------------------------------------------------
+    # Recommendations from the lowest vibration peaks of each sensor
+    #-------------------------------------------------------------------------------------------
+    nyquist = stream.sample_rate / 2
+    gyro_peaks = [peak["frequency"] for name in AXES[3:6] for peak in axes[name]["peaks"]]
+    accel_peaks = [peak["frequency"] for name in AXES[0:3] for peak in axes[name]["peaks"]]
+    lowest_gyro_peak = min(gyro_peaks) if gyro_peaks else None
+    lowest_accel_peak = min(accel_peaks) if accel_peaks else None
+
+    glpf, glpf_bandwidth, glpf_limit = RecommendDLPF(GYRO_DLPF, lowest_gyro_peak, nyquist, GYRO_MIN_BANDWIDTH)
+    alpf, alpf_bandwidth, alpf_limit = RecommendDLPF(ACCEL_DLPF, lowest_accel_peak, nyquist, ACCEL_MIN_BANDWIDTH)
+
+    butterworth = RecommendButterworth(accel_peaks, stream.sample_rate, attitude_period)
+
+    return stream, {
+        "capture": capture.file_name,
+        "version": capture.version,
+        "sample_rate": stream.sample_rate,
+        "samples": stream.samples,
+        "samples_written": capture.count,
+        "wrapped": capture.wrapped,
+        "duration": stream.samples / stream.sample_rate,
+        "gaps": gaps,
+        "nperseg": nperseg,
+        "resolution": stream.sample_rate / nperseg,
+        "segments": stream.segments,
+        "axes": axes,
+        "throttle_bins": throttle_bins if throttle_seen else [],
+        "motor_vibration": motor_fit,
+        "recommendations": {
+            "glpf": {"setting": glpf, "bandwidth": glpf_bandwidth, "limit": glpf_limit, "lowest_peak": lowest_gyro_peak},
+            "alpf": {"setting": alpf, "bandwidth": alpf_bandwidth, "limit": alpf_limit, "lowest_peak": lowest_accel_peak},
+            "butterworth": butterworth}}
+
+###############################################################################################
+#
+# Plots, if matplotlib is installed: the PSDs, the spectrogram of each sensor's axes summed, and
+# the gyro vibration peaks against throttle.
+#
+###############################################################################################
+def Plot(stream, summary, prefix):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as pyplot
+    except ImportError:
+        print("matplotlib not installed: no plots")
+        return []
+
+    file_names = []
+    frequencies = stream.frequencies
+    psd = stream.psd()
+
+    figure, plots = pyplot.subplots(2, 1, figsize = (10, 8), sharex = True)
+    for axis, name in enumerate(AXES):
+        plots[axis // 3].semilogy(frequencies, psd[:, axis], label = name)
+    plots[0].set_ylabel("accel PSD (g^2/Hz)")
+    plots[1].set_ylabel("gyro PSD ((degrees/s)^2/Hz)")
+    plots[1].set_xlabel("frequency (Hz)")
+    for plot in plots:
+        plot.legend()
+        plot.grid(True, which = "both", alpha = 0.3)
+    figure.savefig(prefix + "-psd.png")
+    file_names.append(prefix + "-psd.png")
+    pyplot.close(figure)
+
+    times, columns = stream.spectrogram()
+    if len(columns) > 1:
+        figure, plots = pyplot.subplots(2, 1, figsize = (10, 8), sharex = True)
+        for plot, first, label in ((plots[0], 0, "accel"), (plots[1], 3, "gyro")):
+            power = 10 * numpy.log10(columns[:, :, first:first + 3].sum(axis = 2).T + 1e-20)
+            mesh = plot.pcolormesh(times, frequencies, power, shading = "auto")
+            plot.set_ylabel("%s frequency (Hz)" % label)
+            figure.colorbar(mesh, ax = plot, label = "dB")
+        plots[1].set_xlabel("time (s)")
+        figure.savefig(prefix + "-spectrogram.png")
+        file_names.append(prefix + "-spectrogram.png")
+        pyplot.close(figure)
+
+    points = [(throttle_bin["throttle"] + THROTTLE_BIN / 2, peak["frequency"], peak["psd"])
+              for throttle_bin in summary["throttle_bins"] for peak in throttle_bin["gyro_peaks"]]
+    if points:
+        figure, plot = pyplot.subplots(figsize = (10, 5))
+        plot.scatter([point[0] for point in points], [point[1] for point in points],
+                     s = [20 + 10 * numpy.log10(point[2] / min(point[2] for point in points) + 1) ** 2 for point in points])
+        fit = summary["motor_vibration"]
+        if fit is not None:
+            throttles = numpy.array([points[0][0], points[-1][0]])
+            plot.plot(throttles, fit["hz_at_zero"] + fit["hz_per_throttle"] * throttles, "r--")
+        plot.set_xlabel("throttle")
+        plot.set_ylabel("gyro vibration peak (Hz)")
+        plot.grid(True, alpha = 0.3)
+        figure.savefig(prefix + "-throttle.png")
+        file_names.append(prefix + "-throttle.png")
+        pyplot.close(figure)
+
+    return file_names
+
+
+def Report(summary):
+    print("%s: %d samples at %.1fHz, %.1fs%s, %d gaps" % (summary["capture"], summary["samples"], summary["sample_rate"], summary["duration"],
+                                                          " (ring wrapped, latest kept)" if summary["wrapped"] else "", summary["gaps"]))
+    for name in AXES:
+        axis = summary["axes"][name]
+        print("%s: rms %.4f %s, peaks %s" % (name, axis["rms"], axis["units"], ", ".join(["%.1fHz" % peak["frequency"] for peak in axis["peaks"]]) or "none"))
+
+    if summary["motor_vibration"] is not None:
+        print("motor vibration: %.3fHz per unit throttle + %.1fHz" % (summary["motor_vibration"]["hz_per_throttle"], summary["motor_vibration"]["hz_at_zero"]))
+
+    recommendations = summary["recommendations"]
+    for name in ("glpf", "alpf"):
+        recommendation = recommendations[name]
+        print("--%s %d (%dHz): bandwidth limit %.1fHz, lowest peak %s" % (name, recommendation["setting"], recommendation["bandwidth"], recommendation["limit"],
+                                                                   "none" if recommendation["lowest_peak"] is None else "%.1fHz" % recommendation["lowest_peak"]))
+    butterworth = recommendations["butterworth"]
+    peak = butterworth["limiting_peak"]
+    print("Butterworth cutoff at most %.3fHz at the %.1fHz attitude rate, %s%s" %
+          (butterworth["cutoff"], butterworth["attitude_rate"],
+           "a tenth of the attitude rate" if peak is None else
+           "for the %.1fHz peak aliased to %.2fHz, -%.1fdB after averaging" % (peak["frequency"], peak["aliased"], peak["averaging_db"]),
+           " (floored: deal with the vibration at the DLPF or the props)" if butterworth["floored"] else ""))
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:', ['nperseg=', 'chunk=', 'atp='])
+    except getopt.GetoptError:
+        opts, args = [], []
+
+    if len(args) != 1:
+        print("qcspectrum.py [-o dir] [--nperseg=??] [--chunk=??] [--atp=??] qcimu<date>.bin")
+        sys.exit(2)
+
+    out_dir = None
+    nperseg = 512
+    chunk = 65536
+    attitude_period = 20
+    for opt, arg in opts:
+        if opt == '-o':
+            out_dir = arg
+        elif opt == '--nperseg':
+            nperseg = int(arg)
+        elif opt == '--chunk':
+            chunk = int(arg)
+        elif opt == '--atp':
+            attitude_period = int(arg)
+
+    try:
+        capture = Capture(args[0])
+        stream, summary = Analyse(capture, nperseg, chunk, attitude_period)
+    except (CaptureError, IOError) as err:
+        print(err)
+        sys.exit(1)
+
+    if out_dir is None:
+        out_dir = os.path.dirname(os.path.abspath(args[0]))
+    prefix = os.path.join(out_dir, os.path.splitext(os.path.basename(args[0]))[0])
+
+    summary["plots"] = Plot(stream, summary, prefix)
+    with open(prefix + "-spectrum.json", "w") as summary_file:
+        json.dump(summary, summary_file, indent = 2, sort_keys = True)
+
+    Report(summary)
+    print("summary written to %s" % (prefix + "-spectrum.json"))